@@ -2,6 +2,9 @@
 ASGI config for Baytdesign project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with uvicorn (see "Running the Server" in the README); the catalog
+and review views are async and run on the event loop, taking a thread only
+for each query and template render.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -39,8 +39,10 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'main_app.middleware.QueryInstrumentationMiddleware',
+    'main_app.routers.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'main_app.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -83,8 +85,21 @@ if DEBUG:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
-        }
+            # A file rather than the default shared in-memory database, so
+            # tests that run requests in parallel threads get normal SQLite
+            # locking (writers wait) instead of "table is locked" errors.
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        },
+        # A second SQLite file standing in for a read replica. Copy
+        # db.sqlite3 over it and set USE_SQLITE_REPLICA=1 to route catalog
+        # reads to it (see main_app/routers.py).
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db_replica.sqlite3',
+            'TEST': {'NAME': BASE_DIR / 'test_db_replica.sqlite3'},
+        },
     }
+    DATABASE_REPLICAS = ['replica'] if os.environ.get('USE_SQLITE_REPLICA') else []
 else:
 
     DATABASES = {
@@ -93,6 +108,42 @@ else:
             conn_max_age=600
         ),
     }
+    # Read replicas: a comma-separated list of database URLs.
+    DATABASE_REPLICAS = []
+    for number, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')), start=1):
+        DATABASES[f'replica{number}'] = dj_database_url.parse(url.strip(), conn_max_age=600)
+        DATABASE_REPLICAS.append(f'replica{number}')
+
+DATABASE_ROUTERS = ['main_app.routers.ReplicaRouter']
+
+# After writing, a browser reads from the primary for this many seconds,
+# long enough for the replicas to catch up.
+REPLICA_PIN_SECONDS = 5
+
+# Catalog pages cache fragments here (see main_app/catalog_cache.py). Production
+# runs several worker processes, so they need a cache they all share: Redis
+# when REDIS_URL is set, whose atomic add keeps one worker per recompute,
+# otherwise files on the shared disk.
+if DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+elif os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_DIR', '/var/tmp/baytdesign_cache'),
+        }
+    }
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',},
@@ -124,3 +175,38 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Background tasks are stored in the database and run by `manage.py run_worker`.
+# Set True to run them inline instead (no worker needed).
+TASKS_EAGER = False
+
+# Requests that run the same query this many times with different
+# parameters are logged as N+1 patterns by QueryInstrumentationMiddleware.
+QUERY_N_PLUS_ONE_THRESHOLD = 3
+
+# QueryPlanMixin.assertNoFullScan tolerates full scans of tables smaller
+# than this; past it, a hot query must use an index.
+QUERY_PLAN_SCAN_MIN_ROWS = 1000
+
+# The product vectors behind the similar-products lists (see
+# main_app/similarity.py), rewritten by each refresh.
+SIMILARITY_INDEX_PATH = os.environ.get('SIMILARITY_INDEX_PATH', str(BASE_DIR / 'similarity_index.npz'))
+
+# Milliseconds every query sleeps first, to benchmark against a slow
+# database (see main_app/latency.py). Keep at 0 outside benchmarks.
+SIMULATED_DB_LATENCY_MS = float(os.environ.get('SIMULATED_DB_LATENCY_MS', 0))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'main_app.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
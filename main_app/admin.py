@@ -1,9 +1,13 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.shortcuts import redirect, render
+from django.urls import path
+from .catalog_import import import_upload
 from .models import (
     Classification, Shop, Product,
     Budget, SelectedProduct, Cart,
     Wishlist, ProductReview, BudgetEstimate,
-    UserProfile
+    UserProfile, Task, ClassificationPriceStats, ShopPriceStats
 )
 
 # Classification admin
@@ -12,19 +16,79 @@ class ClassificationAdmin(admin.ModelAdmin):
     list_display = ("name", "slug", "icon")
     prepopulated_fields = {"slug": ("name",)}  # auto-generate slug
 
+# Catalog import (CSV/JSONL upload on the shop and product lists)
+class CatalogImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV, or JSONL (.jsonl) with one object per line.")
+
+
+class CatalogImportMixin:
+    change_list_template = "admin/catalog_change_list.html"
+    import_kind = None
+
+    def get_urls(self):
+        return [
+            path("import/", self.admin_site.admin_view(self.import_view),
+                 name=f"{self.opts.app_label}_{self.opts.model_name}_import"),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request) or not self.has_change_permission(request):
+            return redirect("admin:index")
+        form = CatalogImportForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            result = import_upload(form.cleaned_data["file"], self.import_kind)
+            messages.success(request, f"Imported {result}")
+            for reject in result.rejects[:20]:
+                messages.warning(request, f"Line {reject.line}: {reject.reason}")
+            if result.rejected > 20:
+                messages.warning(request, f"... and {result.rejected - 20} more rejected rows")
+            return redirect(f"admin:{self.opts.app_label}_{self.opts.model_name}_changelist")
+        return render(request, "admin/catalog_import.html", {
+            **self.admin_site.each_context(request),
+            "opts": self.opts,
+            "form": form,
+            "kind": self.import_kind,
+            "title": f"Import {self.import_kind}",
+        })
+
 # Shop admin
 @admin.register(Shop)
-class ShopAdmin(admin.ModelAdmin):
+class ShopAdmin(CatalogImportMixin, admin.ModelAdmin):
+    import_kind = "shops"
     list_display = ("name", "classification", "phone", "email")
     search_fields = ("name", "classification__name")
     list_filter = ("classification",)
 
 # Product admin
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ("name", "shop", "price", "is_available")
+class ProductAdmin(CatalogImportMixin, admin.ModelAdmin):
+    import_kind = "products"
+    list_display = ("name", "shop", "price", "is_available", "rating_count")
     search_fields = ("name", "shop__name")
     list_filter = ("shop", "is_available")
+    readonly_fields = (
+        "rating_count", "rating_sum",
+        "rating_1", "rating_2", "rating_3", "rating_4", "rating_5", "rating_avg",
+    )
+
+# Task admin
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ("name", "status", "attempts", "run_after", "created_at", "finished_at")
+    list_filter = ("status", "name")
+    search_fields = ("idempotency_key",)
+    readonly_fields = ("locked_by", "locked_at", "last_error", "created_at", "finished_at")
+
+# Price statistics (materialized by main_app.price_stats; read-only here)
+@admin.register(ClassificationPriceStats, ShopPriceStats)
+class PriceStatsAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "product_count", "min_price", "median_price", "max_price", "refreshed_at")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
 # Register other models quickly
 admin.site.register(Budget)
@@ -34,3 +98,4 @@ admin.site.register(Wishlist)
 admin.site.register(ProductReview)
 admin.site.register(BudgetEstimate)
 admin.site.register(UserProfile)
+
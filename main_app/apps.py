@@ -5,3 +5,6 @@ class MainAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main_app'
 
+    def ready(self):
+        # Connect the signal receivers and task handlers that live outside models.py.
+        from . import catalog_cache, catalog_import, images, latency, middleware, price_stats, recommendations, search, similarity  # noqa: F401
@@ -0,0 +1,339 @@
+"""
+End-to-end page benchmark.
+
+Every GET page in main_app/urls.py is requested repeatedly, either through
+the Django test client (in-process, with exact query counts from
+QueryInstrumentationMiddleware), through the ASGI application in-process
+(concurrent requests on one event loop, as under uvicorn), or over HTTP
+against a running server (query counts read back from the Server-Timing
+header). Results are plain dicts that are saved as JSON and compared
+against a baseline run.
+
+With `db_latency_ms`, every query of an in-process run sleeps first (see
+main_app/latency.py), which shows how much concurrency a serving mode
+gets out of a slow database: a sync worker waits out each query in turn,
+while the ASGI application keeps other requests moving.
+"""
+import asyncio
+import json
+import re
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
+from django.db.models import Count
+from django.test import Client
+from django.urls import URLPattern, reverse
+
+from . import urls
+from .models import Classification, Shop, Product, SelectedProduct, Cart, Wishlist, ProductReview
+
+
+# Routes that change data on GET; benchmarking them would mutate (or
+# delete) the very rows the other routes are measured against.
+WRITE_ROUTES = {
+    'logout', 'add_to_budget', 'remove_from_budget', 'update_quantity', 'add_to_cart',
+    'remove_from_cart', 'update_cart_quantity', 'batch_lines', 'add_to_wishlist', 'remove_from_wishlist',
+    'mark_as_purchased', 'delete_review',
+}
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def pick_user(username=None):
+    """The named user, or the user with the most cart rows (the heaviest pages)."""
+    if username:
+        return User.objects.get(username=username)
+    return (
+        User.objects.annotate(lines=Count('cart')).order_by('-lines', 'pk').first()
+    )
+
+
+def url_arguments(user):
+    """Values for every URL parameter name used in main_app/urls.py."""
+    product = Product.objects.annotate(reviews_count=Count('reviews')).order_by('-reviews_count', 'pk').first()
+    shop = Shop.objects.annotate(products=Count('product')).order_by('-products', 'pk').first()
+    classification = Classification.objects.annotate(shops=Count('shop')).order_by('-shops', 'pk').first()
+    values = {
+        'slug': classification and classification.slug,
+        'classification_id': classification and classification.pk,
+        'shop_id': shop and shop.pk,
+        'product_id': product and product.pk,
+    }
+    if user is not None:
+        for name, model in [
+            ('selected_product_id', SelectedProduct), ('cart_item_id', Cart),
+            ('wishlist_item_id', Wishlist), ('review_id', ProductReview),
+        ]:
+            values[name] = model.objects.filter(user=user).values_list('pk', flat=True).first()
+    return values
+
+
+def benchmark_routes(user):
+    """[(route name, path)] for every read route whose parameters can be filled."""
+    values = url_arguments(user)
+    routes, skipped = [], []
+    for pattern in urls.urlpatterns:
+        if not isinstance(pattern, URLPattern) or not pattern.name:
+            continue
+        if pattern.name in WRITE_ROUTES:
+            skipped.append(pattern.name)
+            continue
+        kwargs = {name: values.get(name) for name in pattern.pattern.converters}
+        if any(value is None for value in kwargs.values()):
+            skipped.append(pattern.name)
+            continue
+        routes.append((pattern.name, reverse(pattern.name, kwargs=kwargs)))
+    return routes, skipped
+
+
+class ClientTarget:
+    """Requests served in-process by the Django test client."""
+
+    def __init__(self, user):
+        # Server errors are recorded as 500s rather than aborting the run.
+        self.client = Client(raise_request_exception=False)
+        if user is not None:
+            self.client.force_login(user)
+
+    def get(self, path):
+        started = time.perf_counter()
+        response = self.client.get(path)
+        elapsed = time.perf_counter() - started
+        profile = getattr(response, 'query_profile', None)
+        return elapsed, response.status_code, profile.query_count if profile else None
+
+
+def session_cookie(user):
+    """A Cookie header value logged in as `user`, or None for anonymous requests."""
+    if user is None:
+        return None
+    # force_login() stores the session in the shared database, so a server
+    # (or the in-process ASGI application) accepts the same cookie.
+    client = Client()
+    client.force_login(user)
+    return f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+
+class ASGITarget:
+    """Requests served in-process by the ASGI application, sharing one event loop."""
+
+    def __init__(self, user):
+        self.application = ASGIHandler()
+        self.cookie = session_cookie(user)
+
+    async def aget(self, path):
+        started = time.perf_counter()
+        messages = await asgi_get(self.application, path, self.cookie)
+        elapsed = time.perf_counter() - started
+        start = next(message for message in messages if message['type'] == 'http.response.start')
+        response_headers = {name.decode().lower(): value.decode() for name, value in start['headers']}
+        match = SERVER_TIMING_QUERIES.search(response_headers.get('server-timing', ''))
+        return elapsed, start['status'], int(match.group(1)) if match else None
+
+
+async def asgi_get(application, path, cookie=None):
+    """GET `path` from an ASGI `application` in-process; returns every message it sent."""
+    path, _, query = path.partition('?')
+    headers = [(b'host', b'testserver')]
+    if cookie:
+        headers.append((b'cookie', cookie.encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': query.encode(), 'root_path': '', 'headers': headers,
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+    }
+    messages = []
+    body_sent = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Django listens for a disconnect while the view runs; the
+        # client never leaves.
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    return messages
+
+
+class HTTPTarget:
+    """Requests sent to a running server, authenticated with a session cookie."""
+
+    def __init__(self, base_url, user):
+        self.base_url = base_url.rstrip('/')
+        self.cookie = session_cookie(user)
+
+    def get(self, path):
+        request = urllib.request.Request(self.base_url + path)
+        if self.cookie:
+            request.add_header('Cookie', self.cookie)
+        opener = urllib.request.build_opener(NoRedirect)
+        started = time.perf_counter()
+        try:
+            with opener.open(request) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            status, headers = error.code, error.headers
+        elapsed = time.perf_counter() - started
+        match = SERVER_TIMING_QUERIES.search(headers.get('Server-Timing', ''))
+        return elapsed, status, int(match.group(1)) if match else None
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+async def measure_async(target, path, requests, warmup, concurrency):
+    """Run the requests as tasks on one event loop, at most `concurrency` at a time."""
+    for _ in range(warmup):
+        await target.aget(path)
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with slots:
+            return await target.aget(path)
+
+    started = time.perf_counter()
+    samples = await asyncio.gather(*(one() for _ in range(requests)))
+    return samples, time.perf_counter() - started
+
+
+def measure(target, path, requests=50, warmup=5, concurrency=1):
+    if hasattr(target, 'aget'):
+        samples, wall = asyncio.run(measure_async(target, path, requests, warmup, concurrency))
+        return summarize(path, requests, samples, wall)
+
+    for _ in range(warmup):
+        target.get(path)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(lambda _: target.get(path), range(requests)))
+    else:
+        samples = [target.get(path) for _ in range(requests)]
+    return summarize(path, requests, samples, time.perf_counter() - started)
+
+
+def summarize(path, requests, samples, wall):
+    latencies = sorted(elapsed * 1000 for elapsed, status, queries in samples)
+    queries = [queries for elapsed, status, queries in samples if queries is not None]
+    statuses = {}
+    for elapsed, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'path': path,
+        'requests': requests,
+        'statuses': statuses,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'throughput_rps': round(requests / wall, 2) if wall else None,
+        'queries': max(queries) if queries else None,
+    }
+
+
+def run_benchmark(requests=50, warmup=5, concurrency=1, base_url=None, username=None, only=None, log=None,
+                  asgi=False, db_latency_ms=None):
+    """Benchmark every read route and return the results as a JSON-ready dict."""
+    log = log or (lambda message: None)
+    user = pick_user(username)
+    routes, skipped = benchmark_routes(user)
+    if db_latency_ms is not None:
+        settings.SIMULATED_DB_LATENCY_MS = db_latency_ms
+        # Reconnect, so every connection from here on gets the delay.
+        connections.close_all()
+
+    if base_url:
+        target, target_name = HTTPTarget(base_url, user), base_url
+    elif asgi:
+        target, target_name = ASGITarget(user), 'asgi'
+    else:
+        target, target_name = ClientTarget(user), 'test-client'
+        # The test client and the in-process connection are not shared
+        # safely between threads.
+        concurrency = 1
+
+    results = {}
+    for name, path in routes:
+        if only and name not in only:
+            continue
+        results[name] = measure(target, path, requests=requests, warmup=warmup, concurrency=concurrency)
+        row = results[name]
+        log(f"{name:<24} p50 {row['p50_ms']:>8.2f}ms  p95 {row['p95_ms']:>8.2f}ms  "
+            f"p99 {row['p99_ms']:>8.2f}ms  {row['throughput_rps']:>8.1f} req/s  {row['queries']} queries")
+
+    return {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'target': target_name,
+            'db_latency_ms': settings.SIMULATED_DB_LATENCY_MS,
+            'user': user.username if user else None,
+            'requests': requests,
+            'warmup': warmup,
+            'concurrency': concurrency,
+            'rows': {
+                model._meta.model_name: model.objects.count()
+                for model in (Classification, Shop, Product, Cart, Wishlist, SelectedProduct, ProductReview)
+            },
+            'skipped': skipped,
+        },
+        'routes': results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare `results` with a `baseline` run; return a list of regression messages.
+
+    A route regresses when its p95 latency grows by more than `tolerance`
+    (a fraction) or it runs more queries than before.
+    """
+    regressions = []
+    for name, row in results['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        if before['p95_ms'] and row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.2f}ms -> {row['p95_ms']:.2f}ms")
+        if before['queries'] is not None and row['queries'] is not None and row['queries'] > before['queries']:
+            regressions.append(f"{name}: queries {before['queries']} -> {row['queries']}")
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as handle:
+        json.dump(results, handle, indent=2)
+
+
+def load(path):
+    with open(path) as handle:
+        return json.load(handle)
@@ -0,0 +1,329 @@
+from decimal import Decimal, InvalidOperation
+
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import Budget, SelectedProduct, Cart, Product
+from .recommendations import schedule_refresh as schedule_recommendations
+
+
+NEAR_BUDGET_RATIO = Decimal('0.9')
+
+# Most operations accepted by one apply_batch() call.
+MAX_BATCH_OPERATIONS = 500
+
+ZERO = Decimal('0')
+
+MONEY_FIELD = DecimalField(max_digits=14, decimal_places=2)
+
+CENT = Decimal('0.01')
+
+
+def line_total():
+    """price × quantity for a row that has a `product` FK and a `quantity`."""
+    return ExpressionWrapper(F('product__price') * F('quantity'), output_field=MONEY_FIELD)
+
+
+def sum_line_totals():
+    return Coalesce(Sum(line_total(), output_field=MONEY_FIELD), ZERO, output_field=MONEY_FIELD)
+
+
+def get_or_create_budget(user):
+    """Return the user's budget, creating it (or resetting a corrupt total) if needed."""
+    budget = None
+    try:
+        budget = Budget.objects.filter(user=user).first()
+        if not budget:
+            budget = Budget.objects.create(user=user, total=ZERO)
+        Decimal(str(budget.total))
+    except (InvalidOperation, ValueError):
+        if budget:
+            budget.total = ZERO
+            budget.save()
+        else:
+            budget = Budget.objects.create(user=user, total=ZERO)
+    return budget
+
+
+# Rows per INSERT in add_lines(), well under SQLite's and PostgreSQL's
+# limits on bound parameters.
+UPSERT_BATCH_SIZE = 500
+
+
+def add_lines(model, conflict_fields, lines):
+    """
+    Add quantities to several lines of `model` at once. `lines` is a list
+    of (values, quantity) pairs, as for add_to_line(), whose
+    `conflict_fields` values must all differ.
+
+    On SQLite and PostgreSQL each batch of UPSERT_BATCH_SIZE lines is one
+    multi-row INSERT ... ON CONFLICT DO UPDATE; call this inside a
+    transaction to apply several batches atomically. Returns
+    [(pk, new quantity)] in the order of `lines`.
+    """
+    # Raw SQL, so ask the router; this also pins the user to the primary.
+    connection = connections[router.db_for_write(model)]
+    if not (connection.vendor in ('sqlite', 'postgresql') and connection.features.can_return_columns_from_insert):
+        results = [add_line_fallback(model, conflict_fields, values, quantity) for values, quantity in lines]
+    else:
+        results = upsert_lines(connection, model, conflict_fields, lines)
+    # No save signals fire for these rows, so refresh the recommendations here.
+    schedule_recommendations(user_ids={values['user_id'] for values, quantity in lines})
+    return results
+
+
+def upsert_lines(connection, model, conflict_fields, lines):
+    """add_lines() as INSERT ... ON CONFLICT DO UPDATE ... RETURNING statements."""
+    meta = model._meta
+    qn = connection.ops.quote_name
+    table = qn(meta.db_table)
+    conflict = [meta.get_field(name) for name in conflict_fields]
+    quantity_column = qn(meta.get_field('quantity').column)
+    results = []
+    for start in range(0, len(lines), UPSERT_BATCH_SIZE):
+        batch = lines[start:start + UPSERT_BATCH_SIZE]
+        fields = [meta.get_field(name) for name in batch[0][0]]
+        columns = ', '.join([qn(field.column) for field in fields] + [quantity_column])
+        row = f"({', '.join(['%s'] * (len(fields) + 1))})"
+        params = []
+        for values, quantity in batch:
+            params.extend(field.get_db_prep_save(value, connection) for field, value in zip(fields, values.values()))
+            params.append(quantity)
+        sql = (
+            f"INSERT INTO {table} ({columns}) VALUES {', '.join([row] * len(batch))} "
+            f"ON CONFLICT ({', '.join(qn(field.column) for field in conflict)}) DO UPDATE "
+            f"SET {quantity_column} = {table}.{quantity_column} + EXCLUDED.{quantity_column} "
+            f"RETURNING {qn(meta.pk.column)}, {quantity_column}, "
+            f"{', '.join(qn(field.column) for field in conflict)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # RETURNING gives no ordering guarantee; match rows up by key.
+            saved = {tuple(key): (pk, quantity) for pk, quantity, *key in cursor.fetchall()}
+        results.extend(saved[tuple(values[field.attname] for field in conflict)] for values, quantity in batch)
+    return results
+
+
+def add_to_line(model, conflict_fields, values, quantity=1):
+    """
+    Add `quantity` to the line of `model` identified by `conflict_fields`,
+    inserting it with `values` (attname -> value) if it does not exist yet.
+
+    `conflict_fields` must be covered by a unique constraint. On SQLite and
+    PostgreSQL this is a single INSERT ... ON CONFLICT DO UPDATE, so
+    concurrent clicks cannot lose an increment. Returns (pk, new quantity).
+    """
+    return add_lines(model, conflict_fields, [(values, quantity)])[0]
+
+
+def add_line_fallback(model, conflict_fields, values, quantity):
+    """add_to_line() for databases without INSERT ... ON CONFLICT ... RETURNING."""
+    meta = model._meta
+    lookup = {name: values[meta.get_field(name).attname] for name in conflict_fields}
+    line = model.objects.filter(**lookup)
+    if not line.update(quantity=F('quantity') + quantity):
+        try:
+            with transaction.atomic():
+                model.objects.create(quantity=quantity, **values)
+        except IntegrityError:
+            # Lost the race to insert; the other request's row exists now.
+            line.update(quantity=F('quantity') + quantity)
+    return line.values_list('pk', 'quantity').get()
+
+
+def add_to_cart(user, product_id, quantity=1):
+    return add_to_line(
+        Cart, ['user', 'product'],
+        {'user_id': user.pk, 'product_id': product_id, 'added_at': timezone.now()},
+        quantity,
+    )
+
+
+def add_to_budget(budget, product_id, quantity=1):
+    return add_to_line(
+        SelectedProduct, ['budget', 'product'],
+        {'budget_id': budget.pk, 'product_id': product_id, 'user_id': budget.user_id},
+        quantity,
+    )
+
+
+def add_many_to_cart(user, quantities):
+    """add_to_cart() for every product_id -> quantity in `quantities`, in one statement per batch."""
+    now = timezone.now()
+    return add_lines(Cart, ['user', 'product'], [
+        ({'user_id': user.pk, 'product_id': product_id, 'added_at': now}, quantity)
+        for product_id, quantity in quantities.items()
+    ])
+
+
+def add_many_to_budget(budget, quantities):
+    """add_to_budget() for every product_id -> quantity in `quantities`."""
+    return add_lines(SelectedProduct, ['budget', 'product'], [
+        ({'budget_id': budget.pk, 'product_id': product_id, 'user_id': budget.user_id}, quantity)
+        for product_id, quantity in quantities.items()
+    ])
+
+
+class BatchError(ValueError):
+    """A batch that was refused as a whole; `errors` lists every problem found."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def merge_operations(operations):
+    """
+    Validate (product_id, quantity) operations, given as pairs or as
+    {"product_id": ..., "quantity": ...} objects, and return
+    {product_id: total quantity}. Raises BatchError.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise BatchError(['Expected a non-empty list of operations'])
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise BatchError([f'At most {MAX_BATCH_OPERATIONS} operations per batch'])
+
+    quantities, errors = {}, []
+    for index, operation in enumerate(operations):
+        if isinstance(operation, dict):
+            product_id, quantity = operation.get('product_id'), operation.get('quantity', 1)
+        elif isinstance(operation, (list, tuple)) and len(operation) == 2:
+            product_id, quantity = operation
+        else:
+            errors.append(f'Operation {index}: expected [product_id, quantity]')
+            continue
+        if type(product_id) is not int or type(quantity) is not int or quantity < 1:
+            errors.append(f'Operation {index}: product_id and a positive quantity must be integers')
+            continue
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    if errors:
+        raise BatchError(errors)
+    return quantities
+
+
+def apply_batch(user, target, operations, budget=None):
+    """
+    Add every operation to the user's cart or budget (`target`) in one
+    transaction, after checking all product ids with one in_bulk() query.
+    Nothing is written if any operation is invalid. Returns the changed
+    lines as dicts with id, product_id, quantity and total_price.
+    """
+    quantities = merge_operations(operations)
+    products = Product.objects.only('price').in_bulk(list(quantities))
+    missing = [product_id for product_id in quantities if product_id not in products]
+    if missing:
+        raise BatchError([f'Unknown product {product_id}' for product_id in missing])
+
+    with transaction.atomic():
+        if target == 'cart':
+            saved = add_many_to_cart(user, quantities)
+        else:
+            saved = add_many_to_budget(budget or get_or_create_budget(user), quantities)
+    return [
+        {'id': pk, 'product_id': product_id, 'quantity': quantity, 'total_price': products[product_id].price * quantity}
+        for product_id, (pk, quantity) in zip(quantities, saved)
+    ]
+
+
+class BudgetStatus:
+    """How much of a budget limit a given spend uses."""
+
+    def __init__(self, spent, limit):
+        self.spent = spent or ZERO
+        self.limit = limit or ZERO
+
+    @property
+    def remaining(self):
+        return self.limit - self.spent
+
+    @property
+    def percentage(self):
+        if self.limit > 0:
+            return self.spent / self.limit * Decimal('100')
+        return ZERO
+
+    @property
+    def is_over_budget(self):
+        return self.limit > 0 and self.spent > self.limit
+
+    @property
+    def over_budget_amount(self):
+        return self.spent - self.limit if self.is_over_budget else ZERO
+
+    @property
+    def is_near_budget(self):
+        return self.limit > 0 and self.spent > self.limit * NEAR_BUDGET_RATIO
+
+    def as_json(self):
+        return {
+            'remaining': self.remaining.quantize(CENT),
+            'percentage': self.percentage.quantize(Decimal('0.1')),
+            'is_over_budget': self.is_over_budget,
+            'over_budget_amount': self.over_budget_amount.quantize(CENT),
+            'is_near_budget': self.is_near_budget,
+        }
+
+
+class BudgetSummary:
+    """
+    Budget numbers for one user, computed in the database.
+
+    Line totals are annotated onto the `selected_products` and `cart_items`
+    querysets, and each total is one aggregate query run on first access, so
+    the cost does not grow with the number of line items.
+    """
+
+    def __init__(self, user, budget=None):
+        self.user = user
+        self.budget = budget or get_or_create_budget(user)
+
+        self.selected_products = (
+            SelectedProduct.objects
+            .filter(budget=self.budget, user=user)
+            .select_related('product')
+            .annotate(total_price=line_total())
+        )
+        self.cart_items = (
+            Cart.objects
+            .filter(user=user)
+            .select_related('product')
+            .annotate(total_price=line_total())
+        )
+
+    @cached_property
+    def budget_products_total(self):
+        return self.selected_products.aggregate(total=sum_line_totals())['total']
+
+    @cached_property
+    def cart_total(self):
+        return self.cart_items.aggregate(total=sum_line_totals())['total']
+
+    @property
+    def total_spent(self):
+        return self.budget_products_total + self.cart_total
+
+    @property
+    def status(self):
+        """Budget usage counting both selected products and the cart."""
+        return BudgetStatus(self.total_spent, self.budget.total)
+
+    @property
+    def cart_status(self):
+        """Budget usage counting the cart alone."""
+        return BudgetStatus(self.cart_total, self.budget.total)
+
+    def as_json(self):
+        """Totals and both budget statuses, for the JSON mutation endpoints."""
+        return {
+            'totals': {
+                'budget_products': self.budget_products_total.quantize(CENT),
+                'cart': self.cart_total.quantize(CENT),
+                'spent': self.total_spent.quantize(CENT),
+            },
+            'budget': self.budget.total.quantize(CENT),
+            'status': self.status.as_json(),
+            'cart_status': self.cart_status.as_json(),
+        }
@@ -0,0 +1,271 @@
+"""
+Budget-fitting bundles.
+
+suggest_bundle() answers "what should I buy with what is left?": from the
+user's wishlist, and optionally from the catalog for classifications the
+user still needs, it picks the products with the highest total priority
+whose cost fits the remaining budget.
+
+This is a bounded knapsack, solved as a group knapsack: every candidate
+group (one wishlist product, or one classification requirement) offers a
+few options, "k units of product p" for a cost and a value, and at most
+one option per group is taken. The dynamic programme runs over money in
+integer fils (price x 1000, exact for BHD), one NumPy vector operation
+per option, so a few thousand candidates solve in well under a second.
+When the budget spans more than MAX_CELLS steps of the prices' common
+divisor, the step is coarsened and costs are rounded up, so a suggestion
+can only ever be cheaper than the budget, never over it.
+"""
+import math
+from collections import namedtuple
+from decimal import Decimal, ROUND_CEILING
+
+import numpy as np
+
+from .budget import BudgetSummary, CENT, ZERO
+from .models import Cart, Product, SelectedProduct, Wishlist
+
+
+FILS = 1000
+
+# Most budget steps the dynamic programme works over.
+MAX_CELLS = 20_000
+
+# Value per unit of a wishlist product, and per unit bought towards a
+# requirement (scaled by the product's rating, see requirement_groups).
+WISHLIST_PRIORITY = 3.0
+REQUIREMENT_PRIORITY = 5.0
+
+# Top-rated affordable products considered for each requirement.
+REQUIREMENT_CANDIDATES = 20
+
+MAX_QUANTITY = 10
+MAX_REQUIREMENTS = 10
+
+# `key` is ('product', id) or ('classification', id); `options` are
+# (product, quantity, cost in fils, value) tuples.
+Group = namedtuple('Group', ['key', 'options'])
+
+BundleLine = namedtuple('BundleLine', ['product', 'quantity', 'total', 'source'])
+
+Bundle = namedtuple('Bundle', ['lines', 'total', 'remaining', 'value', 'missing'])
+
+
+class BundleOptionsError(ValueError):
+    """Invalid options for suggest_bundle(); `errors` lists what was wrong."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def to_fils(amount):
+    """A money amount as integer fils, rounded up."""
+    return int((Decimal(amount) * FILS).to_integral_value(ROUND_CEILING))
+
+
+def solve(groups, capacity):
+    """
+    Pick at most one option from each group to maximise total value with
+    total cost (fils) at most `capacity`.
+
+    Returns the chosen option index for each group, or None where the group
+    is left out.
+    """
+    costs = [cost for group in groups for product, quantity, cost, value in group.options]
+    if capacity <= 0 or not costs:
+        return [None] * len(groups)
+
+    step = math.gcd(*costs) or 1
+    if capacity // step > MAX_CELLS:
+        step = -(-capacity // MAX_CELLS)
+    cells = capacity // step
+
+    # best[c]: the highest value found so far costing at most c steps.
+    best = np.zeros(cells + 1)
+    # Per group, the option (1-based, 0 for none) taken at each capacity.
+    # Single-option groups, the common case, store it as packed bits.
+    choices = []
+    for group in groups:
+        updated = best.copy()
+        choice = np.zeros(cells + 1, dtype=np.uint8)
+        for number, (product, quantity, cost, value) in enumerate(group.options, start=1):
+            width = -(-cost // step)
+            if width > cells:
+                continue
+            candidate = best[:cells + 1 - width] + value
+            better = candidate > updated[width:]
+            updated[width:] = np.where(better, candidate, updated[width:])
+            choice[width:][better] = number
+        choices.append(np.packbits(choice) if len(group.options) == 1 else choice)
+        best = updated
+
+    # Of the equally valuable sets, take the cheapest: start from the
+    # smallest capacity that already reaches the best value.
+    picked = [None] * len(groups)
+    remaining = int(np.argmax(best >= best[-1] - 1e-9))
+    for index in range(len(groups) - 1, -1, -1):
+        choice = choices[index]
+        if len(groups[index].options) == 1:
+            number = (choice[remaining >> 3] >> (7 - (remaining & 7))) & 1
+        else:
+            number = choice[remaining]
+        if number:
+            picked[index] = int(number) - 1
+            remaining -= -(-groups[index].options[number - 1][2] // step)
+    return picked
+
+
+def wishlist_groups(user, budget, priorities=None, quantities=None):
+    """
+    One group per available wishlist product not already in the cart or
+    the budget, with options for 1 up to its wanted quantity.
+    """
+    priorities = priorities or {}
+    quantities = quantities or {}
+    items = (
+        Wishlist.objects
+        .filter(user=user, product__is_available=True)
+        .exclude(product__in=Cart.objects.filter(user=user).values('product'))
+        .exclude(product__in=SelectedProduct.objects.filter(budget=budget).values('product'))
+        .select_related('product')
+        .order_by('added_at', 'pk')
+    )
+    groups = []
+    seen = set()
+    for item in items:
+        product = item.product
+        if product.price <= ZERO or product.pk in seen:
+            continue
+        seen.add(product.pk)
+        priority = float(priorities.get(product.pk, WISHLIST_PRIORITY))
+        wanted = min(quantities.get(product.pk, 1), MAX_QUANTITY)
+        cost = to_fils(product.price)
+        groups.append(Group(('product', product.pk), [
+            (product, quantity, cost * quantity, priority * quantity)
+            for quantity in range(1, wanted + 1)
+        ]))
+    return groups
+
+
+def requirement_groups(requirements, remaining, priorities=None, exclude=()):
+    """
+    One group per (classification id, quantity) requirement: buy up to
+    that many units of one of the classification's top-rated affordable
+    products, other than those in `exclude`. Better-rated products are
+    worth up to twice as much.
+    """
+    priorities = priorities or {}
+    groups = []
+    for classification_id, wanted in list(requirements.items())[:MAX_REQUIREMENTS]:
+        wanted = min(wanted, MAX_QUANTITY)
+        products = (
+            Product.objects
+            .filter(shop__classification_id=classification_id, is_available=True,
+                    price__gt=ZERO, price__lte=remaining)
+            .exclude(pk__in=exclude)
+            .order_by('-rating_avg', 'price', 'pk')[:REQUIREMENT_CANDIDATES]
+        )
+        options = []
+        for product in products:
+            priority = float(priorities.get(product.pk, REQUIREMENT_PRIORITY)) * (1 + product.rating_avg / 5)
+            cost = to_fils(product.price)
+            options.extend(
+                (product, quantity, cost * quantity, priority * quantity)
+                for quantity in range(1, wanted + 1)
+            )
+        if options:
+            groups.append(Group(('classification', classification_id), options))
+    return groups
+
+
+def suggest_bundle(user, summary=None, requirements=None, priorities=None, quantities=None):
+    """
+    The best set of products to add within the user's remaining budget.
+
+    `requirements` maps classification ids to the number of units needed
+    from them; `priorities` maps product ids to a value per unit, and
+    `quantities` wishlist product ids to the most units wanted (default 1).
+    Requirements the bundle cannot meet are listed in `missing`.
+    """
+    summary = summary or BudgetSummary(user)
+    requirements = requirements or {}
+    remaining = max(summary.status.remaining, ZERO)
+
+    groups = wishlist_groups(user, summary.budget, priorities, quantities)
+    wishlisted = [group.key[1] for group in groups]
+    groups += requirement_groups(requirements, remaining, priorities, exclude=wishlisted)
+    picked = solve(groups, int(remaining * FILS))
+
+    lines = []
+    value = 0.0
+    met = {}
+    for group, option in zip(groups, picked):
+        if option is None:
+            continue
+        product, quantity, cost, option_value = group.options[option]
+        kind, key = group.key
+        lines.append(BundleLine(product, quantity, product.price * quantity,
+                                'wishlist' if kind == 'product' else 'requirement'))
+        value += option_value
+        if kind == 'classification':
+            met[key] = quantity
+    total = sum((line.total for line in lines), ZERO)
+    missing = {
+        classification_id: wanted - met.get(classification_id, 0)
+        for classification_id, wanted in requirements.items()
+        if met.get(classification_id, 0) < wanted
+    }
+    return Bundle(lines, total, remaining - total, value, missing)
+
+
+def parse_options(data):
+    """
+    Keyword arguments for suggest_bundle() from a JSON object such as
+    {"requirements": {"3": 2}, "priorities": {"17": 5}, "quantities": {"17": 2}},
+    whose keys are ids and whose values are positive numbers.
+    """
+    if not isinstance(data, dict):
+        raise BundleOptionsError(['Body must be a JSON object'])
+    options = {}
+    errors = []
+    for name, kind in (('requirements', int), ('priorities', float), ('quantities', int)):
+        mapping = data.get(name) or {}
+        if not isinstance(mapping, dict):
+            errors.append(f'{name} must be an object')
+            continue
+        options[name] = {}
+        for key, value in mapping.items():
+            try:
+                key = int(key)
+            except ValueError:
+                errors.append(f'{name}: {key!r} is not an id')
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0 \
+                    or (kind is int and not isinstance(value, int)):
+                errors.append(f'{name}[{key}]: {value!r} is not a positive {kind.__name__}')
+                continue
+            options[name][key] = kind(value)
+    if errors:
+        raise BundleOptionsError(errors)
+    return options
+
+
+def bundle_json(bundle):
+    return {
+        'lines': [
+            {
+                'product_id': line.product.pk,
+                'name': line.product.name,
+                'price': line.product.price.quantize(CENT),
+                'quantity': line.quantity,
+                'total': line.total.quantize(CENT),
+                'source': line.source,
+            }
+            for line in bundle.lines
+        ],
+        'total': bundle.total.quantize(CENT),
+        'remaining': bundle.remaining.quantize(CENT),
+        'value': round(bundle.value, 3),
+        'missing': {str(key): count for key, count in bundle.missing.items()},
+    }
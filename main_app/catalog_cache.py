@@ -0,0 +1,267 @@
+"""
+Versioned, stale-while-revalidate cache for catalog pages.
+
+Cached fragments are tagged with version counters for the scopes they
+depend on ('catalog' for the classification list, 'classification:<id>'
+for a classification's shops and products, 'shop:<id>' for a shop and
+its products). The model signals below bump those counters once the
+write commits, which makes every fragment in the scope stale without
+having to find and delete its keys.
+
+A stale fragment is recomputed by the one request that wins a short lock;
+concurrent requests keep serving the stale copy meanwhile, so an edit
+does not send every visitor to the database at once. Recomputes read
+from the primary even when the request otherwise uses a replica.
+
+Counters are never incremented in place: bump() writes a fresh unique
+value with a plain set, so two bumps racing on a cache without an atomic
+incr (FileBasedCache) cannot both land on the same value and leave a
+fragment computed in between looking current. Counters expire with the
+fragments; a restarted counter is just as new, so the fragments it
+covered are recomputed.
+
+Callers build fragment keys only from validated values (a known sort,
+parsed filters), never from raw query strings, so clients cannot fill
+the cache with keys of their choosing.
+
+The same counters back the ETag of the catalog pages (see
+conditional_page), so a repeat visit to an unchanged page is answered
+with a 304 before the view runs its listing query or template.
+"""
+import hashlib
+import time
+import uuid
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.views.decorators.http import condition
+
+from .models import Classification, Shop, Product, ProductReview, UserProfile
+from .routers import primary_reads
+
+
+FRESH_SECONDS = 300
+
+KEEP_SECONDS = 24 * 60 * 60
+
+LOCK_SECONDS = 30
+
+
+def version_key(scope):
+    return f'catalog:version:{scope}'
+
+
+def fragment_key(parts):
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return f'catalog:fragment:{digest}'
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def bump(*scopes):
+    cache.set_many({version_key(scope): new_version() for scope in scopes}, KEEP_SECONDS)
+
+
+def bump_on_commit(*scopes):
+    """
+    bump() once the current transaction commits (at once outside one).
+    Bumping earlier would let another request recompute a fragment from
+    the old rows and store it under the new versions.
+    """
+    transaction.on_commit(lambda: bump(*scopes))
+
+
+def read_versions(version_keys, found):
+    """The counters for `version_keys` from a get_many() result, starting missing ones."""
+    versions = []
+    for vkey in version_keys:
+        if vkey not in found:
+            cache.add(vkey, new_version(), KEEP_SECONDS)
+            found[vkey] = cache.get(vkey)
+        versions.append(found[vkey])
+    return versions
+
+
+def cached_fragment(parts, scopes, compute, fresh_for=FRESH_SECONDS):
+    """
+    Return compute() for the fragment identified by `parts`, cached.
+
+    `scopes` lists the version counters the fragment depends on. The
+    counters and the fragment are read in one cache round trip.
+    """
+    key = fragment_key(parts)
+    version_keys = [version_key(scope) for scope in scopes]
+    found = cache.get_many(version_keys + [key])
+    versions = read_versions(version_keys, found)
+
+    entry = found.get(key)
+    if entry is not None:
+        entry_versions, fresh_until, value = entry
+        if entry_versions == versions and fresh_until > time.time():
+            return value
+        if not cache.add(f'{key}:lock', 1, LOCK_SECONDS):
+            return value
+    else:
+        cache.add(f'{key}:lock', 1, LOCK_SECONDS)
+
+    try:
+        # Shared by every user, so never computed from a lagging replica.
+        with primary_reads():
+            value = compute()
+        cache.set(key, (versions, time.time() + fresh_for, value), KEEP_SECONDS)
+    finally:
+        cache.delete(f'{key}:lock')
+    return value
+
+
+async def aread_versions(version_keys, found):
+    """read_versions() through the cache's async API."""
+    versions = []
+    for vkey in version_keys:
+        if vkey not in found:
+            await cache.aadd(vkey, new_version(), KEEP_SECONDS)
+            found[vkey] = await cache.aget(vkey)
+        versions.append(found[vkey])
+    return versions
+
+
+async def acached_fragment(parts, scopes, compute, fresh_for=FRESH_SECONDS):
+    """cached_fragment() for async views; `compute` returns an awaitable."""
+    key = fragment_key(parts)
+    version_keys = [version_key(scope) for scope in scopes]
+    found = await cache.aget_many(version_keys + [key])
+    versions = await aread_versions(version_keys, found)
+
+    entry = found.get(key)
+    if entry is not None:
+        entry_versions, fresh_until, value = entry
+        if entry_versions == versions and fresh_until > time.time():
+            return value
+        if not await cache.aadd(f'{key}:lock', 1, LOCK_SECONDS):
+            return value
+    else:
+        await cache.aadd(f'{key}:lock', 1, LOCK_SECONDS)
+
+    try:
+        with primary_reads():
+            value = await compute()
+        await cache.aset(key, (versions, time.time() + fresh_for, value), KEEP_SECONDS)
+    finally:
+        await cache.adelete(f'{key}:lock')
+    return value
+
+
+def conditional_page(name, scopes):
+    """
+    Decorator for a catalog page view: send a weak ETag and answer a
+    matching If-None-Match with a 304 without calling the view.
+
+    `scopes(*args, **kwargs)` returns the version scopes the page depends
+    on (None if the page does not exist, leaving the view to 404). The
+    ETag is built from their counters, so a revalidation costs no queries
+    beyond loading the session. There is no Last-Modified: no timestamp
+    moves when a product is deleted or made unavailable, but the counters
+    do.
+
+    Pages carry the user's menu and CSRF token, so the ETag includes the
+    user, their profile version and the CSRF cookie. Requests with queued
+    flash messages always get the full page.
+
+    Async views are supported: the ETag, which loads the session and may
+    query, is computed in a thread before condition() reads it.
+    """
+    def etag(request, *args, **kwargs):
+        if not hasattr(request, '_page_etag'):
+            request._page_etag = None
+            page_scopes = scopes(*args, **kwargs)
+            if page_scopes is not None and not len(messages.get_messages(request)):
+                request._page_etag = page_etag(request, name, page_scopes)
+        return request._page_etag
+
+    def decorator(view):
+        conditional = condition(etag_func=etag)(view)
+        if not iscoroutinefunction(view):
+            return conditional
+
+        @wraps(view)
+        async def inner(request, *args, **kwargs):
+            # Async login_required loads the user with auser(); reuse it
+            # rather than querying again through the lazy request.user.
+            request.user = await request.auser()
+            await sync_to_async(etag)(request, *args, **kwargs)
+            return await conditional(request, *args, **kwargs)
+        return inner
+
+    return decorator
+
+
+def page_etag(request, name, scopes):
+    user_id = request.user.pk
+    scopes = list(scopes) + ([f'user:{user_id}'] if user_id else [])
+    version_keys = [version_key(scope) for scope in scopes]
+    versions = read_versions(version_keys, cache.get_many(version_keys))
+    identity = (name, versions, user_id, request.META.get('CSRF_COOKIE'))
+    return f'W/"{hashlib.md5(repr(identity).encode()).hexdigest()}"'
+
+
+@receiver(post_save, sender=Classification)
+@receiver(post_delete, sender=Classification)
+def bump_classification_versions(sender, instance, **kwargs):
+    bump_on_commit('catalog', f'classification:{instance.pk}')
+
+
+@receiver(pre_save, sender=Shop)
+@receiver(pre_save, sender=Product)
+def remember_parent(sender, instance, **kwargs):
+    # A shop (or product) moved to another parent must invalidate both lists.
+    field = 'classification_id' if sender is Shop else 'shop_id'
+    instance._cached_parent_id = None
+    if instance.pk:
+        instance._cached_parent_id = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+def bump_shop_versions(sender, instance, **kwargs):
+    previous = getattr(instance, '_cached_parent_id', None)
+    scopes = {f'shop:{instance.pk}', f'classification:{instance.classification_id}'}
+    if previous and previous != instance.classification_id:
+        scopes.add(f'classification:{previous}')
+    bump_on_commit(*scopes)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def bump_product_versions(sender, instance, **kwargs):
+    previous = getattr(instance, '_cached_parent_id', None)
+    shop_ids = {instance.shop_id, previous} - {None}
+    # The classification page counts its products in the facets (see facets.py).
+    classification_ids = Shop.objects.filter(pk__in=shop_ids).values_list('classification_id', flat=True)
+    bump_on_commit(f'product:{instance.pk}', *{f'shop:{pk}' for pk in shop_ids},
+                   *{f'classification:{pk}' for pk in classification_ids})
+
+
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def bump_review_versions(sender, instance, **kwargs):
+    # Ratings shown on product cards, and counted in the rating facet, change with every review.
+    parents = Product.objects.filter(pk=instance.product_id).values_list('shop_id', 'shop__classification_id').first()
+    scopes = [f'product:{instance.product_id}']
+    if parents:
+        scopes += [f'shop:{parents[0]}', f'classification:{parents[1]}']
+    bump_on_commit(*scopes)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def bump_user_versions(sender, instance, **kwargs):
+    # The page header shows the user's name and picture; saving the User
+    # also saves the profile (see models.save_user_profile).
+    bump_on_commit(f'user:{instance.user_id}')
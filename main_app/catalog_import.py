@@ -0,0 +1,361 @@
+"""
+Streaming import of vendor catalogs.
+
+Shops and products are read from CSV or JSONL one row at a time,
+validated, and upserted in batches with
+`bulk_create(update_conflicts=True)` keyed on the vendor's `external_id`
+(per shop, for products), so a file can be re-imported to update it.
+Memory use depends on the batch size, not on the file size.
+
+Columns (CSV header or JSON keys):
+
+    shops:    external_id, name, classification (slug or name),
+              description, phone, email, address, image_url
+    products: external_id, shop (the shop's external_id), name, price,
+              description, is_available, image_url
+
+A file is a snapshot of the vendor's records: optional columns that are
+missing or empty are stored empty. Images are downloaded afterwards by
+the task worker. Rows that fail validation are reported as rejects and
+the rest of the file is still imported.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, UnidentifiedImageError
+
+from .catalog_cache import bump
+from .models import Classification, Shop, Product
+from .price_stats import schedule_refresh
+from .search import index_objects
+from .similarity import schedule_refresh as schedule_similarity_refresh
+from .tasks import enqueue_many, register_task
+
+
+BATCH_SIZE = 2000
+
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+IMAGE_FETCH_TIMEOUT = 20
+
+# The most rejects kept in ImportResult; the rest are only counted.
+MAX_REPORTED_REJECTS = 1000
+
+PRICE_LIMIT = Decimal('1e8')
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y'}
+
+FALSE_VALUES = {'0', 'false', 'no', 'n'}
+
+Reject = namedtuple('Reject', ['line', 'reason'])
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportResult:
+    def __init__(self, on_reject=None):
+        self.on_reject = on_reject
+        self.rows = 0
+        self.upserted = 0
+        self.rejected = 0
+        self.images_queued = 0
+        self.rejects = []
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        if self.on_reject:
+            self.on_reject(Reject(line, reason))
+        if len(self.rejects) < MAX_REPORTED_REJECTS:
+            self.rejects.append(Reject(line, reason))
+
+    def __str__(self):
+        return (f'{self.rows} rows: {self.upserted} upserted, {self.rejected} rejected, '
+                f'{self.images_queued} images queued')
+
+
+def detect_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(handle, fmt):
+    """Yield (line number, row dict or None, error) from a text file handle."""
+    if fmt == 'csv':
+        reader = csv.DictReader(handle)
+        for row in reader:
+            if None in row:
+                yield reader.line_num, None, 'More values than header columns'
+            else:
+                yield reader.line_num, row, None
+        return
+
+    for line_number, line in enumerate(handle, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, None, f'Invalid JSON: {error}'
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, 'Expected a JSON object'
+        else:
+            yield line_number, row, None
+
+
+def text(row, name, max_length=None, required=False):
+    value = row.get(name)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f'Missing {name}')
+    if max_length and len(value) > max_length:
+        raise RowError(f'{name} is longer than {max_length} characters')
+    return value
+
+
+def clean_price(value):
+    try:
+        price = Decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        raise RowError(f'Invalid price {value!r}')
+    if not price.is_finite() or price < 0:
+        raise RowError(f'Invalid price {value!r}')
+    if price.as_tuple().exponent < -2:
+        raise RowError(f'Price {value!r} has more than 2 decimal places')
+    if price >= PRICE_LIMIT:
+        raise RowError(f'Price {value!r} is too large')
+    return price.quantize(Decimal('0.01'))
+
+
+def clean_bool(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    normalized = str(value).strip().lower()
+    if normalized in TRUE_VALUES:
+        return True
+    if normalized in FALSE_VALUES:
+        return False
+    raise RowError(f'Invalid is_available {value!r}')
+
+
+def clean_image_url(row):
+    url = text(row, 'image_url')
+    if url and urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+        raise RowError('image_url must be an http(s) URL')
+    return url
+
+
+class ShopImporter:
+    model = Shop
+    update_fields = ['name', 'classification', 'description', 'phone', 'email', 'address', 'updated_at']
+
+    def __init__(self):
+        # Classifications are a short list; resolve them from memory.
+        self.classifications = {}
+        for pk, slug, name in Classification.objects.values_list('pk', 'slug', 'name'):
+            self.classifications[slug.lower()] = pk
+            self.classifications.setdefault(name.lower(), pk)
+
+    def clean(self, row):
+        classification = text(row, 'classification', required=True)
+        classification_id = self.classifications.get(classification.lower())
+        if classification_id is None:
+            raise RowError(f'Unknown classification {classification!r}')
+        shop = Shop(
+            external_id=text(row, 'external_id', max_length=100, required=True),
+            name=text(row, 'name', max_length=200, required=True),
+            classification_id=classification_id,
+            description=text(row, 'description'),
+            phone=text(row, 'phone', max_length=20),
+            email=text(row, 'email', max_length=254),
+            address=text(row, 'address'),
+        )
+        return (shop.external_id,), shop, clean_image_url(row)
+
+    def resolve(self, batch):
+        # Classifications were resolved in clean().
+        return batch, []
+
+    def upsert(self, objects):
+        keys = [shop.external_id for shop in objects]
+        previous = dict(Shop.objects.filter(external_id__in=keys).values_list('pk', 'classification_id'))
+        Shop.objects.bulk_create(objects, update_conflicts=True, unique_fields=['external_id'],
+                                 update_fields=self.update_fields)
+        saved = dict(Shop.objects.filter(external_id__in=keys).values_list('external_id', 'pk'))
+
+        scopes = {f'classification:{shop.classification_id}' for shop in objects}
+        scopes.update(f'classification:{classification_id}' for classification_id in previous.values())
+        scopes.update(f'shop:{pk}' for pk in saved.values())
+        return {(key,): pk for key, pk in saved.items()}, scopes
+
+
+class ProductImporter:
+    model = Product
+    update_fields = ['name', 'price', 'description', 'is_available', 'updated_at']
+
+    def clean(self, row):
+        product = Product(
+            external_id=text(row, 'external_id', max_length=100, required=True),
+            name=text(row, 'name', max_length=200, required=True),
+            price=clean_price(text(row, 'price', required=True)),
+            description=text(row, 'description'),
+            is_available=clean_bool(row.get('is_available')),
+        )
+        product.shop_external_id = text(row, 'shop', required=True)
+        return (product.shop_external_id, product.external_id), product, clean_image_url(row)
+
+    def resolve(self, batch):
+        """Set shop_id on each cleaned row with one query; return [(line, reason)] for unknown shops."""
+        shop_keys = {product.shop_external_id for line, key, product, image_url in batch}
+        shops = dict(Shop.objects.filter(external_id__in=shop_keys).values_list('external_id', 'pk'))
+        resolved, missing = [], []
+        for line, key, product, image_url in batch:
+            product.shop_id = shops.get(product.shop_external_id)
+            if product.shop_id is None:
+                missing.append((line, f'Unknown shop {product.shop_external_id!r}'))
+            else:
+                resolved.append((line, key, product, image_url))
+        return resolved, missing
+
+    def upsert(self, objects):
+        Product.objects.bulk_create(objects, update_conflicts=True, unique_fields=['shop', 'external_id'],
+                                    update_fields=self.update_fields)
+        shop_ids = {product.shop_id for product in objects}
+        saved = {}
+        rows = Product.objects.filter(
+            shop_id__in=shop_ids, external_id__in={product.external_id for product in objects}
+        ).values_list('shop__external_id', 'external_id', 'pk', 'shop__classification_id')
+        scopes = {f'shop:{shop_id}' for shop_id in shop_ids}
+        for shop_key, key, pk, classification_id in rows:
+            saved[(shop_key, key)] = pk
+            # The classification page counts its products in the facets.
+            scopes.add(f'classification:{classification_id}')
+        scopes.update(f'product:{pk}' for pk in saved.values())
+        return saved, scopes
+
+
+def scope_ids(scopes, name):
+    """The ids of the `name:<id>` cache scopes in `scopes`."""
+    prefix = f'{name}:'
+    return [int(scope[len(prefix):]) for scope in scopes if scope.startswith(prefix)]
+
+
+IMPORTERS = {
+    'shops': ShopImporter,
+    'products': ProductImporter,
+}
+
+
+def import_catalog(handle, kind, fmt='csv', batch_size=BATCH_SIZE, log=None, on_reject=None):
+    """
+    Import shops or products from the text file `handle` and return an ImportResult.
+
+    `on_reject` is called with every Reject; the result keeps only the
+    first MAX_REPORTED_REJECTS.
+
+    Each batch is upserted in its own transaction, so an interrupted import
+    keeps the batches already written and can simply be run again.
+    """
+    importer = IMPORTERS[kind]()
+    result = ImportResult(on_reject)
+    batch = {}
+
+    def flush():
+        rows, missing = importer.resolve(list(batch.values()))
+        batch.clear()
+        for line, reason in missing:
+            result.reject(line, reason)
+        if not rows:
+            return
+        with transaction.atomic():
+            saved, scopes = importer.upsert([obj for line, key, obj, image_url in rows])
+        result.upserted += len(rows)
+
+        index_objects(importer.model, saved.values())
+        bump(*scopes)
+        schedule_refresh(shop_ids=scope_ids(scopes, 'shop'), classification_ids=scope_ids(scopes, 'classification'))
+        schedule_similarity_refresh()
+        label = importer.model._meta.label_lower
+        jobs = [
+            ({'model': label, 'pk': saved[key], 'url': image_url},
+             f'fetch-image:{label}:{saved[key]}:{hashlib.md5(image_url.encode()).hexdigest()}')
+            for line, key, obj, image_url in rows
+            if image_url and key in saved
+        ]
+        if jobs:
+            result.images_queued += enqueue_many('catalog.fetch_image', jobs)
+        if log:
+            log(f'{result.rows} rows read, {result.upserted} upserted, {result.rejected} rejected')
+
+    for line, row, error in read_rows(handle, fmt):
+        result.rows += 1
+        if error:
+            result.reject(line, error)
+            continue
+        try:
+            key, obj, image_url = importer.clean(row)
+        except RowError as error:
+            result.reject(line, str(error))
+            continue
+        # A key repeated within one batch would make the upsert touch the
+        # same row twice, which PostgreSQL refuses; the later row wins.
+        batch.pop(key, None)
+        batch[key] = (line, key, obj, image_url)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return result
+
+
+def import_file(path, kind, fmt=None, batch_size=BATCH_SIZE, log=None, on_reject=None):
+    with open(path, encoding='utf-8-sig', newline='') as handle:
+        return import_catalog(handle, kind, fmt or detect_format(path), batch_size=batch_size,
+                              log=log, on_reject=on_reject)
+
+
+def import_upload(uploaded_file, kind, batch_size=BATCH_SIZE):
+    """import_catalog() for a Django UploadedFile, read as a stream."""
+    handle = io.TextIOWrapper(uploaded_file.file, encoding='utf-8-sig', newline='')
+    try:
+        return import_catalog(handle, kind, detect_format(uploaded_file.name), batch_size=batch_size)
+    finally:
+        handle.detach()
+
+
+@register_task('catalog.fetch_image')
+def fetch_image(payload):
+    """Download an imported row's image_url into its image field."""
+    model = apps.get_model(payload['model'])
+    instance = model.objects.filter(pk=payload['pk']).first()
+    if instance is None:
+        return
+
+    request = urllib.request.Request(payload['url'], headers={'User-Agent': 'BaytDesign catalog import'})
+    with urllib.request.urlopen(request, timeout=IMAGE_FETCH_TIMEOUT) as response:
+        data = response.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f"Image at {payload['url']} is larger than {MAX_IMAGE_BYTES} bytes")
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+            extension = (image.format or 'jpeg').lower().replace('jpeg', 'jpg')
+    except (UnidentifiedImageError, OSError):
+        raise ValueError(f"{payload['url']} is not an image")
+
+    stem = os.path.splitext(os.path.basename(urllib.parse.urlsplit(payload['url']).path))[0] or 'image'
+    instance.image.save(f'{stem}.{extension}', ContentFile(data), save=False)
+    # A regular save, so the variants, search and cache signals all run.
+    instance.save(update_fields=['image'])
@@ -0,0 +1,148 @@
+"""
+Streaming data exports.
+
+Each export is a queryset walked with `iterator(chunk_size=...)` and the
+related rows it needs joined in with select_related, rendered one line
+at a time as CSV or JSONL. Nothing is accumulated, so a full catalog dump
+runs in constant memory and the first bytes go out immediately; the
+staff views wrap the same generators in a StreamingHttpResponse.
+
+Under ASGI, Django buffers a streaming response built on a sync iterator
+in full before sending it, so astream_export() hands the view an async
+iterator instead, pulling ASYNC_BATCH_LINES lines from the generator per
+hop to a thread.
+"""
+import csv
+import json
+from collections import namedtuple
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .budget import line_total
+from .models import Shop, Product, SelectedProduct, Cart, ProductReview
+
+
+CHUNK_SIZE = 2000
+
+# Lines rendered per thread hop, and sent as one chunk, by astream_export().
+ASYNC_BATCH_LINES = 500
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+# `columns` are (header, attribute path) pairs; `user_field` is the lookup
+# used to restrict the export to one user, if the export supports it.
+Export = namedtuple('Export', ['queryset', 'columns', 'user_field'])
+
+EXPORTS = {
+    'products': Export(
+        lambda: Product.objects.select_related('shop__classification'),
+        [
+            ('id', 'pk'), ('external_id', 'external_id'), ('shop_id', 'shop_id'),
+            ('shop', 'shop.name'), ('shop_external_id', 'shop.external_id'),
+            ('classification', 'shop.classification.slug'), ('name', 'name'), ('price', 'price'),
+            ('is_available', 'is_available'), ('rating_count', 'rating_count'),
+            ('rating_avg', 'rating_avg'), ('description', 'description'), ('image', 'image.name'),
+        ],
+        None,
+    ),
+    'shops': Export(
+        lambda: Shop.objects.select_related('classification'),
+        [
+            ('id', 'pk'), ('external_id', 'external_id'), ('name', 'name'),
+            ('classification', 'classification.slug'), ('phone', 'phone'), ('email', 'email'),
+            ('address', 'address'), ('description', 'description'), ('image', 'image.name'),
+        ],
+        None,
+    ),
+    'reviews': Export(
+        lambda: ProductReview.objects.select_related('product', 'user'),
+        [
+            ('id', 'pk'), ('product_id', 'product_id'), ('product', 'product.name'),
+            ('user_id', 'user_id'), ('username', 'user.username'), ('rating', 'rating'),
+            ('comment', 'comment'), ('created_at', 'created_at'),
+        ],
+        'user_id',
+    ),
+    'budget_lines': Export(
+        lambda: SelectedProduct.objects.select_related('budget', 'product', 'user').annotate(line_total=line_total()),
+        [
+            ('id', 'pk'), ('user_id', 'user_id'), ('username', 'user.username'),
+            ('budget_id', 'budget_id'), ('budget_total', 'budget.total'), ('product_id', 'product_id'),
+            ('product', 'product.name'), ('price', 'product.price'), ('quantity', 'quantity'),
+            ('line_total', 'line_total'),
+        ],
+        'user_id',
+    ),
+    'cart_lines': Export(
+        lambda: Cart.objects.select_related('product', 'user').annotate(line_total=line_total()),
+        [
+            ('id', 'pk'), ('user_id', 'user_id'), ('username', 'user.username'),
+            ('product_id', 'product_id'), ('product', 'product.name'), ('price', 'product.price'),
+            ('quantity', 'quantity'), ('line_total', 'line_total'), ('added_at', 'added_at'),
+        ],
+        'user_id',
+    ),
+}
+
+
+def resolve(obj, path):
+    for name in path.split('.'):
+        if obj is None:
+            return None
+        obj = getattr(obj, name)
+    return obj
+
+
+def export_rows(name, user_id=None, chunk_size=CHUNK_SIZE):
+    """Yield one list of column values per row of export `name`, in primary key order."""
+    export = EXPORTS[name]
+    queryset = export.queryset().order_by('pk')
+    if user_id is not None and export.user_field:
+        queryset = queryset.filter(**{export.user_field: user_id})
+    paths = [path for header, path in export.columns]
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        yield [resolve(obj, path) for path in paths]
+
+
+class Echo:
+    """A file-like object whose write() returns the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def render_csv(headers, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def render_jsonl(headers, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def stream_export(name, fmt='csv', user_id=None, chunk_size=CHUNK_SIZE):
+    """Yield export `name` as lines of CSV or JSONL text."""
+    headers = [header for header, path in EXPORTS[name].columns]
+    rows = export_rows(name, user_id=user_id, chunk_size=chunk_size)
+    render = render_csv if fmt == 'csv' else render_jsonl
+    return render(headers, rows)
+
+
+async def astream_export(name, fmt='csv', user_id=None, chunk_size=CHUNK_SIZE):
+    """stream_export() as an async iterator of chunks of ASYNC_BATCH_LINES lines."""
+    lines = stream_export(name, fmt, user_id=user_id, chunk_size=chunk_size)
+    # Thread-sensitive, so every batch reads the export's cursor on the same connection.
+    next_batch = sync_to_async(lambda: list(islice(lines, ASYNC_BATCH_LINES)), thread_sensitive=True)
+    try:
+        while batch := await next_batch():
+            yield ''.join(batch)
+    finally:
+        await sync_to_async(lines.close, thread_sensitive=True)()
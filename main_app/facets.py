@@ -0,0 +1,201 @@
+"""
+Faceted filtering for the classification and shop pages.
+
+Products can be narrowed by price range, availability, rating and shop,
+and every facet option shows how many products it would match. Counts
+follow the usual faceted-search rule: an option is counted with the
+filters of every *other* facet applied, so ticking a second price range
+does not zero the first one.
+
+Rather than one COUNT query per option, facet_cells() groups the page's
+products by (shop, price bucket, availability, rating bucket) in a single
+query. That table of cells is small (a few per shop) and is cached under
+the page's scope, 'classification:<id>' or 'shop:<id>', which product
+and review changes bump. facet_counts() then sums the cells for any
+combination of filters in Python, so filters cost no queries; only the
+filtered listing itself does.
+"""
+from collections import namedtuple
+from decimal import Decimal
+from urllib.parse import urlencode
+
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+
+# key -> (label, lowest price, price it stays under); None is unbounded.
+PRICE_BUCKETS = {
+    '0-10': ('Under 10 BHD', None, Decimal('10')),
+    '10-25': ('10–25 BHD', Decimal('10'), Decimal('25')),
+    '25-50': ('25–50 BHD', Decimal('25'), Decimal('50')),
+    '50-100': ('50–100 BHD', Decimal('50'), Decimal('100')),
+    '100-250': ('100–250 BHD', Decimal('100'), Decimal('250')),
+    '250-500': ('250–500 BHD', Decimal('250'), Decimal('500')),
+    '500-': ('500 BHD and over', Decimal('500'), None),
+}
+
+AVAILABILITY = {
+    'in_stock': ('In stock', True),
+    'out_of_stock': ('Out of stock', False),
+}
+
+# "N stars & up" on Product.rating_avg; unrated products are in none.
+RATING_THRESHOLDS = (4, 3, 2, 1)
+
+FACETS = ('price', 'availability', 'rating', 'shop')
+
+# Sorted tuples (and an int or None for rating), so filters can be part of a cache key.
+Filters = namedtuple('Filters', ['price', 'availability', 'rating', 'shop'])
+
+NO_FILTERS = Filters((), (), None, ())
+
+# `multiple` facets take any number of options, the others one; `active` if any is selected.
+Facet = namedtuple('Facet', ['name', 'label', 'options', 'multiple', 'active'])
+
+FacetOption = namedtuple('FacetOption', ['value', 'label', 'count', 'selected'])
+
+FacetCounts = namedtuple('FacetCounts', ['total', 'facets', 'shop_counts'])
+
+
+def parse_filters(params, facets=FACETS):
+    """The Filters in the query dict `params`, ignoring unknown values and facets not in `facets`."""
+    def chosen(name, valid):
+        if name not in facets:
+            return ()
+        return tuple(sorted({value for value in params.getlist(name) if value in valid}))
+
+    rating = params.get('rating') if 'rating' in facets else None
+    shops = set()
+    if 'shop' in facets:
+        for value in params.getlist('shop'):
+            try:
+                shops.add(int(value))
+            except ValueError:
+                pass
+    return Filters(
+        price=chosen('price', PRICE_BUCKETS),
+        availability=chosen('availability', AVAILABILITY),
+        rating=int(rating) if rating in {str(threshold) for threshold in RATING_THRESHOLDS} else None,
+        shop=tuple(sorted(shops)),
+    )
+
+
+def filter_params(filters):
+    """The (name, value) query parameters for `filters`."""
+    params = [(name, value) for name in ('price', 'availability') for value in getattr(filters, name)]
+    if filters.rating:
+        params.append(('rating', filters.rating))
+    params.extend(('shop', pk) for pk in filters.shop)
+    return params
+
+
+def filter_query(filters):
+    return urlencode(filter_params(filters))
+
+
+def product_filter(filters):
+    """Q matching the products that pass `filters`."""
+    condition = Q()
+    if filters.price:
+        prices = Q()
+        for key in filters.price:
+            label, low, high = PRICE_BUCKETS[key]
+            bucket = Q()
+            if low is not None:
+                bucket &= Q(price__gte=low)
+            if high is not None:
+                bucket &= Q(price__lt=high)
+            prices |= bucket
+        condition &= prices
+    if filters.availability:
+        condition &= Q(is_available__in=[AVAILABILITY[key][1] for key in filters.availability])
+    if filters.rating:
+        condition &= Q(rating_avg__gte=filters.rating)
+    if filters.shop:
+        condition &= Q(shop_id__in=filters.shop)
+    return condition
+
+
+def facet_cells(products):
+    """
+    Count `products` grouped by (shop id, shop name, price bucket,
+    is_available, rating bucket) in one query. The price bucket is a
+    PRICE_BUCKETS key, the rating bucket the highest RATING_THRESHOLDS met
+    (0 for none).
+    """
+    price_keys = list(PRICE_BUCKETS)
+    price_bucket = Case(
+        *[When(price__lt=high, then=Value(index))
+          for index, (label, low, high) in enumerate(PRICE_BUCKETS.values()) if high is not None],
+        default=Value(len(price_keys) - 1), output_field=IntegerField(),
+    )
+    rating_bucket = Case(
+        *[When(rating_avg__gte=threshold, then=Value(threshold)) for threshold in RATING_THRESHOLDS],
+        default=Value(0), output_field=IntegerField(),
+    )
+    rows = (
+        products.order_by()
+        .annotate(price_bucket=price_bucket, rating_bucket=rating_bucket)
+        .values_list('shop_id', 'shop__name', 'price_bucket', 'is_available', 'rating_bucket')
+        .annotate(count=Count('pk'))
+    )
+    return [(shop_id, shop_name, price_keys[price], available, rating, count)
+            for shop_id, shop_name, price, available, rating, count in rows]
+
+
+def facet_counts(cells, filters, facets=FACETS):
+    """
+    The FacetCounts of `cells` (from facet_cells) under `filters`: the
+    number of products passing every filter, the options of each facet in
+    `facets` with their counts, and {shop id: count} for the shop facet.
+    """
+    availability_keys = {available: key for key, (label, available) in AVAILABILITY.items()}
+    counts = {name: {} for name in FACETS}
+    shop_names = {}
+    total = 0
+    for shop_id, shop_name, price, available, rating, count in cells:
+        shop_names[shop_id] = shop_name
+        availability = availability_keys[available]
+        passes = {
+            'price': not filters.price or price in filters.price,
+            'availability': not filters.availability or availability in filters.availability,
+            'rating': not filters.rating or rating >= filters.rating,
+            'shop': not filters.shop or shop_id in filters.shop,
+        }
+        failed = [name for name, passed in passes.items() if not passed]
+        if not failed:
+            total += count
+            counted = FACETS
+        elif len(failed) == 1:
+            # Passing every other facet, the cell still counts towards this one's options.
+            counted = failed
+        else:
+            continue
+        values = {
+            'price': [price],
+            'availability': [availability],
+            'rating': [threshold for threshold in RATING_THRESHOLDS if rating >= threshold],
+            'shop': [shop_id],
+        }
+        for name in counted:
+            for value in values[name]:
+                counts[name][value] = counts[name].get(value, 0) + count
+
+    options = {
+        'price': [FacetOption(key, label, counts['price'].get(key, 0), key in filters.price)
+                  for key, (label, low, high) in PRICE_BUCKETS.items()],
+        'availability': [FacetOption(key, label, counts['availability'].get(key, 0), key in filters.availability)
+                         for key, (label, available) in AVAILABILITY.items()],
+        'rating': [FacetOption(threshold, f'{threshold}★ & up', counts['rating'].get(threshold, 0),
+                               threshold == filters.rating) for threshold in RATING_THRESHOLDS],
+        'shop': [FacetOption(pk, shop_names[pk], counts['shop'].get(pk, 0), pk in filters.shop)
+                 for pk in sorted(shop_names, key=lambda pk: (shop_names[pk], pk))],
+    }
+    labels = {'price': 'Price', 'availability': 'Availability', 'rating': 'Rating', 'shop': 'Shop'}
+    return FacetCounts(
+        total=total,
+        facets=[
+            Facet(name, labels[name], options[name], name != 'rating', any(option.selected for option in options[name]))
+            for name in FACETS if name in facets
+        ],
+        shop_counts=counts['shop'],
+    )
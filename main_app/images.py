@@ -0,0 +1,175 @@
+"""
+Resized derivatives of uploaded images.
+
+Every preset is rendered at 1x and 2x, as WebP and JPEG, under
+`variants/` by a background task queued when an image is saved. Paths
+are derived from the original file name alone, so templates can build
+`srcset` URLs without touching the database. Once every preset of an
+image is written, the task records the image's name in the model's
+`<field>_variants` column, and the template tags check that rather than
+asking the storage about each image on every render.
+"""
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .catalog_cache import bump_on_commit
+from .models import Product, Shop, UserProfile
+from .tasks import enqueue, register_task
+
+
+VARIANT_ROOT = 'variants'
+
+# name -> (width, height) of the 1x rendering; images are cropped to fill it.
+PRESETS = {
+    'card': (400, 250),
+    'thumb': (80, 80),
+    'avatar': (100, 100),
+}
+
+DENSITIES = (1, 2)
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# The 1x JPEG is written last: variant_exists() looks for it, so a preset
+# only counts as done once all of its files are in place.
+VARIANT_FILES = [
+    (density, fmt) for density in DENSITIES for fmt in FORMATS if (density, fmt) != (1, 'jpg')
+] + [(1, 'jpg')]
+
+# The image field and presets rendered for each model.
+MODEL_PRESETS = {
+    Product: ('image', ('card', 'thumb')),
+    Shop: ('image', ('card', 'thumb')),
+    UserProfile: ('profile_picture', ('avatar', 'thumb')),
+}
+
+
+def variant_name(original_name, preset, density=1, fmt='jpg'):
+    stem, _ = os.path.splitext(original_name)
+    suffix = '' if density == 1 else f'-{density}x'
+    return f'{VARIANT_ROOT}/{stem}/{preset}{suffix}.{fmt}'
+
+
+def variants_field(field_name):
+    """The column recording which upload of `field_name` has its variants written."""
+    return f'{field_name}_variants'
+
+
+def has_variants(fieldfile):
+    """Whether the variants of `fieldfile` are ready, as recorded on its instance; no storage call."""
+    recorded = getattr(fieldfile.instance, variants_field(fieldfile.field.name), None) if fieldfile else None
+    return bool(fieldfile) and recorded == fieldfile.name
+
+
+def variant_exists(fieldfile, preset):
+    return bool(fieldfile) and fieldfile.storage.exists(variant_name(fieldfile.name, preset))
+
+
+def render_variant(image, size, fmt):
+    pil_format, options = FORMATS[fmt]
+    resized = ImageOps.fit(image, size, method=Image.Resampling.LANCZOS)
+    if pil_format == 'JPEG' and resized.mode != 'RGB':
+        resized = resized.convert('RGB')
+    buffer = BytesIO()
+    resized.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def generate_variants(fieldfile, presets, force=False):
+    """
+    Write every density and format of `presets` for `fieldfile`.
+
+    Presets that already exist are skipped unless `force` is set. Returns
+    the number of files written; unreadable images write nothing.
+    """
+    if not fieldfile:
+        return 0
+    storage = fieldfile.storage
+    missing = [preset for preset in presets if force or not variant_exists(fieldfile, preset)]
+    if not missing:
+        return 0
+
+    try:
+        with storage.open(fieldfile.name, 'rb') as source:
+            image = Image.open(source)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (UnidentifiedImageError, OSError):
+        return 0
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    written = 0
+    for preset in missing:
+        width, height = PRESETS[preset]
+        for density, fmt in VARIANT_FILES:
+            name = variant_name(fieldfile.name, preset, density, fmt)
+            content = render_variant(image, (width * density, height * density), fmt)
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(content))
+            written += 1
+    return written
+
+
+def variant_scopes(instance):
+    """The catalog_cache scopes of the pages showing `instance`'s image."""
+    if isinstance(instance, Product):
+        classification_id = Shop.objects.filter(pk=instance.shop_id).values_list('classification_id', flat=True).first()
+        return [f'product:{instance.pk}', f'shop:{instance.shop_id}', f'classification:{classification_id}']
+    if isinstance(instance, Shop):
+        return [f'shop:{instance.pk}', f'classification:{instance.classification_id}']
+    return [f'user:{instance.user_id}']
+
+
+def generate_instance_variants(instance, force=False):
+    """
+    generate_variants() for a model instance, then record whether every
+    preset of its current image is in place. Returns the files written.
+    """
+    model = type(instance)
+    field_name, presets = MODEL_PRESETS[model]
+    fieldfile = getattr(instance, field_name)
+    written = generate_variants(fieldfile, presets, force=force)
+    ready = fieldfile.name if fieldfile and all(variant_exists(fieldfile, preset) for preset in presets) else ''
+    if getattr(instance, variants_field(field_name)) != ready:
+        # Only if the image has not been replaced meanwhile; update() so the save signals do not queue this again.
+        if model.objects.filter(pk=instance.pk, **{field_name: fieldfile.name}).update(
+            **{variants_field(field_name): ready}
+        ):
+            setattr(instance, variants_field(field_name), ready)
+            bump_on_commit(*variant_scopes(instance))
+    return written
+
+
+@register_task('images.generate_variants')
+def generate_variants_task(payload):
+    model = apps.get_model(payload['model'])
+    instance = model.objects.filter(pk=payload['pk']).first()
+    if instance is not None:
+        generate_instance_variants(instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=UserProfile)
+def queue_image_variants(sender, instance, raw=False, **kwargs):
+    field_name, presets = MODEL_PRESETS[sender]
+    fieldfile = getattr(instance, field_name)
+    if raw or not fieldfile:
+        return
+    # Keyed on the file name, so re-saving the same upload queues nothing new.
+    enqueue(
+        'images.generate_variants',
+        {'model': sender._meta.label_lower, 'pk': instance.pk},
+        key=f'variants:{sender._meta.label_lower}:{instance.pk}:{fieldfile.name}',
+    )
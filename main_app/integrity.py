@@ -0,0 +1,260 @@
+"""
+Data-integrity scanning for the main_app tables.
+
+Every DecimalField, ForeignKey and `quantity` column of every main_app
+model gets a set of checks (build_checks). A check is a SQL predicate
+over the table, so finding bad rows is an indexed range scan per chunk
+and fixing them is one UPDATE ... WHERE <predicate>. Where SQL cannot
+decide, as for text stored in a SQLite decimal column, the predicate only
+narrows the candidates and a Python validator reads them with
+iterator(chunk_size).
+
+scan() walks each table in primary-key chunks of `chunk_size` rows and
+records its progress in a JSON checkpoint file per table after every
+chunk, so an interrupted scan resumes where it stopped, as long as it
+is run with the same --fix. Tables are
+scanned in parallel worker processes, one table per process.
+"""
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.apps import apps
+from django.db import close_old_connections, connection, connections, models, transaction
+from django.db.models import BooleanField, TextField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+
+CHUNK_SIZE = 10_000
+
+# Bad rows listed per check in the report; the rest are only counted.
+SAMPLE_SIZE = 5
+
+# `predicate` is SQL over the table; `fix` is the SQL expression the
+# field's column is set to, DELETE to delete the rows, or None to only
+# report them. With a `validate` callable, the predicate only narrows the
+# rows and validate(value as text) decides which are bad.
+Check = namedtuple('Check', ['name', 'field', 'predicate', 'fix', 'validate'])
+
+DELETE = 'DELETE'
+
+
+def is_decimal(raw):
+    try:
+        return Decimal(raw).is_finite()
+    except (InvalidOperation, TypeError, ValueError):
+        return False
+
+
+def decimal_checks(field, column, vendor):
+    # Every decimal here is an amount of money, never negative.
+    if vendor == 'sqlite':
+        # SQLite keeps whatever it is given; numbers come back as integer or real.
+        numeric = f"typeof({column}) IN ('integer', 'real')"
+        yield Check(f'{field.name}.not_a_number', field, f"typeof({column}) IN ('text', 'blob')",
+                    'NULL' if field.null else '0', is_decimal)
+    else:
+        numeric = f'{column} IS NOT NULL'
+    limit = 10 ** (field.max_digits - field.decimal_places)
+    yield Check(f'{field.name}.negative', field, f'{numeric} AND {column} < 0', '0', None)
+    yield Check(f'{field.name}.too_precise', field,
+                f'{numeric} AND {column} <> ROUND({column}, {field.decimal_places})',
+                f'ROUND({column}, {field.decimal_places})', None)
+    yield Check(f'{field.name}.too_large', field, f'{numeric} AND ABS({column}) >= {limit}', None, None)
+
+
+def foreign_key_checks(field, column, vendor):
+    qn = connection.ops.quote_name
+    target = field.related_model._meta
+    target_column = target.get_field(field.target_field.name).column
+    predicate = (
+        f'{column} IS NOT NULL AND NOT EXISTS ('
+        f'SELECT 1 FROM {qn(target.db_table)} WHERE {qn(target.db_table)}.{qn(target_column)} = {column})'
+    )
+    yield Check(f'{field.name}.orphaned', field, predicate, 'NULL' if field.null else DELETE, None)
+
+
+def quantity_checks(field, column, vendor):
+    # A line of zero items should have been removed; keep it as one.
+    yield Check(f'{field.name}.below_one', field, f'{column} < 1', '1', None)
+
+
+def build_checks(model, vendor=None):
+    """The checks for `model`, value checks before the foreign-key checks that may delete rows."""
+    vendor = vendor or connection.vendor
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    value_checks, key_checks = [], []
+    for field in model._meta.concrete_fields:
+        column = f'{table}.{qn(field.column)}'
+        if isinstance(field, models.DecimalField):
+            value_checks.extend(decimal_checks(field, column, vendor))
+        elif isinstance(field, models.ForeignKey):
+            key_checks.extend(foreign_key_checks(field, column, vendor))
+        elif field.name == 'quantity':
+            value_checks.extend(quantity_checks(field, column, vendor))
+    return value_checks + key_checks
+
+
+def scanned_models():
+    return [model for model in apps.get_app_config('main_app').get_models() if build_checks(model)]
+
+
+class Checkpoint:
+    """
+    Progress of one table's scan, kept in `<directory>/<table>.json`.
+
+    Progress saved by a run with a different `fix` is discarded: a fixing
+    run must not skip the chunks a report-only run covered, nor report
+    their findings as its own.
+    """
+
+    def __init__(self, directory, table, fix=False):
+        self.path = os.path.join(directory, f'{table}.json')
+        self.state = {'fix': fix, 'last_pk': None, 'done': False, 'found': {}, 'fixed': {}, 'samples': {},
+                      'rewritten': []}
+        if os.path.exists(self.path):
+            with open(self.path) as handle:
+                saved = json.load(handle)
+            if saved.get('fix') == fix:
+                self.state.update(saved)
+
+    def record(self, check, found, fixed, samples, rewritten):
+        self.state['found'][check] = self.state['found'].get(check, 0) + found
+        self.state['fixed'][check] = self.state['fixed'].get(check, 0) + fixed
+        kept = self.state['samples'].setdefault(check, [])
+        kept.extend(samples[:SAMPLE_SIZE - len(kept)])
+        self.state['rewritten'].extend(rewritten)
+
+    def save(self):
+        # Write and rename, so a crash never leaves a half-written file.
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as handle:
+            json.dump(self.state, handle)
+        os.replace(temporary, self.path)
+
+
+def chunk_end(model, last_pk, chunk_size):
+    """The primary key closing the chunk after `last_pk`, or None when the table is done."""
+    rows = model._base_manager.order_by('pk').values_list('pk', flat=True)
+    if last_pk is not None:
+        rows = rows.filter(pk__gt=last_pk)
+    ends = list(rows[chunk_size - 1:chunk_size])
+    return ends[0] if ends else rows.order_by('-pk').first()
+
+
+def in_chunk(model, last_pk, end, predicate):
+    rows = model._base_manager.filter(pk__lte=end).filter(RawSQL(predicate, [], output_field=BooleanField()))
+    return rows.filter(pk__gt=last_pk) if last_pk is not None else rows
+
+
+def run_check(model, check, last_pk, end, fix, chunk_size):
+    """
+    Find, and with `fix` repair, the rows of one chunk failing `check`.
+    Returns (found, fixed, sample pks, pks rewritten by UPDATE). Rewritten
+    rows bypass the model signals; deleted ones go through the ORM.
+    """
+    rows = in_chunk(model, last_pk, end, check.predicate)
+    if check.validate:
+        candidates = rows.annotate(raw=Cast(check.field.name, TextField())).values_list('pk', 'raw')
+        bad = [pk for pk, raw in candidates.order_by('pk').iterator(chunk_size=chunk_size)
+               if not check.validate(raw)]
+    else:
+        bad = list(rows.order_by('pk').values_list('pk', flat=True))
+    if not bad or not fix or check.fix is None:
+        return len(bad), 0, bad[:SAMPLE_SIZE], []
+
+    qn = connection.ops.quote_name
+    table, column, pk_column = qn(model._meta.db_table), qn(check.field.column), qn(model._meta.pk.column)
+    fixed = 0
+    with transaction.atomic():
+        if check.fix == DELETE:
+            # Through the ORM, so rows that depend on these are removed too.
+            fixed = model._base_manager.filter(pk__in=bad).delete()[1].get(model._meta.label, 0)
+        elif check.validate:
+            with connection.cursor() as cursor:
+                for start in range(0, len(bad), 500):
+                    batch = bad[start:start + 500]
+                    cursor.execute(
+                        f'UPDATE {table} SET {column} = {check.fix} '
+                        f'WHERE {pk_column} IN ({", ".join(["%s"] * len(batch))})', batch
+                    )
+                    fixed += cursor.rowcount
+        else:
+            bounds = [end] if last_pk is None else [last_pk, end]
+            lower = '' if last_pk is None else f'{table}.{pk_column} > %s AND '
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET {column} = {check.fix} '
+                    f'WHERE {lower}{table}.{pk_column} <= %s AND ({check.predicate})', bounds
+                )
+                fixed = cursor.rowcount
+    return len(bad), fixed, bad[:SAMPLE_SIZE], [] if check.fix == DELETE else bad
+
+
+def scan_table(label, checkpoint_dir, fix=False, chunk_size=CHUNK_SIZE):
+    """Scan one model's table from its checkpoint to the end; returns the checkpoint state."""
+    model = apps.get_model(label)
+    checks = build_checks(model)
+    checkpoint = Checkpoint(checkpoint_dir, model._meta.db_table, fix)
+    while not checkpoint.state['done']:
+        last_pk = checkpoint.state['last_pk']
+        end = chunk_end(model, last_pk, chunk_size)
+        if end is None:
+            checkpoint.state['done'] = True
+        else:
+            for check in checks:
+                checkpoint.record(check.name, *run_check(model, check, last_pk, end, fix, chunk_size))
+            checkpoint.state['last_pk'] = end
+        checkpoint.save()
+    return checkpoint.state
+
+
+def scan_table_in_pool(*args):
+    """scan_table() for worker processes, which manage their own connections."""
+    close_old_connections()
+    try:
+        return scan_table(*args)
+    finally:
+        close_old_connections()
+
+
+def scan(labels=None, checkpoint_dir='.integrity-scan', fix=False, chunk_size=CHUNK_SIZE, workers=4,
+         restart=False, log=None):
+    """
+    Scan the tables of `labels` (every checked main_app model by default)
+    and return {label: checkpoint state}. Checkpoints are kept in
+    `checkpoint_dir` and removed once every table is done; with
+    `restart`, existing ones are discarded first.
+    """
+    labels = labels or [model._meta.label for model in scanned_models()]
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    if restart:
+        for name in os.listdir(checkpoint_dir):
+            if name.endswith('.json'):
+                os.remove(os.path.join(checkpoint_dir, name))
+
+    results = {}
+    if workers <= 1:
+        for label in labels:
+            results[label] = scan_table(label, checkpoint_dir, fix, chunk_size)
+            if log:
+                log(label, results[label])
+    else:
+        # Forked workers must not share the parent's database connections.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {label: executor.submit(scan_table_in_pool, label, checkpoint_dir, fix, chunk_size) for label in labels}
+            for label, future in futures.items():
+                results[label] = future.result()
+                if log:
+                    log(label, results[label])
+
+    for label in labels:
+        os.remove(Checkpoint(checkpoint_dir, apps.get_model(label)._meta.db_table).path)
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+    return results
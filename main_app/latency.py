@@ -0,0 +1,25 @@
+"""
+Simulated database latency.
+
+With SIMULATED_DB_LATENCY_MS set, every query sleeps that long before it
+runs, on every connection opened afterwards. It stands in for a remote or
+overloaded database when benchmarking how many requests a server keeps in
+flight (`manage.py benchmark --db-latency-ms`, or the environment variable
+of the same name for a real server). Never set it in production.
+"""
+import time
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def sleep_before_query(execute, sql, params, many, context):
+    time.sleep(settings.SIMULATED_DB_LATENCY_MS / 1000)
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def add_simulated_latency(sender, connection, **kwargs):
+    if settings.SIMULATED_DB_LATENCY_MS and sleep_before_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sleep_before_query)
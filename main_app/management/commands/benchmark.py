@@ -0,0 +1,63 @@
+from urllib.error import URLError
+
+from django.core.management.base import BaseCommand, CommandError
+from main_app.benchmark import compare, load, run_benchmark, save
+
+class Command(BaseCommand):
+    help = 'Benchmark every read page in main_app/urls.py and report latency percentiles and query counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Measured requests per page (default: 50)')
+        parser.add_argument('--warmup', type=int, default=5,
+                            help='Unmeasured requests per page first (default: 5)')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Parallel requests per page; only with --asgi or --base-url')
+        parser.add_argument('--base-url',
+                            help='Benchmark a running server (e.g. http://127.0.0.1:8000) instead of the test client')
+        parser.add_argument('--asgi', action='store_true',
+                            help='Serve the requests in-process through the ASGI application instead of the test client')
+        parser.add_argument('--db-latency-ms', type=float,
+                            help='Delay every query by this many milliseconds (in-process runs only; set '
+                                 'SIMULATED_DB_LATENCY_MS on the server for --base-url)')
+        parser.add_argument('--user', help='Username to browse as (default: the user with the largest cart)')
+        parser.add_argument('--route', action='append', dest='routes',
+                            help='Only benchmark this URL name (may be repeated)')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a previous JSON results file')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 slowdown against the baseline, as a fraction (default: 0.2)')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error when the baseline comparison finds regressions')
+
+    def handle(self, *args, **options):
+        if options['base_url'] and options['db_latency_ms'] is not None:
+            raise CommandError('--db-latency-ms only applies in-process; start the server with SIMULATED_DB_LATENCY_MS instead')
+        try:
+            results = run_benchmark(
+                requests=options['requests'],
+                warmup=options['warmup'],
+                concurrency=options['concurrency'],
+                base_url=options['base_url'],
+                username=options['user'],
+                only=options['routes'],
+                log=self.stdout.write,
+                asgi=options['asgi'],
+                db_latency_ms=options['db_latency_ms'],
+            )
+        except URLError as error:
+            raise CommandError(f"Could not reach {options['base_url']}: {error.reason}")
+        if results['meta']['skipped']:
+            self.stdout.write(f"Skipped: {', '.join(results['meta']['skipped'])}")
+        if options['output']:
+            save(results, options['output'])
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            regressions = compare(results, load(options['baseline']), tolerance=options['tolerance'])
+            for line in regressions:
+                self.stdout.write(self.style.WARNING(f'Regression: {line}'))
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            if not regressions:
+                self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from main_app.exports import CHUNK_SIZE, EXPORTS, FORMATS, stream_export
+
+class Command(BaseCommand):
+    help = 'Stream products, shops, reviews, budget lines or cart lines as CSV or JSONL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(EXPORTS), help='What to export')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv',
+                            help='Output format (default: csv)')
+        parser.add_argument('--output', help='Write to this file instead of standard output')
+        parser.add_argument('--user', type=int, help='Only this user id (reviews, budget and cart lines)')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help=f'Rows fetched per database round trip (default: {CHUNK_SIZE})')
+
+    def handle(self, *args, **options):
+        lines = stream_export(options['name'], options['format'], user_id=options['user'],
+                              chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as handle:
+                handle.writelines(lines)
+            self.stderr.write(self.style.SUCCESS(f"Exported {options['name']} to {options['output']}"))
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from main_app.synthetic import DEFAULTS, generate
+
+class Command(BaseCommand):
+    help = 'Bulk-create a skewed synthetic data set (catalog, users, carts, budgets, wishlists, reviews)'
+
+    def add_arguments(self, parser):
+        for name, default in DEFAULTS.items():
+            per_user = name in ('cart_items', 'wishlist_items', 'budget_items', 'reviews')
+            parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=default, dest=name,
+                                help=f"{'Mean rows per user' if per_user else 'Rows to create'} (default: {default})")
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='Multiply the classification, shop, product and user counts')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per bulk_create statement (default: 5000)')
+        parser.add_argument('--seed', type=int, help='Random seed, for reproducible data sets')
+
+    def handle(self, *args, **options):
+        sizes = {name: options[name] for name in DEFAULTS}
+        for name in ('classifications', 'shops', 'products', 'users'):
+            sizes[name] = max(1, int(sizes[name] * options['scale']))
+
+        started = time.perf_counter()
+        counts = generate(sizes, batch_size=options['batch_size'], seed=options['seed'], log=self.stdout.write)
+        total = sum(counts.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {total} rows in {time.perf_counter() - started:.1f}s'
+        ))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from main_app.images import MODEL_PRESETS, generate_instance_variants
+
+class Command(BaseCommand):
+    help = 'Generate resized WebP/JPEG variants for every uploaded product, shop and profile image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate variants that already exist')
+
+    def handle(self, *args, **options):
+        total = 0
+        for model, (field_name, presets) in MODEL_PRESETS.items():
+            queryset = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+            # Variants already written are not redrawn, only recorded as ready.
+            for instance in queryset.iterator(chunk_size=500):
+                total += generate_instance_variants(instance, force=options['force'])
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {total} image variants'))
@@ -0,0 +1,41 @@
+import csv
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from main_app.catalog_import import BATCH_SIZE, IMPORTERS, import_file
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or JSONL file of shops or products into the catalog, upserting on external_id'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL (.jsonl/.ndjson) file to import')
+        parser.add_argument('--kind', choices=sorted(IMPORTERS), required=True,
+                            help='What the file contains')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format (default: from the file extension)')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help=f'Rows per upsert (default: {BATCH_SIZE})')
+        parser.add_argument('--rejects', help='Write rejected rows (line, reason) to this CSV file')
+
+    def handle(self, *args, **options):
+        with ExitStack() as stack:
+            on_reject = None
+            if options['rejects']:
+                writer = csv.writer(stack.enter_context(open(options['rejects'], 'w', newline='')))
+                writer.writerow(['line', 'reason'])
+                on_reject = writer.writerow
+            try:
+                result = import_file(
+                    options['path'], options['kind'], fmt=options['format'],
+                    batch_size=options['batch_size'], log=self.stdout.write, on_reject=on_reject,
+                )
+            except OSError as error:
+                raise CommandError(f"Could not read {options['path']}: {error}")
+
+        if not options['rejects']:
+            for reject in result.rejects[:20]:
+                self.stdout.write(self.style.WARNING(f'Line {reject.line}: {reject.reason}'))
+            if result.rejected > 20:
+                self.stdout.write(self.style.WARNING(f'... and {result.rejected - 20} more (use --rejects)'))
+
+        self.stdout.write(self.style.SUCCESS(f'Imported {result}'))
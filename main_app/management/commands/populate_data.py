@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
-from main_app.models import Classification, Shop, Product, BudgetEstimate
+from main_app.models import Classification, Shop, Product, ClassificationPriceStats, ShopPriceStats
+from main_app.price_stats import refresh_price_stats
 
 class Command(BaseCommand):
     help = 'Populate the database with sample data'
@@ -93,27 +94,10 @@ class Command(BaseCommand):
             if created:
                 self.stdout.write(f'Created product: {product.name}')
 
-        # Create Budget Estimates
-        estimates_data = [
-            {'classification': 'Furniture', 'min_price': 500.00, 'max_price': 3000.00, 'average_price': 1500.00},
-            {'classification': 'Tiles', 'min_price': 200.00, 'max_price': 1500.00, 'average_price': 800.00},
-            {'classification': 'Paints', 'min_price': 100.00, 'max_price': 800.00, 'average_price': 400.00},
-            {'classification': 'Lighting & Fixtures', 'min_price': 150.00, 'max_price': 1200.00, 'average_price': 600.00},
-            {'classification': 'Curtains & Carpets', 'min_price': 100.00, 'max_price': 1000.00, 'average_price': 500.00},
-        ]
-
-        for data in estimates_data:
-            classification = Classification.objects.get(name=data['classification'])
-            estimate, created = BudgetEstimate.objects.get_or_create(
-                classification=classification,
-                defaults={
-                    'min_price': data['min_price'],
-                    'max_price': data['max_price'],
-                    'average_price': data['average_price']
-                }
-            )
-            if created:
-                self.stdout.write(f'Created budget estimate for: {classification.name}')
+        # Price statistics per classification and shop, for the budget hints
+        shops = refresh_price_stats(ShopPriceStats)
+        classifications = refresh_price_stats(ClassificationPriceStats)
+        self.stdout.write(f'Computed price statistics for {classifications} classifications and {shops} shops')
 
         self.stdout.write(
             self.style.SUCCESS('Successfully populated database with sample data!')
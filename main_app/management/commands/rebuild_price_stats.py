@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main_app.models import ClassificationPriceStats, ShopPriceStats
+from main_app.price_stats import refresh_price_stats
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-classification and per-shop price statistics from the product table'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            shops = refresh_price_stats(ShopPriceStats)
+            classifications = refresh_price_stats(ClassificationPriceStats)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt price statistics ({classifications} classifications, {shops} shops)')
+        )
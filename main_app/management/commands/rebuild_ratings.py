@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main_app.models import Product, rebuild_product_ratings
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized product rating aggregates from the reviews table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, action='append', dest='products',
+                            help='Only rebuild this product id (may be repeated)')
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options['products']:
+            products = products.filter(pk__in=options['products'])
+
+        with transaction.atomic():
+            updated = rebuild_product_ratings(products)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt rating aggregates ({updated} products changed)')
+        )
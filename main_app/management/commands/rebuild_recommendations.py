@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from main_app.recommendations import refresh_neighbors
+
+class Command(BaseCommand):
+    help = 'Rebuild every product\'s "frequently planned together" neighbours from wishlists, carts and budgets'
+
+    def handle(self, *args, **options):
+        rows = refresh_neighbors()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt recommendations ({rows} neighbour rows)'))
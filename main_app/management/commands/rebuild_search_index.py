@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main_app.search import create_index, rebuild_index
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index over products, shops and classifications'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            create_index()
+            rebuild_index()
+
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from main_app.similarity import refresh_similar
+
+class Command(BaseCommand):
+    help = 'Rebuild the product vectors and every product\'s similar-products list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--changed', action='store_true',
+                            help='Only refresh products changed since the last run, as the background task does')
+
+    def handle(self, *args, **options):
+        products = refresh_similar(full=not options['changed'])
+        self.stdout.write(self.style.SUCCESS(f'Refreshed similar products for {products} products'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from main_app.tasks import run_worker
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks (image variants and other post-save work)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Number of tasks to run at once (default: 4)')
+        parser.add_argument('--processes', action='store_true',
+                            help='Use a process pool instead of threads, for CPU-heavy tasks')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait between polls when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no due tasks are left instead of polling forever')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Worker started with {options['concurrency']} "
+                          f"{'processes' if options['processes'] else 'threads'}")
+        completed = run_worker(
+            concurrency=options['concurrency'],
+            use_processes=options['processes'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Worker stopped after {completed} tasks'))
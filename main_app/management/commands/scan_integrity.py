@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from main_app import similarity
+from main_app.catalog_cache import bump
+from main_app.integrity import CHUNK_SIZE, scan, scanned_models
+from main_app.models import ClassificationPriceStats, Product, Shop, ShopPriceStats
+from main_app.price_stats import refresh_price_stats
+
+class Command(BaseCommand):
+    help = ('Check every decimal, foreign key and quantity column of the main_app tables '
+            'for bad values, and with --fix repair them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Repair the bad values instead of only reporting them')
+        parser.add_argument('--model', action='append', dest='models',
+                            help='Only scan this model, e.g. Product (may be repeated)')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Tables scanned at once, each in its own process (default: 4)')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help=f'Rows checked per chunk between checkpoints (default: {CHUNK_SIZE})')
+        parser.add_argument('--checkpoint-dir', default='.integrity-scan',
+                            help='Where progress is saved for resuming (default: .integrity-scan)')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore saved progress and scan from the start')
+
+    def handle(self, *args, **options):
+        checked = {model._meta.model_name: model._meta.label for model in scanned_models()}
+        labels = None
+        if options['models']:
+            unknown = [name for name in options['models'] if name.lower() not in checked]
+            if unknown:
+                raise CommandError(f"No checks for {', '.join(unknown)}; choose from {', '.join(sorted(checked))}")
+            labels = [checked[name.lower()] for name in options['models']]
+
+        results = scan(labels, checkpoint_dir=options['checkpoint_dir'], fix=options['fix'],
+                       chunk_size=options['chunk_size'], workers=options['workers'],
+                       restart=options['restart'], log=self.report)
+
+        found = sum(sum(state['found'].values()) for state in results.values())
+        fixed = sum(sum(state['fixed'].values()) for state in results.values())
+        if 'main_app.Product' in results and sum(results['main_app.Product']['fixed'].values()):
+            refresh_price_stats(ShopPriceStats)
+            refresh_price_stats(ClassificationPriceStats)
+        self.refresh_rewritten(results)
+        style = self.style.SUCCESS if not found or fixed == found else self.style.WARNING
+        self.stdout.write(style(f'Scanned {len(results)} tables: {found} bad values found, {fixed} fixed'))
+
+    def refresh_rewritten(self, results):
+        # Rows fixed by UPDATE went behind the model signals: bump their
+        # pages and mark them changed for the similarity index.
+        product_ids = set(results.get('main_app.Product', {}).get('rewritten', []))
+        shop_ids = set(results.get('main_app.Shop', {}).get('rewritten', []))
+        if not product_ids and not shop_ids:
+            return
+        products = Product.objects.filter(pk__in=product_ids)
+        shops = Shop.objects.filter(pk__in=shop_ids | set(products.values_list('shop_id', flat=True)))
+        products.update(updated_at=timezone.now())
+        Shop.objects.filter(pk__in=shop_ids).update(updated_at=timezone.now())
+        bump(*{f'product:{pk}' for pk in product_ids},
+             *{f'shop:{pk}' for pk in shops.values_list('pk', flat=True)},
+             *{f'classification:{pk}' for pk in shops.values_list('classification_id', flat=True)})
+        similarity.schedule_refresh()
+
+    def report(self, label, state):
+        bad = {check: count for check, count in state['found'].items() if count}
+        if not bad:
+            self.stdout.write(f'{label}: ok')
+            return
+        for check, count in sorted(bad.items()):
+            samples = ', '.join(str(pk) for pk in state['samples'].get(check, []))
+            self.stdout.write(f"{label} {check}: {count} found, {state['fixed'].get(check, 0)} fixed (ids {samples})")
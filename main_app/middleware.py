@@ -0,0 +1,212 @@
+"""
+Per-request query and timing instrumentation.
+
+QueryInstrumentationMiddleware records every SQL statement a request
+runs (through an execute wrapper on every connection, so it works with
+DEBUG off),
+plus template and total time. It reports them in a `Server-Timing`
+header and logs two kinds of offenders:
+
+* duplicates: the same SQL with the same parameters run more than once;
+* N+1 patterns: the same SQL run N_PLUS_ONE_THRESHOLD or more times with
+  different parameters, typically a lazy foreign-key load inside a loop.
+
+The profile is attached to the response as `response.query_profile`, which
+is what main_app.testing.QueryBudgetMixin asserts against.
+
+The middleware here is async-capable, as are Django's own, so under ASGI
+the whole stack runs on the event loop without being adapted to sync.
+StaticFilesMiddleware does the same for WhiteNoise.
+"""
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.base import Template
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+logger = logging.getLogger('main_app.queries')
+
+N_PLUS_ONE_THRESHOLD = getattr(settings, 'QUERY_N_PLUS_ONE_THRESHOLD', 3)
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.queries = []
+        self.template_time = 0.0
+        self.total_time = 0.0
+        self.template_depth = 0
+
+    def record(self, sql, params, duration):
+        self.queries.append((sql, repr(params), duration))
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+    @property
+    def db_time(self):
+        return sum(duration for sql, params, duration in self.queries)
+
+    def duplicates(self):
+        """{sql: count} for statements repeated with identical parameters."""
+        counts = Counter((sql, params) for sql, params, duration in self.queries)
+        repeated = Counter()
+        for (sql, params), count in counts.items():
+            if count > 1:
+                repeated[sql] += count
+        return dict(repeated)
+
+    def n_plus_one(self, threshold=None):
+        """{sql: count} for statements run `threshold`+ times with differing parameters."""
+        threshold = threshold or N_PLUS_ONE_THRESHOLD
+        by_sql = {}
+        for sql, params, duration in self.queries:
+            by_sql.setdefault(sql, set()).add(params)
+        counts = Counter(sql for sql, params, duration in self.queries)
+        return {
+            sql: counts[sql] for sql, param_sets in by_sql.items()
+            if counts[sql] >= threshold and len(param_sets) > 1
+        }
+
+    def server_timing(self):
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.query_count} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'total;dur={self.total_time * 1000:.1f}',
+        ])
+
+
+def _install_template_timer():
+    """Time top-level Template.render calls made while a profile is active."""
+    if getattr(Template.render, 'profiled', False):
+        return
+    original_render = Template.render
+
+    def render(self, context):
+        profile = current_profile.get()
+        if profile is None:
+            return original_render(self, context)
+        # Included templates render inside their parent; only the outermost
+        # render is timed so nothing is counted twice.
+        outermost = not profile.template_depth
+        profile.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return original_render(self, context)
+        finally:
+            profile.template_depth -= 1
+            if outermost:
+                profile.template_time += time.perf_counter() - started
+
+    render.profiled = True
+    Template.render = render
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper timing each query into the current request's profile, if any."""
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.record(sql, params, time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def add_query_recorder(sender, connection, **kwargs):
+    # Installed on every connection rather than per request: under ASGI the
+    # queries of an async view run on connections of other threads, which
+    # the profile reaches through the context variable.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class QueryInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        _install_template_timer()
+        # Connections opened before this module was loaded.
+        for connection in connections.all(initialized_only=True):
+            add_query_recorder(None, connection)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.total_time = time.perf_counter() - started
+            current_profile.reset(token)
+        return self.finish(request, response, profile)
+
+    async def __acall__(self, request):
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profile.total_time = time.perf_counter() - started
+            current_profile.reset(token)
+        return self.finish(request, response, profile)
+
+    def finish(self, request, response, profile):
+        response['Server-Timing'] = profile.server_timing()
+        response.query_profile = profile
+        self.report(request, profile)
+        return response
+
+    def report(self, request, profile):
+        for sql, count in profile.n_plus_one().items():
+            logger.warning("N+1 on %s %s: %d x %s", request.method, request.path, count, sql)
+        for sql, count in profile.duplicates().items():
+            logger.info("Duplicate query on %s %s: %d x %s", request.method, request.path, count, sql)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise's middleware, made async-capable so it does not push the ASGI stack into a thread."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            # Looks the file up on disk.
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
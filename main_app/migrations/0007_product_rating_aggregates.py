@@ -0,0 +1,64 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:02
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+
+
+def populate_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('main_app', 'Product')
+    aggregates = {
+        'rating_count': Count('reviews'),
+        'rating_sum': Coalesce(Sum('reviews__rating'), 0),
+    }
+    for stars in range(1, 6):
+        aggregates[f'rating_{stars}'] = Count('reviews', filter=Q(reviews__rating=stars))
+    rows = Product.objects.filter(reviews__isnull=False).order_by().values('pk').annotate(**aggregates)
+    for row in rows.iterator(chunk_size=2000):
+        Product.objects.filter(pk=row.pop('pk')).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0006_remove_userprofile_address_remove_userprofile_phone_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_rating_aggregates, migrations.RunPython.noop),
+    ]
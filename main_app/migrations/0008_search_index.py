@@ -0,0 +1,66 @@
+from django.db import migrations
+
+
+# The search index as it was when this migration was written. The SQL is
+# kept here rather than imported from main_app.search, so later changes
+# to that module cannot change what replaying this migration does.
+# Rows are keyed by object id * 4 + kind code (product 1, shop 2,
+# classification 3).
+DOCUMENTS = [
+    ('product', 1, 'main_app_product', 'name', "COALESCE(description, '')"),
+    ('shop', 2, 'main_app_shop', 'name', "COALESCE(description, '')"),
+    ('classification', 3, 'main_app_classification', 'name', "''"),
+]
+
+CREATE = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS main_app_searchindex USING fts5("
+        "kind UNINDEXED, object_id UNINDEXED, title, body, "
+        "tokenize = 'porter unicode61')",
+    ],
+    'postgresql': [
+        "CREATE TABLE IF NOT EXISTS main_app_searchindex ("
+        "id bigint PRIMARY KEY, "
+        "kind varchar(20) NOT NULL, "
+        "object_id bigint NOT NULL, "
+        "title text NOT NULL, "
+        "body text NOT NULL, "
+        "document tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', title), 'A') || "
+        "setweight(to_tsvector('english', body), 'B')"
+        ") STORED)",
+        "CREATE INDEX IF NOT EXISTS main_app_searchindex_document_gin ON main_app_searchindex USING GIN (document)",
+    ],
+}
+
+KEY_COLUMN = {'sqlite': 'rowid', 'postgresql': 'id'}
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in CREATE:
+        return
+    for sql in CREATE[vendor]:
+        schema_editor.execute(sql)
+    for kind, code, table, title, body in DOCUMENTS:
+        schema_editor.execute(
+            f"INSERT INTO main_app_searchindex ({KEY_COLUMN[vendor]}, kind, object_id, title, body) "
+            f"SELECT id * 4 + {code}, %s, id, {title}, {body} FROM {table}",
+            [kind],
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in CREATE:
+        schema_editor.execute("DROP TABLE IF EXISTS main_app_searchindex")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0007_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
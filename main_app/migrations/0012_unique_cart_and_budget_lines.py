@@ -0,0 +1,40 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:23
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    """Fold repeated (owner, product) lines into the oldest one, summing quantities."""
+    for model_name, owner in [('Cart', 'user'), ('SelectedProduct', 'budget')]:
+        model = apps.get_model('main_app', model_name)
+        duplicates = (
+            model.objects.values(owner, 'product')
+            .annotate(lines=Count('id'), keep=Min('id'), quantity=Sum('quantity'))
+            .filter(lines__gt=1)
+        )
+        for row in duplicates.iterator():
+            lines = model.objects.filter(**{owner: row[owner], 'product': row['product']})
+            lines.exclude(pk=row['keep']).delete()
+            lines.filter(pk=row['keep']).update(quantity=row['quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0011_catalog_external_ids'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='cart_user_product_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='selectedproduct',
+            constraint=models.UniqueConstraint(fields=('budget', 'product'), name='selectedproduct_budget_product_uniq'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:50
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0013_catalog_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['shop', 'is_available', 'price'], name='product_shop_available_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', '-created_at'], name='review_product_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['user', '-created_at'], name='review_user_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='selectedproduct',
+            index=models.Index(fields=['budget', 'user', 'product'], name='selected_budget_user_idx'),
+        ),
+    ]
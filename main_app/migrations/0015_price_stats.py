@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0014_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassificationPriceStats',
+            fields=[
+                ('product_count', models.PositiveIntegerField(default=0)),
+                ('min_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('max_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('mean_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('median_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('p10_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('p90_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+                ('classification', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='price_stats', serialize=False, to='main_app.classification')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ShopPriceStats',
+            fields=[
+                ('product_count', models.PositiveIntegerField(default=0)),
+                ('min_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('max_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('mean_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('median_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('p10_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('p90_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+                ('shop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='price_stats', serialize=False, to='main_app.shop')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
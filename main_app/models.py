@@ -1,7 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.utils.text import slugify
-from django.db.models.signals import post_save
+from django.db.models import Count, F, FloatField, Q, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -12,6 +15,7 @@ class Classification(models.Model):
     icon = models.CharField(max_length=10, blank=True, null=True)  
     description = models.TextField(blank=True, null=True) 
     image = models.ImageField(upload_to='store_images/', blank=True, null=True)  
+    updated_at = models.DateTimeField(auto_now=True)
 
 
     def save(self, *args, **kwargs):
@@ -28,9 +32,21 @@ class Shop(models.Model):
     classification = models.ForeignKey(Classification, on_delete=models.CASCADE)
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='store_images/', blank=True, null=True)  
+    # The image whose resized variants are all written (see main_app.images).
+    image_variants = models.CharField(max_length=255, blank=True, default='')
     phone = models.CharField(max_length=20, blank=True, null=True)
     email = models.EmailField(blank=True, null=True)
     address = models.TextField(blank=True, null=True)
+    # The vendor's own id, used by `manage.py import_catalog` to upsert.
+    external_id = models.CharField(max_length=100, unique=True, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Back the keyset-paginated sort orders of classification_stores_view.
+        indexes = [
+            models.Index(fields=['classification', 'name', 'id'], name='shop_class_name_idx'),
+            models.Index(fields=['classification', 'id'], name='shop_class_newest_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -42,11 +58,56 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='product_images/', blank=True, null=True)  
+    # The image whose resized variants are all written (see main_app.images).
+    image_variants = models.CharField(max_length=255, blank=True, default='')
     is_available = models.BooleanField(default=True)
+    # The vendor's own id within the shop, used by `manage.py import_catalog` to upsert.
+    external_id = models.CharField(max_length=100, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Denormalized review aggregates, kept in step by the ProductReview signals
+    # below and rebuilt from scratch by `manage.py rebuild_ratings`.
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+    # rating_sum / rating_count, stored so listings can sort on an index.
+    rating_avg = models.FloatField(default=0)
+
+    class Meta:
+        # Back the keyset-paginated sort orders of shop_products_view.
+        indexes = [
+            models.Index(fields=['shop', 'price', 'id'], name='product_shop_price_idx'),
+            models.Index(fields=['shop', 'name', 'id'], name='product_shop_name_idx'),
+            models.Index(fields=['shop', 'id'], name='product_shop_newest_idx'),
+            models.Index(fields=['shop', 'rating_avg', 'id'], name='product_shop_rating_idx'),
+            # A shop's in-stock products, cheapest first.
+            models.Index(fields=['shop', 'is_available', 'price'], name='product_shop_available_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'external_id'], name='product_shop_external_id_uniq'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @property
+    def avg_rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count else 0
+
+    @property
+    def rating_histogram(self):
+        """(stars, count, percent) for 5 down to 1 stars."""
+        histogram = []
+        for stars in range(5, 0, -1):
+            count = getattr(self, f'rating_{stars}')
+            percent = count * 100 / self.rating_count if self.rating_count else 0
+            histogram.append((stars, count, percent))
+        return histogram
+
 
 class Budget(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -63,6 +124,18 @@ class SelectedProduct(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        # One line per product; adding it again increments the quantity
+        # (see main_app.budget.add_to_budget).
+        constraints = [
+            models.UniqueConstraint(fields=['budget', 'product'], name='selectedproduct_budget_product_uniq'),
+        ]
+        # BudgetSummary filters on budget and user; covering product_id
+        # lets the join to Product read it from the index.
+        indexes = [
+            models.Index(fields=['budget', 'user', 'product'], name='selected_budget_user_idx'),
+        ]
+
     def __str__(self):
         return f"{self.product.name} × {self.quantity}"
 
@@ -73,6 +146,13 @@ class Cart(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # One line per product; adding it again increments the quantity
+        # (see main_app.budget.add_to_cart).
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='cart_user_product_uniq'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} → {self.product.name} ({self.quantity})"
 
@@ -92,11 +172,40 @@ class ProductReview(models.Model):
     rating = models.PositiveIntegerField(default=1)  # 1–5 stars
     comment = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Number of HelpfulVote rows, kept in step by review_helpful_view.
+    helpful_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # The sort orders of product_reviews_view (scanned backwards for
+        # the descending ones) and newest-first reviews by a user
+        # (profile_view), read in index order without a sort.
+        indexes = [
+            models.Index(fields=['product', 'created_at', 'id'], name='review_product_newest_idx'),
+            models.Index(fields=['product', 'rating', 'id'], name='review_product_rating_idx'),
+            models.Index(fields=['product', 'helpful_count', 'id'], name='review_product_helpful_idx'),
+            models.Index(fields=['user', '-created_at'], name='review_user_newest_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} rated {self.product.name} {self.rating}/5"
 
 
+class HelpfulVote(models.Model):
+    """A user marking a review as helpful; counted in ProductReview.helpful_count."""
+    review = models.ForeignKey(ProductReview, on_delete=models.CASCADE, related_name='helpful_votes')
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['review', 'user'], name='helpfulvote_review_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} found review {self.review_id} helpful"
+
+
 class BudgetEstimate(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     estimated_cost = models.DecimalField(max_digits=10, decimal_places=2)
@@ -107,14 +216,125 @@ class BudgetEstimate(models.Model):
         return f"Estimate for {self.user.username} – {self.estimated_cost}"
 
 
+class PriceStats(models.Model):
+    """
+    Price statistics of the available products under one classification
+    or shop, materialized by main_app.price_stats. The prices are null
+    when there are no available products.
+    """
+    product_count = models.PositiveIntegerField(default=0)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    mean_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    median_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    p10_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    p90_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    refreshed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        abstract = True
+
+
+class ClassificationPriceStats(PriceStats):
+    classification = models.OneToOneField(Classification, on_delete=models.CASCADE, primary_key=True,
+                                          related_name='price_stats')
+
+    def __str__(self):
+        return f"Prices in {self.classification.name}"
+
+
+class ShopPriceStats(PriceStats):
+    shop = models.OneToOneField(Shop, on_delete=models.CASCADE, primary_key=True, related_name='price_stats')
+
+    def __str__(self):
+        return f"Prices at {self.shop.name}"
+
+
+class ProductNeighbor(models.Model):
+    """
+    One of a product's most often planned-together products, ranked from
+    0 by score; maintained by main_app.recommendations.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbors')
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    # Users with both products in their wishlist, cart or budget.
+    shared_count = models.PositiveIntegerField()
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='neighbor_product_rank_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.neighbor_id} ({self.score:.3f})"
+
+
+class SimilarProduct(models.Model):
+    """
+    One of a product's most similar products by name, description and
+    price, ranked from 0 by cosine score; maintained by main_app.similarity.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='similar_products')
+    similar = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='similar_product_rank_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} ~ {self.similar_id} ({self.score:.3f})"
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='userprofile')
     profile_picture = models.ImageField(upload_to='profile_pictures/', blank=True, null=True)
+    # The picture whose resized variants are all written (see main_app.images).
+    profile_picture_variants = models.CharField(max_length=255, blank=True, default='')
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
 
+class Task(models.Model):
+    """A unit of background work, run by `manage.py run_worker`."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='task_status_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
@@ -126,3 +346,84 @@ def save_user_profile(sender, instance, **kwargs):
         instance.userprofile.save()
     except ObjectDoesNotExist:
         UserProfile.objects.create(user=instance)
+
+
+RATING_STARS = range(1, 6)
+
+
+def rating_aggregate_changes(rating, sign):
+    """F() updates that add (sign=1) or remove (sign=-1) one rating from a Product."""
+    # UPDATE ... SET reads the pre-update row, so the new average is
+    # derived from the same old count and sum the other columns use.
+    changes = {
+        'rating_count': F('rating_count') + sign,
+        'rating_sum': F('rating_sum') + sign * rating,
+        'rating_avg': Coalesce(
+            Cast(F('rating_sum') + sign * rating, FloatField()) / NullIf(F('rating_count') + sign, 0),
+            0.0,
+        ),
+        # update() skips auto_now; the product's card has changed.
+        'updated_at': timezone.now(),
+    }
+    if rating in RATING_STARS:
+        changes[f'rating_{rating}'] = F(f'rating_{rating}') + sign
+    return changes
+
+
+def apply_rating_change(product_id, rating, sign):
+    Product.objects.filter(pk=product_id).update(**rating_aggregate_changes(rating, sign))
+
+
+def rebuild_product_ratings(products=None):
+    """
+    Recompute the rating aggregates from ProductReview rows.
+
+    `products` optionally limits the rebuild to a Product queryset.
+    Returns the number of products whose aggregates changed; their cache
+    scopes are bumped once the transaction commits.
+    """
+    from .catalog_cache import bump_on_commit
+
+    products = Product.objects.all() if products is None else products
+    aggregates = {
+        'rating_count': Count('reviews'),
+        'rating_sum': Coalesce(Sum('reviews__rating'), 0),
+    }
+    for stars in RATING_STARS:
+        aggregates[f'rating_{stars}'] = Count('reviews', filter=Q(reviews__rating=stars))
+    updated = 0
+    scopes = set()
+    rows = products.order_by().values('pk', 'shop_id', 'shop__classification_id').annotate(**aggregates)
+    for row in rows.iterator(chunk_size=2000):
+        pk, shop_id, classification_id = row.pop('pk'), row.pop('shop_id'), row.pop('shop__classification_id')
+        row['rating_avg'] = row['rating_sum'] / row['rating_count'] if row['rating_count'] else 0
+        # update() skips auto_now; the similarity index looks for changed products by updated_at.
+        if Product.objects.filter(pk=pk).exclude(**row).update(**row, updated_at=timezone.now()):
+            updated += 1
+            # Ratings show on the product's card and feed the rating sort and facet.
+            scopes.update([f'product:{pk}', f'shop:{shop_id}', f'classification:{classification_id}'])
+    if scopes:
+        bump_on_commit(*scopes)
+    return updated
+
+
+@receiver(pre_save, sender=ProductReview)
+def remember_review_rating(sender, instance, **kwargs):
+    instance._previous_rating = None
+    if instance.pk:
+        instance._previous_rating = (
+            ProductReview.objects.filter(pk=instance.pk).values_list('product_id', 'rating').first()
+        )
+
+@receiver(post_save, sender=ProductReview)
+def count_review_rating(sender, instance, **kwargs):
+    previous = instance._previous_rating
+    current = (instance.product_id, instance.rating)
+    if previous != current:
+        if previous is not None:
+            apply_rating_change(*previous, -1)
+        apply_rating_change(*current, 1)
+
+@receiver(post_delete, sender=ProductReview)
+def uncount_review_rating(sender, instance, **kwargs):
+    apply_rating_change(instance.product_id, instance.rating, -1)
@@ -0,0 +1,117 @@
+"""
+Keyset (cursor) pagination.
+
+Instead of OFFSET, each page is fetched with a WHERE clause that starts
+right after the last row of the previous page, so page N costs the same
+index range scan as page 1. Every ordering must end in a unique column
+(the primary key) so that rows with equal sort values are not skipped.
+"""
+import base64
+import json
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+KeysetPage = namedtuple('KeysetPage', ['object_list', 'next_cursor', 'previous_cursor'])
+
+
+def encode_cursor(direction, values):
+    payload = json.dumps([direction, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (direction, values), or (None, None) for a missing or malformed cursor."""
+    if not cursor:
+        return None, None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None, None
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        return None, None
+    return direction, values
+
+
+class KeysetPaginator:
+    """
+    Paginate `queryset` by `ordering`, e.g. ('-price', '-pk').
+
+    Sort values are carried in an opaque cursor; `page(cursor)` returns the
+    rows after (or, for a previous-page cursor, before) that position.
+    """
+
+    def __init__(self, queryset, ordering, per_page=24):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        self.fields = [name.lstrip('-') for name in self.ordering]
+        self.descending = [name.startswith('-') for name in self.ordering]
+
+    def _model_field(self, name):
+        meta = self.queryset.model._meta
+        return meta.pk if name == 'pk' else meta.get_field(name)
+
+    def _serialize(self, obj):
+        return [self._model_field(name).value_to_string(obj) for name in self.fields]
+
+    def _deserialize(self, values):
+        return [self._model_field(name).to_python(value) for name, value in zip(self.fields, values)]
+
+    def _after(self, values, reverse=False):
+        """Q matching rows strictly after `values` in this ordering (or before, if reverse)."""
+        condition = Q()
+        for i, (name, value) in enumerate(zip(self.fields, values)):
+            descending = self.descending[i] != reverse
+            step = Q(**{f'{name}__lt' if descending else f'{name}__gt': value})
+            for prior_name, prior_value in zip(self.fields[:i], values[:i]):
+                step &= Q(**{prior_name: prior_value})
+            condition |= step
+        return condition
+
+    def page(self, cursor=None):
+        queryset, direction = self._page_queryset(cursor)
+        # Fetch one extra row to learn whether another page exists.
+        return self._build_page(list(queryset[:self.per_page + 1]), direction)
+
+    async def apage(self, cursor=None):
+        """page() for async views, fetching the rows with the async ORM."""
+        queryset, direction = self._page_queryset(cursor)
+        return self._build_page([row async for row in queryset[:self.per_page + 1]], direction)
+
+    def _page_queryset(self, cursor):
+        direction, values = decode_cursor(cursor)
+        if values is not None and len(values) != len(self.fields):
+            direction, values = None, None
+        if values is not None:
+            try:
+                values = self._deserialize(values)
+            except (ValidationError, ValueError, TypeError):
+                direction, values = None, None
+
+        queryset = self.queryset
+        if direction == 'prev':
+            reversed_ordering = [name[1:] if name.startswith('-') else f'-{name}' for name in self.ordering]
+            queryset = queryset.filter(self._after(values, reverse=True)).order_by(*reversed_ordering)
+        else:
+            if direction == 'next':
+                queryset = queryset.filter(self._after(values))
+            queryset = queryset.order_by(*self.ordering)
+        return queryset, direction
+
+    def _build_page(self, rows, direction):
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == 'prev':
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or direction == 'prev':
+                next_cursor = encode_cursor('next', self._serialize(rows[-1]))
+            if direction == 'next' or (direction == 'prev' and has_more):
+                previous_cursor = encode_cursor('prev', self._serialize(rows[0]))
+        return KeysetPage(rows, next_cursor, previous_cursor)
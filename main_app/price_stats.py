@@ -0,0 +1,188 @@
+"""
+Materialized price statistics.
+
+ClassificationPriceStats and ShopPriceStats hold the count, min, max,
+mean, median and 10th/90th percentiles of Product.price over the
+available products of each classification and shop, so budget hints and
+listing pages read one row instead of scanning the product table.
+
+The statistics are computed by the database, so a refresh holds a few
+rows per parent rather than every price: percentile_cont on PostgreSQL,
+and elsewhere the rows either side of each percentile's position, picked
+out with window functions and interpolated the same (linear) way.
+
+Saving or deleting a product (or moving a shop) queues a refresh of just
+the shops and classifications it touches. Refreshes are debounced: every
+change within one REFRESH_WINDOW shares a task, keyed by scope and
+window, that runs once the window has closed. `manage.py
+rebuild_price_stats` recomputes every row.
+"""
+import math
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Aggregate, Avg, Count, F, FloatField, Max, Min, Q, Window
+from django.db.models.functions import Ceil, Floor, RowNumber
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .catalog_cache import bump
+from .models import Classification, ClassificationPriceStats, Product, Shop, ShopPriceStats
+from .tasks import enqueue_many, register_task
+
+
+REFRESH_WINDOW = 60
+
+CENT = Decimal('0.01')
+
+STAT_FIELDS = [
+    'product_count', 'min_price', 'max_price', 'mean_price', 'median_price', 'p10_price', 'p90_price',
+]
+
+PERCENTILES = {'p10_price': 0.1, 'median_price': 0.5, 'p90_price': 0.9}
+
+# Stats model -> (scope name, parent model, Product lookup of the parent's id).
+SOURCES = {
+    ShopPriceStats: ('shop', Shop, 'shop_id'),
+    ClassificationPriceStats: ('classification', Classification, 'shop__classification_id'),
+}
+
+SCOPE_MODELS = {scope: stats_model for stats_model, (scope, parent, lookup) in SOURCES.items()}
+
+
+class PercentileCont(Aggregate):
+    """PostgreSQL's percentile_cont: the linearly interpolated `fraction` percentile."""
+    function = 'PERCENTILE_CONT'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+def money(value):
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def interpolate(count, fraction, prices):
+    """
+    The linear `fraction` percentile of `count` sorted prices, given
+    {position: price} holding at least the two positions around it.
+    """
+    rank = (count - 1) * fraction
+    lower, upper = math.floor(rank), math.ceil(rank)
+    return prices[lower] + (prices[upper] - prices[lower]) * Decimal(rank - lower)
+
+
+def grouped_stats(prices, lookup):
+    """{parent id: PriceStats field values} for the parents with any of `prices`."""
+    prices = prices.order_by()
+    aggregates = {
+        'product_count': Count('pk'), 'min_price': Min('price'), 'max_price': Max('price'),
+        'mean_price': Avg('price'),
+    }
+    postgres = connections[prices.db].vendor == 'postgresql'
+    if postgres:
+        aggregates.update({field: PercentileCont('price', fraction) for field, fraction in PERCENTILES.items()})
+    stats = {row.pop(lookup): row for row in prices.values(lookup).annotate(**aggregates)}
+
+    if not postgres:
+        # Only the rows next to each percentile's position leave the database.
+        ranked = prices.annotate(
+            position=Window(RowNumber(), partition_by=F(lookup), order_by=F('price').asc()) - 1,
+            size=Window(Count('pk'), partition_by=F(lookup)),
+        )
+        near = Q()
+        for fraction in PERCENTILES.values():
+            rank = (F('size') - 1) * fraction
+            near |= Q(position=Floor(rank)) | Q(position=Ceil(rank))
+        positions = defaultdict(dict)
+        for parent_id, position, price in ranked.filter(near).values_list(lookup, 'position', 'price'):
+            positions[parent_id][position] = price
+        for parent_id, row in stats.items():
+            row.update({field: interpolate(row['product_count'], fraction, positions[parent_id])
+                        for field, fraction in PERCENTILES.items()})
+
+    for row in stats.values():
+        row.update({field: money(row[field]) for field in ['mean_price', *PERCENTILES]})
+    return stats
+
+
+def refresh_price_stats(stats_model, ids=None):
+    """
+    Recompute the `stats_model` rows for parent `ids` (every shop or
+    classification when None) from their available products. Returns
+    the number of rows written.
+    """
+    scope, parent_model, lookup = SOURCES[stats_model]
+    parents = parent_model.objects.all()
+    prices = Product.objects.filter(is_available=True)
+    if ids is not None:
+        parents = parents.filter(pk__in=ids)
+        prices = prices.filter(**{f'{lookup}__in': ids})
+    stats = grouped_stats(prices, lookup)
+    empty = dict.fromkeys(STAT_FIELDS, None) | {'product_count': 0}
+    # Ids whose parent has been deleted are dropped here.
+    parent_ids = list(parents.values_list('pk', flat=True))
+
+    rows = [stats_model(pk=pk, **stats.get(pk, empty)) for pk in parent_ids]
+    stats_model.objects.bulk_create(rows, batch_size=500, update_conflicts=True, unique_fields=[scope],
+                                    update_fields=STAT_FIELDS + ['refreshed_at'])
+    scopes = {f'{scope}:{pk}' for pk in parent_ids}
+    if stats_model is ShopPriceStats:
+        # The classification page lists its shops' price ranges.
+        scopes.update(f'classification:{pk}' for pk in
+                      Shop.objects.filter(pk__in=parent_ids).values_list('classification_id', flat=True).distinct())
+    bump(*scopes)
+    return len(rows)
+
+
+def schedule_refresh(shop_ids=(), classification_ids=()):
+    """Queue a debounced refresh of these shops, their classifications and `classification_ids`."""
+    now = time.time()
+    window = int(now // REFRESH_WINDOW)
+
+    def unqueued(scope, ids):
+        jobs = [({'scope': scope, 'id': pk}, f'price-stats:{scope}:{pk}:{window}') for pk in sorted(ids)]
+        if getattr(settings, 'TASKS_EAGER', False):
+            return jobs
+        # Every product save lands here; after the first in a window, the
+        # job is known to be queued and the INSERT is skipped.
+        return [(payload, key) for payload, key in jobs if cache.add(f'queued:{key}', True, REFRESH_WINDOW)]
+
+    shop_jobs = unqueued('shop', {pk for pk in shop_ids if pk})
+    classification_ids = {pk for pk in classification_ids if pk}
+    if shop_jobs:
+        # A shop already queued this window queued its classification with it.
+        classification_ids.update(Shop.objects.filter(pk__in=[payload['id'] for payload, key in shop_jobs])
+                                  .values_list('classification_id', flat=True))
+    jobs = shop_jobs + unqueued('classification', classification_ids)
+    if not jobs:
+        return 0
+    return enqueue_many('catalog.refresh_price_stats', jobs,
+                        delay=timedelta(seconds=(window + 1) * REFRESH_WINDOW - now))
+
+
+@register_task('catalog.refresh_price_stats')
+def refresh_scope(payload):
+    refresh_price_stats(SCOPE_MODELS[payload['scope']], [payload['id']])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_product_price_stats(sender, instance, **kwargs):
+    # _cached_parent_id is the shop before the save (catalog_cache.remember_parent).
+    schedule_refresh(shop_ids=[instance.shop_id, getattr(instance, '_cached_parent_id', None)])
+
+
+@receiver(post_save, sender=Shop)
+def refresh_moved_shop_price_stats(sender, instance, created, **kwargs):
+    # Deleting a shop deletes its products, which refresh through the receiver above.
+    previous = getattr(instance, '_cached_parent_id', None)
+    if previous and previous != instance.classification_id:
+        schedule_refresh(classification_ids=[previous, instance.classification_id])
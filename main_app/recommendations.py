@@ -0,0 +1,309 @@
+"""
+"Frequently planned together" recommendations.
+
+A user's wishlist, cart and budget together form one basket of products
+they are planning with. Two products are related by how many users have
+both in their basket, normalised by how many have each (cosine
+similarity), so that popular products do not top every list.
+ProductNeighbor keeps each product's TOP_K best neighbours, so pages read
+recommendations with one indexed lookup.
+
+The co-occurrence counts are built with NumPy: baskets are sorted by
+user, every in-basket pair is generated with repeat/arange arithmetic
+instead of Python loops, and pairs are counted with np.unique on a single
+int64 key per pair, a chunk of users at a time.
+
+Adding a product to a basket (or removing one) queues a refresh of that
+user's basket products, debounced like the price statistics: every change
+by a user within one REFRESH_WINDOW shares a task. A refresh recomputes
+the affected products' rows exactly; other rows pick up the new
+popularities on their own next refresh. `manage.py rebuild_recommendations`
+recomputes every row.
+"""
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .catalog_cache import bump
+from .models import Cart, Product, ProductNeighbor, SelectedProduct, Wishlist
+from .tasks import enqueue_many, register_task
+
+
+TOP_K = 10
+
+# Pairs must share at least this many users to be recommended.
+MIN_SHARED = 2
+
+# Larger baskets (bulk imports, bots) say little about any one pair and
+# would dominate the quadratic pair count, so they are left out.
+MAX_BASKET = 200
+
+# In-basket pairs generated per NumPy chunk.
+PAIR_CHUNK = 2_000_000
+
+# Product ids per query when counting baskets in holders().
+ID_BATCH = 5000
+
+REFRESH_WINDOW = 60
+
+BASKET_MODELS = (Wishlist, Cart, SelectedProduct)
+
+
+def basket_rows(holding=None, user_ids=None, product_ids=None):
+    """
+    Distinct (user_id, product_id) basket rows as two int64 arrays sorted
+    by user: every basket, only the baskets holding one of the products
+    `holding`, or only those of `user_ids`; with `product_ids`, only the
+    rows for those products.
+    """
+    users = None
+    if holding is not None:
+        users = Q()
+        for model in BASKET_MODELS:
+            users |= Q(user_id__in=model.objects.filter(product_id__in=holding).values('user_id'))
+    querysets = []
+    for model in BASKET_MODELS:
+        rows = model.objects.all()
+        if users is not None:
+            rows = rows.filter(users)
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        if product_ids is not None:
+            rows = rows.filter(product_id__in=product_ids)
+        querysets.append(rows.order_by().values_list('user_id', 'product_id'))
+    rows = np.array(list(querysets[0].union(*querysets[1:])), dtype=np.int64).reshape(-1, 2)
+    rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+    return rows[:, 0], rows[:, 1]
+
+
+def group_bounds(users):
+    """Start offsets and sizes of the runs of equal values in sorted `users`."""
+    if not len(users):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    return starts, np.diff(np.r_[starts, len(users)])
+
+
+def basket_pairs(items, starts, sizes):
+    """Every ordered pair (left, right) of different items within the baskets at `starts`."""
+    def offsets(counts):
+        # 0..count-1 for each count, concatenated.
+        return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    basket_start = np.repeat(starts, sizes)
+    position = basket_start + offsets(sizes)
+    size_of = np.repeat(sizes, sizes)
+    left = np.repeat(position, size_of)
+    right = np.repeat(basket_start, size_of) + offsets(size_of)
+    different = left != right
+    return items[left[different]], items[right[different]]
+
+
+def cooccurrence(users, items, n_items, rows=None):
+    """
+    Count the users sharing each pair of items (dense indices below
+    `n_items`). With `rows`, a boolean mask over item indices, only pairs
+    whose first item is in it are kept. Returns (first, second, count).
+    """
+    starts, sizes = group_bounds(users)
+    keep = (sizes >= 2) & (sizes <= MAX_BASKET)
+    starts, sizes = starts[keep], sizes[keep]
+
+    # Whole baskets per chunk, about PAIR_CHUNK pairs each.
+    chunk_of = np.cumsum(sizes ** 2) // PAIR_CHUNK
+    bounds = np.r_[0, np.flatnonzero(np.diff(chunk_of)) + 1, len(sizes)]
+    keys, counts = [], []
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        if end <= begin:
+            continue
+        offset = starts[begin]
+        chunk_items = items[offset:starts[end - 1] + sizes[end - 1]]
+        first, second = basket_pairs(chunk_items, starts[begin:end] - offset, sizes[begin:end])
+        if rows is not None:
+            wanted = rows[first]
+            first, second = first[wanted], second[wanted]
+        chunk_keys, chunk_counts = np.unique(first * n_items + second, return_counts=True)
+        keys.append(chunk_keys)
+        counts.append(chunk_counts)
+
+    if not keys:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+    return keys // n_items, keys % n_items, counts
+
+
+def holders(product_ids):
+    """The number of baskets holding each of `product_ids`, a sorted int64 array."""
+    counts = np.zeros(len(product_ids), dtype=np.int64)
+    for start in range(0, len(product_ids), ID_BATCH):
+        batch = product_ids[start:start + ID_BATCH]
+        users, products = basket_rows(product_ids=batch.tolist())
+        counts[start:start + len(batch)] = np.bincount(np.searchsorted(batch, products), minlength=len(batch))
+    return counts
+
+
+def top_neighbors(first, second, counts, popularity):
+    """
+    The TOP_K pairs per first item by cosine score, as (first, second,
+    count, score, rank) arrays sorted by first item, then rank.
+    """
+    scores = counts / np.sqrt(popularity[first] * popularity[second])
+    # The pairs come sorted by (first, second) and lexsort is stable, so
+    # equal scores stay in neighbour id order.
+    order = np.lexsort((-scores, first))
+    first, second, counts, scores = first[order], second[order], counts[order], scores[order]
+    starts, sizes = group_bounds(first)
+    ranks = np.arange(len(first)) - np.repeat(starts, sizes)
+    top = ranks < TOP_K
+    return first[top], second[top], counts[top], scores[top], ranks[top]
+
+
+def compute_neighbors(product_ids=None):
+    """
+    ProductNeighbor rows (unsaved) for `product_ids`, or for every product
+    when None.
+    """
+    # Only the baskets holding one of the products can pair with it.
+    users, products = basket_rows(holding=product_ids)
+    if not len(products):
+        return []
+
+    ids, items = np.unique(products, return_inverse=True)
+    rows = None if product_ids is None else np.isin(ids, list(product_ids))
+    first, second, counts = cooccurrence(users, items, len(ids), rows)
+    shared = counts >= MIN_SHARED
+    first, second, counts = first[shared], second[shared], counts[shared]
+
+    if product_ids is None:
+        popularity = np.bincount(items, minlength=len(ids))
+    else:
+        # Only some baskets were loaded; count every basket holding the
+        # items that are left.
+        popularity = np.zeros(len(ids), dtype=np.int64)
+        needed = np.unique(np.r_[first, second])
+        popularity[needed] = holders(ids[needed])
+
+    first, second, counts, scores, ranks = top_neighbors(first, second, counts, popularity)
+    return [
+        ProductNeighbor(product_id=product, neighbor_id=neighbor, shared_count=count, score=score, rank=rank)
+        for product, neighbor, count, score, rank in zip(
+            ids[first].tolist(), ids[second].tolist(), counts.tolist(), scores.tolist(), ranks.tolist()
+        )
+    ]
+
+
+def refresh_neighbors(product_ids=None):
+    """
+    Recompute and store the neighbours of `product_ids` (every product
+    when None). Returns the number of rows written.
+    """
+    if product_ids is not None:
+        product_ids = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+        if not product_ids:
+            return 0
+    rows = compute_neighbors(product_ids)
+    with transaction.atomic():
+        stale = ProductNeighbor.objects.all()
+        if product_ids is not None:
+            stale = stale.filter(product_id__in=product_ids)
+        stale.delete()
+        ProductNeighbor.objects.bulk_create(rows, batch_size=1000)
+
+    shops = Product.objects.all()
+    if product_ids is not None:
+        shops = shops.filter(pk__in=product_ids)
+    bump(*{f'shop:{pk}' for pk in shops.values_list('shop_id', flat=True).distinct()})
+    return len(rows)
+
+
+def basket_product_ids(user_id):
+    return set(basket_rows(user_ids=[user_id])[1].tolist())
+
+
+def schedule_refresh(user_ids=(), product_ids=()):
+    """Queue a debounced refresh of these users' basket products and of `product_ids`."""
+    now = time.time()
+    window = int(now // REFRESH_WINDOW)
+    jobs = [
+        ({'scope': scope, 'id': pk}, f'recommendations:{scope}:{pk}:{window}')
+        for scope, ids in (('user', user_ids), ('product', product_ids))
+        for pk in sorted({pk for pk in ids if pk})
+    ]
+    if not getattr(settings, 'TASKS_EAGER', False):
+        # Every click adds to a basket; after the first in a window, the
+        # job is known to be queued and the INSERT is skipped.
+        jobs = [(payload, key) for payload, key in jobs if cache.add(f'queued:{key}', True, REFRESH_WINDOW)]
+    if not jobs:
+        return 0
+    return enqueue_many('recommendations.refresh', jobs,
+                        delay=timedelta(seconds=(window + 1) * REFRESH_WINDOW - now))
+
+
+@register_task('recommendations.refresh')
+def refresh_scope(payload):
+    if payload['scope'] == 'user':
+        refresh_neighbors(basket_product_ids(payload['id']))
+    else:
+        refresh_neighbors([payload['id']])
+
+
+@receiver(post_save, sender=Wishlist)
+def refresh_added_neighbors(sender, instance, created, **kwargs):
+    # Cart and budget lines are added by budget.add_lines(), which
+    # schedules its own refresh.
+    if created:
+        schedule_refresh(user_ids=[instance.user_id])
+
+
+@receiver(post_delete, sender=Wishlist)
+@receiver(post_delete, sender=Cart)
+@receiver(post_delete, sender=SelectedProduct)
+def refresh_removed_neighbors(sender, instance, **kwargs):
+    # The removed product is no longer in the basket, so refresh it by id.
+    schedule_refresh(user_ids=[instance.user_id], product_ids=[instance.product_id])
+
+
+def planned_together(product_ids, exclude=(), limit=6):
+    """
+    Available products most often planned together with `product_ids`,
+    other than those in `exclude`, by their scores summed across the
+    products.
+    """
+    neighbors = (
+        ProductNeighbor.objects
+        .filter(product_id__in=product_ids, neighbor__is_available=True)
+        .exclude(neighbor_id__in=exclude)
+    )
+    return rank_neighbors(neighbors, limit)
+
+
+def shop_planned_together(shop_id, limit=6):
+    """Products from other shops most often planned together with the shop's products."""
+    neighbors = (
+        ProductNeighbor.objects
+        .filter(product__shop_id=shop_id, neighbor__is_available=True)
+        .exclude(neighbor__shop_id=shop_id)
+    )
+    return rank_neighbors(neighbors, limit)
+
+
+def rank_neighbors(neighbors, limit):
+    """
+    The `limit` neighbours with the highest summed score: summed and ranked
+    in the database, so only the winners are loaded.
+    """
+    best = list(
+        neighbors.values('neighbor_id').annotate(total=Sum('score'))
+        .order_by('-total', 'neighbor_id').values_list('neighbor_id', flat=True)[:limit]
+    )
+    products = Product.objects.in_bulk(best)
+    return [products[pk] for pk in best if pk in products]
@@ -0,0 +1,142 @@
+"""
+Read-replica routing.
+
+Reads of the catalog models (classifications, shops, products and
+reviews) made while serving a request go to one of the aliases in
+settings.DATABASE_REPLICAS; everything else, and every write, uses the
+primary ('default'). Cart, budget and wishlist rows are never read from a
+replica.
+
+Replicas lag behind the primary, so a user who has just written is
+pinned to the primary: for the rest of the request, and, through the
+cookie set by ReplicaPinningMiddleware, for REPLICA_PIN_SECONDS after.
+Locking reads (select_for_update, get_or_create) are routed as writes
+by Django and so stay on the primary too.
+
+Outside a request (management commands, the task worker) nothing is
+routed to a replica: those read back what they have just written. Nor
+are the reads that fill the shared catalog cache (see
+catalog_cache.cached_fragment): one recomputed from a lagging replica
+just after a bump would be stored under the new version and served to
+everyone, the writer included.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+REPLICA_MODELS = {
+    'main_app.classification',
+    'main_app.shop',
+    'main_app.product',
+    'main_app.productreview',
+}
+
+PIN_COOKIE = 'primary_pin'
+
+current_routing = ContextVar('current_routing', default=None)
+
+
+@contextmanager
+def primary_reads():
+    """Read everything in the block from the primary, as outside a request."""
+    token = current_routing.set(None)
+    try:
+        yield
+    finally:
+        current_routing.reset(token)
+
+
+def pin_seconds():
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+class RequestRouting:
+    """Routing state for one request: its replica, and whether it is pinned to the primary."""
+
+    def __init__(self, pinned_until=0.0):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        # One replica per request, so its reads see one consistent snapshot.
+        self.replica = random.choice(replicas) if replicas else None
+        self.pinned = pinned_until > time.time()
+        self.wrote = False
+
+    @classmethod
+    def from_request(cls, request):
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0.0
+        return cls(pinned_until)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if routing is None or routing.replica is None or routing.pinned:
+            return None
+        if model._meta.label_lower not in REPLICA_MODELS:
+            return None
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.wrote = routing.pinned = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        aliases = {DEFAULT_DB_ALIAS, *getattr(settings, 'DATABASE_REPLICAS', [])}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """
+    Enable replica reads for the request, unless the user wrote recently;
+    after a write, pin the browser to the primary with a short-lived cookie.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        routing = RequestRouting.from_request(request)
+        token = current_routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.pin(routing, response)
+
+    async def __acall__(self, request):
+        # The context variable reaches the view's sync_to_async threads too.
+        routing = RequestRouting.from_request(request)
+        token = current_routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.pin(routing, response)
+
+    def pin(self, routing, response):
+        if routing.wrote:
+            seconds = pin_seconds()
+            response.set_cookie(PIN_COOKIE, f'{time.time() + seconds:.3f}', max_age=seconds,
+                                httponly=True, samesite='Lax')
+        return response
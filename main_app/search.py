@@ -0,0 +1,304 @@
+"""
+Full-text catalog search.
+
+Products, shops and classifications are indexed into one table,
+`main_app_searchindex`: an FTS5 virtual table on SQLite and a weighted
+`tsvector` column with a GIN index on PostgreSQL. Each row is keyed by
+`object_id * KIND_STRIDE + kind code`, so keeping an object in sync is a
+primary-key upsert or delete done from the model signals below.
+"""
+import re
+from collections import namedtuple
+
+from django.db import connection as default_connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Classification, Shop, Product
+
+
+INDEX_TABLE = 'main_app_searchindex'
+
+KIND_STRIDE = 4
+
+KINDS = {
+    'product': (1, Product),
+    'shop': (2, Shop),
+    'classification': (3, Classification),
+}
+
+MODEL_KINDS = {model: kind for kind, (code, model) in KINDS.items()}
+
+# (title column, body column) per kind, as SQL over the model's table.
+DOCUMENT_COLUMNS = {
+    'product': ('name', "COALESCE(description, '')"),
+    'shop': ('name', "COALESCE(description, '')"),
+    'classification': ('name', "''"),
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+SearchResult = namedtuple('SearchResult', ['kind', 'object', 'rank'])
+
+SearchPage = namedtuple('SearchPage', ['query', 'results', 'number', 'has_previous', 'has_next'])
+
+
+def index_key(kind, object_id):
+    return object_id * KIND_STRIDE + KINDS[kind][0]
+
+
+def document_for(instance):
+    if isinstance(instance, Classification):
+        return instance.name, ''
+    return instance.name, instance.description or ''
+
+
+def id_placeholders(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+def id_filter(object_ids):
+    """(SQL suffix, params) restricting insert_select() to `object_ids`, if given."""
+    if object_ids is None:
+        return '', []
+    object_ids = list(object_ids)
+    return f" WHERE id IN ({id_placeholders(object_ids)})", object_ids
+
+
+def query_tokens(query):
+    return TOKEN_RE.findall((query or '').lower())[:16]
+
+
+class SQLiteSearchBackend:
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5("
+            "kind UNINDEXED, object_id UNINDEXED, title, body, "
+            "tokenize = 'porter unicode61')"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {INDEX_TABLE}")
+
+    def clear(self, cursor):
+        cursor.execute(f"DELETE FROM {INDEX_TABLE}")
+
+    def upsert(self, cursor, kind, object_id, title, body):
+        key = index_key(kind, object_id)
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE rowid = %s", [key])
+        cursor.execute(
+            f"INSERT INTO {INDEX_TABLE} (rowid, kind, object_id, title, body) VALUES (%s, %s, %s, %s, %s)",
+            [key, kind, object_id, title, body],
+        )
+
+    def delete(self, cursor, kind, object_id):
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE rowid = %s", [index_key(kind, object_id)])
+
+    def delete_many(self, cursor, kind, object_ids):
+        keys = [index_key(kind, object_id) for object_id in object_ids]
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE rowid IN ({id_placeholders(keys)})", keys)
+
+    def insert_select(self, cursor, kind, table, object_ids=None):
+        title, body = DOCUMENT_COLUMNS[kind]
+        where, params = id_filter(object_ids)
+        cursor.execute(
+            f"INSERT INTO {INDEX_TABLE} (rowid, kind, object_id, title, body) "
+            f"SELECT id * {KIND_STRIDE} + {KINDS[kind][0]}, %s, id, {title}, {body} FROM {table}{where}",
+            [kind] + params,
+        )
+
+    def match(self, cursor, tokens, limit, offset):
+        # Every term must match; the last one is a prefix so results show up while typing.
+        terms = [f'"{token}"' for token in tokens]
+        terms[-1] += '*'
+        cursor.execute(
+            f"SELECT kind, object_id, bm25({INDEX_TABLE}, 0, 0, 10.0, 2.0) AS rank "
+            f"FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s ORDER BY rank LIMIT %s OFFSET %s",
+            [' '.join(terms), limit, offset],
+        )
+        # bm25() is lower-is-better; flip it so callers always sort descending.
+        return [(kind, object_id, -rank) for kind, object_id, rank in cursor.fetchall()]
+
+
+class PostgresSearchBackend:
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {INDEX_TABLE} ("
+            "id bigint PRIMARY KEY, "
+            "kind varchar(20) NOT NULL, "
+            "object_id bigint NOT NULL, "
+            "title text NOT NULL, "
+            "body text NOT NULL, "
+            "document tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', title), 'A') || "
+            "setweight(to_tsvector('english', body), 'B')"
+            ") STORED)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_document_gin ON {INDEX_TABLE} USING GIN (document)"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {INDEX_TABLE}")
+
+    def clear(self, cursor):
+        cursor.execute(f"TRUNCATE {INDEX_TABLE}")
+
+    def upsert(self, cursor, kind, object_id, title, body):
+        cursor.execute(
+            f"INSERT INTO {INDEX_TABLE} (id, kind, object_id, title, body) VALUES (%s, %s, %s, %s, %s) "
+            "ON CONFLICT (id) DO UPDATE SET title = EXCLUDED.title, body = EXCLUDED.body",
+            [index_key(kind, object_id), kind, object_id, title, body],
+        )
+
+    def delete(self, cursor, kind, object_id):
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE id = %s", [index_key(kind, object_id)])
+
+    def delete_many(self, cursor, kind, object_ids):
+        keys = [index_key(kind, object_id) for object_id in object_ids]
+        cursor.execute(f"DELETE FROM {INDEX_TABLE} WHERE id IN ({id_placeholders(keys)})", keys)
+
+    def insert_select(self, cursor, kind, table, object_ids=None):
+        title, body = DOCUMENT_COLUMNS[kind]
+        where, params = id_filter(object_ids)
+        cursor.execute(
+            f"INSERT INTO {INDEX_TABLE} (id, kind, object_id, title, body) "
+            f"SELECT id * {KIND_STRIDE} + {KINDS[kind][0]}, %s, id, {title}, {body} FROM {table}{where}",
+            [kind] + params,
+        )
+
+    def match(self, cursor, tokens, limit, offset):
+        terms = list(tokens)
+        terms[-1] += ':*'
+        cursor.execute(
+            f"SELECT kind, object_id, ts_rank_cd(document, tsq) AS rank "
+            f"FROM {INDEX_TABLE}, to_tsquery('english', %s) tsq "
+            "WHERE document @@ tsq ORDER BY rank DESC LIMIT %s OFFSET %s",
+            [' & '.join(terms), limit, offset],
+        )
+        return cursor.fetchall()
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend(),
+    'postgresql': PostgresSearchBackend(),
+}
+
+
+def get_backend(connection=None):
+    return BACKENDS.get((connection or default_connection).vendor)
+
+
+def create_index(connection=None):
+    connection = connection or default_connection
+    backend = get_backend(connection)
+    if backend:
+        with connection.cursor() as cursor:
+            backend.create(cursor)
+
+
+def drop_index(connection=None):
+    connection = connection or default_connection
+    backend = get_backend(connection)
+    if backend:
+        with connection.cursor() as cursor:
+            backend.drop(cursor)
+
+
+def rebuild_index(connection=None):
+    """Refill the whole index from the catalog tables with INSERT ... SELECT."""
+    connection = connection or default_connection
+    backend = get_backend(connection)
+    if not backend:
+        return
+    with connection.cursor() as cursor:
+        backend.clear(cursor)
+        for kind, (code, model) in KINDS.items():
+            backend.insert_select(cursor, kind, model._meta.db_table)
+
+
+def index_object(instance):
+    backend = get_backend()
+    if backend:
+        with default_connection.cursor() as cursor:
+            backend.upsert(cursor, MODEL_KINDS[type(instance)], instance.pk, *document_for(instance))
+
+
+def index_objects(model, object_ids):
+    """Re-index many objects of one model at once, for writes that bypass signals (bulk_create)."""
+    backend = get_backend()
+    object_ids = list(object_ids)
+    if backend and object_ids:
+        kind = MODEL_KINDS[model]
+        with default_connection.cursor() as cursor:
+            backend.delete_many(cursor, kind, object_ids)
+            backend.insert_select(cursor, kind, model._meta.db_table, object_ids)
+
+
+def unindex_object(instance):
+    backend = get_backend()
+    if backend:
+        with default_connection.cursor() as cursor:
+            backend.delete(cursor, MODEL_KINDS[type(instance)], instance.pk)
+
+
+def fallback_match(tokens, limit, offset):
+    """Unranked name lookups for database backends without a full-text index."""
+    rows = []
+    for kind, (code, model) in KINDS.items():
+        queryset = model.objects.all()
+        for token in tokens:
+            queryset = queryset.filter(name__icontains=token)
+        rows += [(kind, pk, 0) for pk in queryset.order_by('pk').values_list('pk', flat=True)[:offset + limit]]
+    return rows[offset:offset + limit]
+
+
+def hydrate(rows):
+    """Load the matched objects with one query per kind, keeping the rank order."""
+    ids = {}
+    for kind, object_id, rank in rows:
+        ids.setdefault(kind, []).append(object_id)
+    objects = {
+        'product': Product.objects.select_related('shop').in_bulk(ids.get('product', [])),
+        'shop': Shop.objects.select_related('classification').in_bulk(ids.get('shop', [])),
+        'classification': Classification.objects.in_bulk(ids.get('classification', [])),
+    }
+    return [
+        SearchResult(kind, objects[kind][object_id], rank)
+        for kind, object_id, rank in rows
+        if object_id in objects[kind]
+    ]
+
+
+def search_catalog(query, page=1, per_page=20):
+    """Return one ranked page of products, shops and classifications matching `query`."""
+    tokens = query_tokens(query)
+    if not tokens:
+        return SearchPage(query, [], 1, False, False)
+
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    backend = get_backend()
+    if backend:
+        with default_connection.cursor() as cursor:
+            rows = backend.match(cursor, tokens, per_page + 1, offset)
+    else:
+        rows = fallback_match(tokens, per_page + 1, offset)
+
+    # One extra row tells us whether there is a next page without a COUNT(*).
+    has_next = len(rows) > per_page
+    return SearchPage(query, hydrate(rows[:per_page]), page, page > 1, has_next)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Shop)
+@receiver(post_save, sender=Classification)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_object(instance)
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Shop)
+@receiver(post_delete, sender=Classification)
+def remove_from_search_index(sender, instance, **kwargs):
+    unindex_object(instance)
@@ -0,0 +1,349 @@
+"""
+Content-based similar products.
+
+Co-occurrence (main_app.recommendations) says nothing about products no
+one has planned with yet, so products are also compared by content. Each
+product becomes a TF-IDF vector over the words of its name (weighted
+NAME_WEIGHT) and description and a price-band token, hashed into DIM
+signed buckets so no vocabulary has to be kept. The unit vectors live in
+one float16 NumPy array, saved with the product ids and the IDF weights
+at settings.SIMILARITY_INDEX_PATH.
+
+Only products of the same classification are compared: a lamp is never
+"similar" to a sofa, and the blocks keep the matrix products small.
+Cosine scores are computed for BATCH_SIZE products against TILE_SIZE
+products of the block at a time, keeping a running top-K per product, so
+memory stays fixed however large a classification grows. Each product's
+TOP_K neighbours scoring at least MIN_SCORE are stored in SimilarProduct
+for a one-query lookup.
+
+A refresh re-vectorizes only the products (or shops) updated since the
+last one and drops deleted products. Besides the changed products, it
+recomputes just the lists a change can affect: those listing a changed
+or deleted product, and those a changed product now scores high enough
+to enter. The IDF weights are those of the last full rebuild, `manage.py
+rebuild_similar_products`.
+"""
+import io
+import math
+import os
+import time
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .catalog_cache import bump
+from .models import Product, Shop, SimilarProduct
+from .search import TOKEN_RE
+from .tasks import enqueue, register_task
+
+
+DIM = 256
+
+TOP_K = 10
+
+MIN_SCORE = 0.1
+
+SCORE_TOLERANCE = 1e-4
+
+NAME_WEIGHT = 2.0
+
+# Prices within one band differ by less than this factor.
+PRICE_BAND_RATIO = 1.5
+
+# Products scored, and classification products scored against, per
+# matrix product: the score matrix never exceeds BATCH_SIZE x TILE_SIZE.
+BATCH_SIZE = 1024
+TILE_SIZE = 8192
+
+REFRESH_WINDOW = 60
+
+# Cache scope of every product's list, bumped by full rebuilds; a refresh
+# bumps the 'product:<id>' scopes of the lists it recomputes.
+SCOPE = 'similar-products'
+
+
+def index_path():
+    return getattr(settings, 'SIMILARITY_INDEX_PATH', os.path.join(settings.BASE_DIR, 'similarity_index.npz'))
+
+
+def bucket(token):
+    """The (column, sign) a token hashes to; crc32 is stable across processes, unlike hash()."""
+    value = zlib.crc32(token.encode())
+    return value % DIM, 1.0 if value & (1 << 31) else -1.0
+
+
+def features(name, description, price):
+    """(token, weight) pairs describing a product."""
+    pairs = [(word, NAME_WEIGHT) for word in TOKEN_RE.findall((name or '').lower())]
+    pairs += [(word, 1.0) for word in TOKEN_RE.findall((description or '').lower())]
+    if price and price > 0:
+        band = math.floor(math.log(float(price), PRICE_BAND_RATIO))
+        # Neighbouring bands count half, so a price near a band edge still
+        # matches the products just across it.
+        pairs += [(f'price:{band}', 1.0), (f'price:{band - 1}', 0.5), (f'price:{band + 1}', 0.5)]
+    return pairs
+
+
+def term_matrix(documents):
+    """Signed hashed term weights, one float32 row per (name, description, price)."""
+    buckets = {}
+    rows, columns, values = [], [], []
+    for row, document in enumerate(documents):
+        for token, weight in features(*document):
+            if token not in buckets:
+                buckets[token] = bucket(token)
+            column, sign = buckets[token]
+            rows.append(row)
+            columns.append(column)
+            values.append(sign * weight)
+    matrix = np.zeros((len(documents), DIM), dtype=np.float32)
+    np.add.at(matrix, (rows, columns), values)
+    return matrix
+
+
+def weigh(terms, idf):
+    """TF-IDF rows scaled to unit length (rows with no terms stay zero)."""
+    vectors = terms * idf
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1)).astype(np.float16)
+
+
+def product_rows(products=None):
+    """(ids, classification ids, [(name, description, price)]) of `products`, by id."""
+    products = Product.objects.all() if products is None else products
+    rows = list(products.order_by('pk').values_list('pk', 'shop__classification_id', 'name', 'description', 'price'))
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    classifications = np.array([row[1] for row in rows], dtype=np.int64)
+    return ids, classifications, [row[2:] for row in rows]
+
+
+class SimilarityIndex:
+    """
+    Unit vectors of the products with ids `ids` (ascending), their
+    classifications, and the length and lowest score of their stored lists.
+    """
+
+    FIELDS = ['ids', 'classifications', 'vectors', 'idf', 'lengths', 'lowest']
+
+    def __init__(self, ids, classifications, vectors, idf, built_at, lengths=None, lowest=None):
+        self.ids = ids
+        self.classifications = classifications
+        self.vectors = vectors
+        self.idf = idf
+        self.built_at = built_at
+        self.lengths = np.zeros(len(ids), dtype=np.int8) if lengths is None else lengths
+        self.lowest = np.zeros(len(ids), dtype=np.float32) if lowest is None else lowest
+
+    @classmethod
+    def build(cls, built_at):
+        ids, classifications, documents = product_rows()
+        terms = term_matrix(documents)
+        frequency = np.count_nonzero(terms, axis=0)
+        idf = (np.log((1 + len(ids)) / (1 + frequency)) + 1).astype(np.float32)
+        return cls(ids, classifications, weigh(terms, idf), idf, built_at)
+
+    @classmethod
+    def load(cls, path):
+        """The saved index, or None if there is none (or it was made with other settings)."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if any(name not in data for name in cls.FIELDS) or data['vectors'].shape[1] != DIM:
+                return None
+            built_at = datetime.fromtimestamp(float(data['built_at']), tz=dt_timezone.utc)
+            return cls(data['ids'], data['classifications'], data['vectors'], data['idf'], built_at,
+                       data['lengths'], data['lowest'])
+
+    def save(self, path):
+        # Write and rename, so a crash never leaves a half-written file.
+        buffer = io.BytesIO()
+        np.savez(buffer, built_at=self.built_at.timestamp(), **{name: getattr(self, name) for name in self.FIELDS})
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as handle:
+            handle.write(buffer.getvalue())
+        os.replace(temporary, path)
+
+    def update(self, ids, classifications, documents, removed):
+        """Replace or add the rows of `ids` and drop those of `removed`."""
+        keep = ~np.isin(self.ids, np.concatenate([ids, removed]))
+        merged_ids = np.concatenate([self.ids[keep], ids])
+        order = np.argsort(merged_ids, kind='stable')
+        self.ids = merged_ids[order]
+        self.classifications = np.concatenate([self.classifications[keep], classifications])[order]
+        self.vectors = np.concatenate([self.vectors[keep], weigh(term_matrix(documents), self.idf)])[order]
+        self.lengths = np.concatenate([self.lengths[keep], np.zeros(len(ids), dtype=np.int8)])[order]
+        self.lowest = np.concatenate([self.lowest[keep], np.zeros(len(ids), dtype=np.float32)])[order]
+
+    def rows(self, ids):
+        return np.searchsorted(self.ids, ids)
+
+
+def score_tiles(index, vectors, block):
+    """
+    Yield (offset, scores) for the cosine scores of `vectors` against the
+    index rows `block`, TILE_SIZE block rows at a time; `offset` is the
+    first block position of the tile.
+    """
+    vectors = vectors.astype(np.float32)
+    for offset in range(0, len(block), TILE_SIZE):
+        tile = index.vectors[block[offset:offset + TILE_SIZE]].astype(np.float32)
+        yield offset, vectors @ tile.T
+
+
+def neighbor_rows(index, rows):
+    """
+    SimilarProduct rows (unsaved) for the index rows `rows`, compared
+    within their classification; records each list's length and lowest
+    score in the index.
+    """
+    results = []
+    for classification in np.unique(index.classifications[rows]):
+        block = np.flatnonzero(index.classifications == classification)
+        wanted = rows[index.classifications[rows] == classification]
+        count = min(TOP_K, len(block) - 1)
+        if count <= 0:
+            index.lengths[wanted] = 0
+            continue
+        for start in range(0, len(wanted), BATCH_SIZE):
+            batch = wanted[start:start + BATCH_SIZE]
+            own = np.searchsorted(block, batch)
+            # The best `count` block positions so far, merged with each tile in turn.
+            best_scores = np.full((len(batch), count), -np.inf, dtype=np.float32)
+            best = np.zeros((len(batch), count), dtype=np.int64)
+            for offset, scores in score_tiles(index, index.vectors[batch], block):
+                in_tile = (own >= offset) & (own < offset + scores.shape[1])
+                scores[np.flatnonzero(in_tile), own[in_tile] - offset] = -np.inf
+                candidates = np.concatenate([best_scores, scores], axis=1)
+                positions = np.concatenate([best, np.broadcast_to(
+                    np.arange(offset, offset + scores.shape[1]), scores.shape)], axis=1)
+                top = np.argpartition(candidates, -count, axis=1)[:, -count:]
+                best_scores = np.take_along_axis(candidates, top, axis=1)
+                best = np.take_along_axis(positions, top, axis=1)
+            for row, columns, values in zip(batch.tolist(), best, best_scores):
+                ranked = sorted(
+                    (pair for pair in zip(values.tolist(), index.ids[block[columns]].tolist()) if pair[0] >= MIN_SCORE),
+                    key=lambda pair: (-pair[0], pair[1]),
+                )
+                index.lengths[row] = len(ranked)
+                index.lowest[row] = ranked[-1][0] if ranked else 0
+                results.extend(
+                    SimilarProduct(product_id=int(index.ids[row]), similar_id=similar, score=score, rank=rank)
+                    for rank, (score, similar) in enumerate(ranked)
+                )
+    return results
+
+
+def affected_rows(index, changed, removed_vectors, removed_classifications):
+    """
+    Index rows whose lists may change when the products at rows `changed`
+    have new vectors and the removed ones are gone: the changed products,
+    those listing a changed product, and those a changed product now
+    beats, or a removed product leaves short.
+    """
+    listing = SimilarProduct.objects.filter(similar_id__in=index.ids[changed].tolist()).values_list('product_id', flat=True)
+    affected = np.zeros(len(index.ids), dtype=bool)
+    affected[changed] = True
+    affected[index.rows(np.array(list(listing), dtype=np.int64))] = True
+
+    # A list with room takes any product scoring MIN_SCORE; a full one only
+    # a product reaching its lowest score. The same test finds the full
+    # lists a removed product was in, whose rows the delete has cascaded.
+    vectors = np.concatenate([index.vectors[changed], removed_vectors])
+    classifications = np.concatenate([index.classifications[changed], removed_classifications])
+    for classification in np.unique(classifications):
+        block = np.flatnonzero(index.classifications == classification)
+        block_vectors = vectors[classifications == classification]
+        scores = np.full(len(block), -np.inf, dtype=np.float32)
+        for start in range(0, len(block_vectors), BATCH_SIZE):
+            for offset, tile_scores in score_tiles(index, block_vectors[start:start + BATCH_SIZE], block):
+                tile = scores[offset:offset + tile_scores.shape[1]]
+                np.maximum(tile, tile_scores.max(axis=0), out=tile)
+        # Allow for float rounding differing between matrix products.
+        reaches = (index.lengths[block] < TOP_K) | (scores >= index.lowest[block] - SCORE_TOLERANCE)
+        affected[block[(scores >= MIN_SCORE) & reaches]] = True
+    return np.flatnonzero(affected)
+
+
+def refresh_similar(full=False):
+    """
+    Bring the saved index and SimilarProduct up to date with the catalog,
+    rebuilding everything when `full` or when there is no index yet.
+    Returns the number of products whose lists were recomputed.
+    """
+    started = timezone.now()
+    path = index_path()
+    index = None if full else SimilarityIndex.load(path)
+    full = index is None
+    if full:
+        index = SimilarityIndex.build(started)
+        rows = np.arange(len(index.ids))
+    else:
+        current = np.array(list(Product.objects.values_list('pk', flat=True)), dtype=np.int64)
+        removed = np.setdiff1d(index.ids, current)
+        removed_rows = index.rows(removed)
+        removed_vectors, removed_classifications = index.vectors[removed_rows], index.classifications[removed_rows]
+        changed = Product.objects.filter(Q(updated_at__gte=index.built_at) | Q(shop__updated_at__gte=index.built_at))
+        ids, classifications, documents = product_rows(changed)
+        # Products missing from the index (say, from a restored database) count as changed.
+        missing = np.setdiff1d(current, np.concatenate([index.ids, ids]))
+        if len(missing):
+            extra = product_rows(Product.objects.filter(pk__in=missing.tolist()))
+            ids, classifications = np.concatenate([ids, extra[0]]), np.concatenate([classifications, extra[1]])
+            documents += extra[2]
+        index.update(ids, classifications, documents, removed)
+        index.built_at = started
+        rows = affected_rows(index, index.rows(ids), removed_vectors, removed_classifications)
+
+    similar = neighbor_rows(index, rows)
+    product_ids = index.ids[rows].tolist()
+    with transaction.atomic():
+        stale = SimilarProduct.objects.all()
+        if not full:
+            stale = stale.filter(product_id__in=product_ids)
+        stale.delete()
+        SimilarProduct.objects.bulk_create(similar, batch_size=1000)
+    index.save(path)
+    if full:
+        bump(SCOPE)
+    else:
+        bump(*[f'product:{pk}' for pk in product_ids])
+    return len(product_ids)
+
+
+def schedule_refresh():
+    """Queue one refresh at the end of the current REFRESH_WINDOW, shared by every change within it."""
+    now = time.time()
+    window = int(now // REFRESH_WINDOW)
+    return enqueue('similarity.refresh', key=f'similar-products:{window}',
+                   delay=timedelta(seconds=(window + 1) * REFRESH_WINDOW - now))
+
+
+@register_task('similarity.refresh')
+def refresh_task(payload):
+    refresh_similar()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Shop)
+def refresh_changed_similar(sender, instance, **kwargs):
+    schedule_refresh()
+
+
+def similar_products(product_id, limit=6):
+    """The available products most similar to `product_id`, best first: one indexed query."""
+    rows = (
+        SimilarProduct.objects
+        .filter(product_id=product_id, similar__is_available=True)
+        .select_related('similar')
+        .order_by('rank')[:limit]
+    )
+    return [row.similar for row in rows]
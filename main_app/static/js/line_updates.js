@@ -0,0 +1,126 @@
+/*
+ * In-place cart, budget and wishlist updates.
+ *
+ * Links and forms marked with data-json-action are sent with fetch() and
+ * an "Accept: application/json" header; the views answer with the changed
+ * line plus fresh totals (see wants_json() in views.py) and the page is
+ * patched instead of reloaded:
+ *
+ *   [data-line="<id>"]              the row of a line; removed when the line is
+ *     [data-line-quantity]          input or text showing its quantity
+ *     [data-line-total]             its price x quantity
+ *   [data-total="cart|spent|budget_products"]
+ *   [data-status="remaining|percentage"]   (data-status-of="cart" for the cart-only status)
+ *   [data-over-budget]              shown while over budget (data-status-of as above)
+ *   .progress-bar                   width follows status.percentage
+ *
+ * A "budget:updated" event carrying the response is dispatched on document.
+ */
+(function () {
+    function csrfToken() {
+        const match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+        return match ? decodeURIComponent(match[1]) : '';
+    }
+
+    function money(value) {
+        return parseFloat(value).toFixed(2);
+    }
+
+    function setText(selector, value) {
+        document.querySelectorAll(selector).forEach(function (el) {
+            el.textContent = value;
+        });
+    }
+
+    function applyLine(data) {
+        if (data.removed) {
+            document.querySelectorAll('[data-line="' + data.removed + '"]').forEach(function (row) {
+                row.remove();
+            });
+        }
+        const line = data.line;
+        if (!line) {
+            return;
+        }
+        document.querySelectorAll('[data-line="' + line.id + '"]').forEach(function (row) {
+            row.querySelectorAll('[data-line-quantity]').forEach(function (el) {
+                if ('value' in el) {
+                    el.value = line.quantity;
+                } else {
+                    el.textContent = line.quantity;
+                }
+            });
+            row.querySelectorAll('[data-line-total]').forEach(function (el) {
+                el.textContent = money(line.total);
+            });
+        });
+    }
+
+    function applyStatus(status, of) {
+        const scope = of ? '[data-status-of="' + of + '"]' : ':not([data-status-of])';
+        setText('[data-status="remaining"]' + scope, money(status.remaining));
+        setText('[data-status="percentage"]' + scope, Math.round(status.percentage));
+        document.querySelectorAll('[data-over-budget]' + scope).forEach(function (el) {
+            el.style.display = status.is_over_budget ? 'block' : 'none';
+        });
+        if (!of) {
+            document.querySelectorAll('.progress-bar').forEach(function (bar) {
+                bar.style.width = Math.min(status.percentage, 100) + '%';
+                bar.setAttribute('aria-valuenow', Math.round(status.percentage));
+            });
+        }
+    }
+
+    function apply(data) {
+        applyLine(data);
+        if (data.totals) {
+            Object.keys(data.totals).forEach(function (name) {
+                setText('[data-total="' + name + '"]', money(data.totals[name]));
+            });
+            applyStatus(data.status);
+            applyStatus(data.cart_status, 'cart');
+        }
+        document.dispatchEvent(new CustomEvent('budget:updated', {detail: data}));
+    }
+
+    function send(url, options) {
+        options.headers = Object.assign({'Accept': 'application/json'}, options.headers);
+        options.credentials = 'same-origin';
+        return fetch(url, options).then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        }).then(apply);
+    }
+
+    document.addEventListener('submit', function (event) {
+        const form = event.target.closest('form[data-json-action]');
+        if (!form) {
+            return;
+        }
+        event.preventDefault();
+        send(form.action, {
+            method: 'POST',
+            body: new FormData(form),
+            headers: {'X-CSRFToken': csrfToken()},
+        }).catch(function () {
+            form.submit();
+        });
+    });
+
+    document.addEventListener('click', function (event) {
+        const link = event.target.closest('a[data-json-action]');
+        if (!link) {
+            return;
+        }
+        event.preventDefault();
+        send(link.href, {method: 'GET'}).then(function () {
+            // Add links stay on the page; mark them as done.
+            link.classList.add('active');
+            link.setAttribute('aria-pressed', 'true');
+        }).catch(function () {
+            window.location = link.href;
+        });
+    });
+})();
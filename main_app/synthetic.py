@@ -0,0 +1,246 @@
+"""
+Synthetic catalog and shopper data at production scale.
+
+Everything is written with bulk_create in batches, so millions of rows take
+minutes rather than hours. Popularity is skewed the way real traffic is:
+a few classifications hold most shops, a few shops most products, and a
+few products collect most carts, wishlists and reviews (Zipf weights).
+
+bulk_create skips model signals, so the denormalized data those signals
+maintain (rating aggregates, search index, price statistics, catalog
+cache versions) is brought up to date at the end of generate().
+"""
+import itertools
+import random
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .catalog_cache import bump
+from .models import (
+    Classification, Shop, Product, Budget, SelectedProduct,
+    Cart, Wishlist, ProductReview, UserProfile, RATING_STARS,
+    ClassificationPriceStats, ShopPriceStats,
+)
+from . import search
+from .price_stats import refresh_price_stats
+from .recommendations import refresh_neighbors
+
+
+CATEGORY_WORDS = [
+    'Furniture', 'Tiles', 'Paints', 'Lighting', 'Curtains', 'Carpets', 'Doors', 'Windows',
+    'Garden', 'Bathroom', 'Kitchen', 'Flooring', 'Ceilings', 'Decor', 'Storage', 'Outdoor',
+]
+
+PRODUCT_WORDS = [
+    'Modern', 'Classic', 'Oak', 'Marble', 'Ceramic', 'Velvet', 'Linen', 'Brass', 'Matte',
+    'Glossy', 'Compact', 'Deluxe', 'Rustic', 'Nordic', 'Sofa', 'Chair', 'Table', 'Lamp',
+    'Rug', 'Tile', 'Paint', 'Curtain', 'Mirror', 'Shelf', 'Cabinet', 'Basin', 'Faucet',
+]
+
+# Reviews lean positive, as they do on real storefronts.
+RATING_WEIGHTS = [4, 5, 10, 30, 51]
+
+DEFAULTS = {
+    'classifications': 20,
+    'shops': 500,
+    'products': 50000,
+    'users': 5000,
+    'cart_items': 4,
+    'wishlist_items': 6,
+    'budget_items': 5,
+    'reviews': 3,
+}
+
+
+def zipf_cum_weights(n, exponent=1.1):
+    """Cumulative Zipf weights for n items, for random.choices(cum_weights=...)."""
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class Generator:
+    def __init__(self, batch_size=5000, seed=None, log=None):
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.tag = uuid.UUID(int=self.random.getrandbits(128)).hex[:6]
+        self.log = log or (lambda message: None)
+        self.counts = {}
+        self.cum_weights = {}
+
+    def insert(self, model, objects):
+        """bulk_create `objects` (any iterable) in batches; return the new primary keys."""
+        pks = []
+        started = time.perf_counter()
+        for batch in batched(objects, self.batch_size):
+            with transaction.atomic():
+                pks.extend(obj.pk for obj in model.objects.bulk_create(batch))
+        self.counts[model._meta.model_name] = self.counts.get(model._meta.model_name, 0) + len(pks)
+        self.log(f'{model.__name__}: {len(pks)} rows in {time.perf_counter() - started:.1f}s')
+        return pks
+
+    def skewed(self, population, k):
+        """k picks from `population`, the first items being the most popular."""
+        n = len(population)
+        if n not in self.cum_weights:
+            self.cum_weights[n] = zipf_cum_weights(n)
+        return self.random.choices(population, cum_weights=self.cum_weights[n], k=k)
+
+    def distinct_skewed(self, population, k):
+        """Up to k distinct skewed picks (fewer if the population is small)."""
+        k = min(k, len(population))
+        picked = set()
+        for _ in range(4):
+            picked.update(self.skewed(population, k - len(picked)))
+            if len(picked) >= k:
+                break
+        return list(picked)
+
+    def activity(self, mean):
+        """Per-user row count: geometric, so most users do little and a few do a lot."""
+        if mean <= 0:
+            return 0
+        return min(int(self.random.expovariate(1 / mean)), int(mean * 20))
+
+    def price(self):
+        return Decimal(f'{self.random.lognormvariate(4.2, 1.1):.2f}').min(Decimal('99999999.99'))
+
+    def classifications(self, n):
+        def rows():
+            for i in range(n):
+                name = f'{self.random.choice(CATEGORY_WORDS)} {self.tag}-{i}'
+                yield Classification(name=name, slug=f'synthetic-{self.tag}-{i}',
+                                     description=f'Synthetic classification {i}')
+        return self.insert(Classification, rows())
+
+    def shops(self, n, classification_ids):
+        def rows():
+            for i, classification_id in enumerate(self.skewed(classification_ids, n)):
+                yield Shop(
+                    name=f'Shop {self.tag}-{i}',
+                    classification_id=classification_id,
+                    description='Synthetic shop',
+                    phone=f'+973-{self.random.randint(10000000, 99999999)}',
+                    email=f'shop-{self.tag}-{i}@example.com',
+                    address=f'{self.random.randint(1, 999)} Road {self.random.randint(1, 4000)}, Manama',
+                )
+        return self.insert(Shop, rows())
+
+    def products(self, n, shop_ids):
+        def rows():
+            for i, shop_id in enumerate(self.skewed(shop_ids, n)):
+                words = self.random.sample(PRODUCT_WORDS, 3)
+                yield Product(
+                    shop_id=shop_id,
+                    name=f"{' '.join(words)} {i}",
+                    price=self.price(),
+                    description=f"{words[0]} {words[1].lower()} {words[2].lower()} for every room",
+                    is_available=self.random.random() < 0.9,
+                )
+        return self.insert(Product, rows())
+
+    def users(self, n):
+        # Hashing is the slow part of create_user; every synthetic user
+        # shares one hash of the password 'password'.
+        password = make_password('password')
+        user_ids = self.insert(User, (
+            User(username=f'user-{self.tag}-{i}', email=f'user-{self.tag}-{i}@example.com', password=password)
+            for i in range(n)
+        ))
+        self.insert(UserProfile, (UserProfile(user_id=user_id) for user_id in user_ids))
+        return user_ids
+
+    def budgets(self, user_ids):
+        return self.insert(Budget, (
+            Budget(user_id=user_id, total=Decimal(self.random.randrange(500, 50000, 50)))
+            for user_id in user_ids
+        ))
+
+    def user_lines(self, model, user_ids, product_ids, mean, build):
+        def rows():
+            for index, user_id in enumerate(user_ids):
+                for product_id in self.distinct_skewed(product_ids, self.activity(mean)):
+                    yield build(index, user_id, product_id)
+        return self.insert(model, rows())
+
+    def reviews(self, user_ids, product_ids, mean):
+        """Create reviews and return {product_id: [count per star]}."""
+        stars = {}
+
+        def build(index, user_id, product_id):
+            rating = self.random.choices(RATING_STARS, weights=RATING_WEIGHTS)[0]
+            stars.setdefault(product_id, [0] * 5)[rating - 1] += 1
+            return ProductReview(user_id=user_id, product_id=product_id, rating=rating,
+                                 comment=self.random.choice(['Great quality', 'As described', 'Fast delivery', '']))
+
+        self.user_lines(ProductReview, user_ids, product_ids, mean, build)
+        return stars
+
+    def apply_ratings(self, stars):
+        """Write the rating aggregates the review signals would have maintained."""
+        fields = ['rating_count', 'rating_sum', 'rating_avg'] + [f'rating_{n}' for n in RATING_STARS]
+
+        def rows():
+            for product_id, counts in stars.items():
+                product = Product(pk=product_id)
+                product.rating_count = sum(counts)
+                product.rating_sum = sum(n * count for n, count in zip(RATING_STARS, counts))
+                product.rating_avg = product.rating_sum / product.rating_count
+                for n, count in zip(RATING_STARS, counts):
+                    setattr(product, f'rating_{n}', count)
+                yield product
+
+        for batch in batched(rows(), self.batch_size):
+            with transaction.atomic():
+                Product.objects.bulk_update(batch, fields)
+
+
+def generate(options=None, batch_size=5000, seed=None, log=None):
+    """
+    Create a synthetic data set sized by `options` (see DEFAULTS) and
+    return {model_name: rows created}.
+    """
+    options = {**DEFAULTS, **(options or {})}
+    gen = Generator(batch_size=batch_size, seed=seed, log=log)
+
+    classification_ids = gen.classifications(options['classifications'])
+    shop_ids = gen.shops(options['shops'], classification_ids)
+    product_ids = gen.products(options['products'], shop_ids)
+    # Shuffle so popularity is not correlated with insertion order (and shop).
+    gen.random.shuffle(product_ids)
+
+    user_ids = gen.users(options['users'])
+    budget_ids = gen.budgets(user_ids)
+
+    gen.user_lines(Cart, user_ids, product_ids, options['cart_items'],
+                   lambda i, user_id, product_id: Cart(user_id=user_id, product_id=product_id,
+                                                       quantity=gen.random.randint(1, 3)))
+    gen.user_lines(Wishlist, user_ids, product_ids, options['wishlist_items'],
+                   lambda i, user_id, product_id: Wishlist(user_id=user_id, product_id=product_id))
+    gen.user_lines(SelectedProduct, user_ids, product_ids, options['budget_items'],
+                   lambda i, user_id, product_id: SelectedProduct(budget_id=budget_ids[i], user_id=user_id,
+                                                                  product_id=product_id,
+                                                                  quantity=gen.random.randint(1, 4)))
+    gen.apply_ratings(gen.reviews(user_ids, product_ids, options['reviews']))
+
+    started = time.perf_counter()
+    search.rebuild_index()
+    gen.log(f'Search index rebuilt in {time.perf_counter() - started:.1f}s')
+    started = time.perf_counter()
+    refresh_price_stats(ShopPriceStats)
+    refresh_price_stats(ClassificationPriceStats)
+    gen.log(f'Price statistics rebuilt in {time.perf_counter() - started:.1f}s')
+    started = time.perf_counter()
+    refresh_neighbors()
+    gen.log(f'Recommendations rebuilt in {time.perf_counter() - started:.1f}s')
+    bump('catalog')
+    return gen.counts
@@ -0,0 +1,218 @@
+"""
+Database-backed background tasks.
+
+Work is queued as `Task` rows and run by `manage.py run_worker`, which
+claims due rows with a conditional UPDATE (so several workers can share
+the table without a broker) and runs them on a thread or process pool.
+Failed tasks are retried with exponential backoff until `max_attempts`.
+While a task runs, its worker refreshes the row's `locked_at` every
+HEARTBEAT_SECONDS; a row not refreshed for STALE_AFTER belongs to a dead
+worker and is queued again, however long the task itself takes.
+
+Handlers are registered by name:
+
+    @register_task('images.generate_variants')
+    def generate(payload):
+        ...
+
+    enqueue('images.generate_variants', {'pk': 1}, key='variants:1')
+"""
+import logging
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from .models import Task
+
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+RETRY_BASE_SECONDS = 10
+
+# A running task whose lock has not been refreshed this long is assumed dead.
+STALE_AFTER = timedelta(minutes=15)
+
+# How often a worker refreshes the locks of the tasks it is running.
+HEARTBEAT_SECONDS = 60
+
+
+def register_task(name):
+    def decorator(func):
+        HANDLERS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, key=None, delay=None, max_attempts=5):
+    """
+    Queue `name` to run with `payload` (JSON-serialisable) and return the Task.
+
+    With an idempotency `key`, enqueuing the same key again returns the
+    existing task instead of queuing another. With TASKS_EAGER set, the
+    handler runs inline and nothing is stored.
+    """
+    if name not in HANDLERS:
+        raise ValueError(f"Unknown task: {name}")
+    payload = payload or {}
+
+    if getattr(settings, 'TASKS_EAGER', False):
+        HANDLERS[name](payload)
+        return None
+
+    fields = {
+        'name': name,
+        'payload': payload,
+        'max_attempts': max_attempts,
+        'run_after': timezone.now() + (delay or timedelta(0)),
+    }
+    if key is None:
+        return Task.objects.create(**fields)
+    task, created = Task.objects.get_or_create(idempotency_key=key, defaults=fields)
+    return task
+
+
+def enqueue_many(name, jobs, delay=None, max_attempts=5):
+    """
+    Queue `name` once per (payload, key) in `jobs` with a single INSERT.
+
+    Keys that are already queued are skipped, as with enqueue(). Returns
+    the number of jobs submitted.
+    """
+    if name not in HANDLERS:
+        raise ValueError(f"Unknown task: {name}")
+    jobs = list(jobs)
+
+    if getattr(settings, 'TASKS_EAGER', False):
+        for payload, key in jobs:
+            HANDLERS[name](payload or {})
+        return len(jobs)
+
+    run_after = timezone.now() + (delay or timedelta(0))
+    Task.objects.bulk_create(
+        [Task(name=name, payload=payload or {}, idempotency_key=key, max_attempts=max_attempts, run_after=run_after)
+         for payload, key in jobs],
+        ignore_conflicts=True,
+    )
+    return len(jobs)
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_tasks(limit, owner):
+    """Mark up to `limit` due tasks as running for `owner` and return their ids."""
+    now = timezone.now()
+    Task.objects.filter(status=Task.RUNNING, locked_at__lt=now - STALE_AFTER).update(
+        status=Task.PENDING, locked_by='', locked_at=None
+    )
+    candidates = Task.objects.filter(status=Task.PENDING, run_after__lte=now).order_by('run_after', 'pk')
+    claimed = []
+    for pk in candidates.values_list('pk', flat=True)[:limit * 2]:
+        # Another worker may win the race for the same row; the status
+        # condition makes the UPDATE a no-op for the loser.
+        if Task.objects.filter(pk=pk, status=Task.PENDING).update(
+            status=Task.RUNNING, locked_by=owner, locked_at=now
+        ):
+            claimed.append(pk)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+def heartbeat(task_ids, owner):
+    """Refresh the locks of `owner`'s running `task_ids`, so claim_tasks() does not take them back."""
+    return Task.objects.filter(pk__in=task_ids, status=Task.RUNNING, locked_by=owner).update(
+        locked_at=timezone.now()
+    )
+
+
+def execute_task(task_id):
+    """Run one claimed task and record the outcome. Returns the final status."""
+    task = Task.objects.get(pk=task_id)
+    try:
+        HANDLERS[task.name](task.payload)
+    except Exception:
+        task.attempts += 1
+        task.last_error = traceback.format_exc()
+        task.locked_by = ''
+        task.locked_at = None
+        if task.attempts >= task.max_attempts:
+            task.status = Task.FAILED
+            task.finished_at = timezone.now()
+            logger.error("Task %s failed permanently", task)
+        else:
+            task.status = Task.PENDING
+            task.run_after = timezone.now() + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (task.attempts - 1))
+            logger.warning("Task %s failed, retry %s scheduled", task, task.attempts)
+    else:
+        task.attempts += 1
+        task.status = Task.DONE
+        task.finished_at = timezone.now()
+        task.last_error = ''
+    task.save()
+    return task.status
+
+
+def execute_in_pool(task_id):
+    """execute_task() for pool threads/processes, which manage their own connections."""
+    close_old_connections()
+    try:
+        return execute_task(task_id)
+    except Exception:
+        logger.exception("Task %s could not be recorded", task_id)
+    finally:
+        close_old_connections()
+
+
+def run_worker(concurrency=4, use_processes=False, poll_interval=1.0, once=False):
+    """
+    Claim and run tasks until interrupted.
+
+    With `once`, return as soon as no due tasks are left. Returns the number
+    of tasks run.
+    """
+    owner = worker_id()
+    if use_processes:
+        # Forked children must not share the parent's database connections.
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=concurrency)
+    else:
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='task')
+
+    running = {}  # future -> task id
+    completed = 0
+    last_beat = time.monotonic()
+    try:
+        with executor:
+            while True:
+                for future in [f for f in running if f.done()]:
+                    del running[future]
+                    completed += 1
+                    future.result()
+
+                if running and time.monotonic() - last_beat >= HEARTBEAT_SECONDS:
+                    heartbeat(list(running.values()), owner)
+                    last_beat = time.monotonic()
+
+                free = concurrency - len(running)
+                claimed = claim_tasks(free, owner) if free else []
+                for task_id in claimed:
+                    running[executor.submit(execute_in_pool, task_id)] = task_id
+
+                if once and not claimed and not running:
+                    return completed
+                if not claimed:
+                    time.sleep(poll_interval if not running else min(poll_interval, 0.05))
+    except KeyboardInterrupt:
+        logger.info("Worker %s stopping", owner)
+    return completed
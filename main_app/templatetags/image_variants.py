@@ -0,0 +1,51 @@
+from django import template
+from django.utils.html import format_html
+
+from main_app.images import DENSITIES, PRESETS, has_variants, variant_name
+
+register = template.Library()
+
+
+def _srcset(fieldfile, preset, fmt):
+    return ', '.join(
+        f'{fieldfile.storage.url(variant_name(fieldfile.name, preset, density, fmt))} {density}x'
+        for density in DENSITIES
+    )
+
+@register.simple_tag
+def image_srcset(fieldfile, preset, fmt='webp'):
+    """srcset value for a preset, or an empty string if it has not been generated."""
+    if not has_variants(fieldfile):
+        return ''
+    return _srcset(fieldfile, preset, fmt)
+
+@register.simple_tag
+def image_variant_url(fieldfile, preset, fmt='jpg'):
+    """URL of the 1x rendering of a preset, falling back to the original upload."""
+    if not fieldfile:
+        return ''
+    if not has_variants(fieldfile):
+        return fieldfile.url
+    return fieldfile.storage.url(variant_name(fieldfile.name, preset, 1, fmt))
+
+@register.simple_tag
+def picture(fieldfile, preset, alt='', css_class='', style=''):
+    """<picture> with WebP and JPEG srcsets for a preset, or a plain <img> of the original."""
+    if not fieldfile:
+        return ''
+    if not has_variants(fieldfile):
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" style="{}" loading="lazy">',
+            fieldfile.url, alt, css_class, style,
+        )
+    width, height = PRESETS[preset]
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}">'
+        '<img src="{}" srcset="{}" width="{}" height="{}" alt="{}" class="{}" style="{}" loading="lazy">'
+        '</picture>',
+        _srcset(fieldfile, preset, 'webp'),
+        fieldfile.storage.url(variant_name(fieldfile.name, preset, 1, 'jpg')),
+        _srcset(fieldfile, preset, 'jpg'),
+        width, height, alt, css_class, style,
+    )
@@ -0,0 +1,83 @@
+"""
+Test helpers built on QueryInstrumentationMiddleware, and on the
+database's own query plans.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections
+
+# Plan lines that read a whole table: SQLite's "SCAN <table>" (SEARCH is an
+# index lookup) and PostgreSQL's "Seq Scan on <table>".
+FULL_SCAN_PATTERNS = [
+    re.compile(r'\bSCAN (?P<table>\w+)'),
+    re.compile(r'\bSeq Scan on (?P<table>\w+)'),
+]
+# Plan lines that sort the result rather than reading it in index order.
+SORT_PATTERNS = [
+    re.compile(r'\bUSE TEMP B-TREE FOR (?:ORDER BY|RIGHT PART OF ORDER BY)'),
+    re.compile(r'^\W*(?:Incremental )?Sort\b'),
+]
+
+
+class QueryBudgetMixin:
+    """
+    Mixin for TestCase classes that pins the number of queries per URL.
+
+        self.assertQueryBudget(reverse('cart'), 6)
+
+    fails when the page runs more than `budget` queries or shows an N+1
+    pattern, and lists the offending SQL in the failure message.
+    """
+
+    def assertQueryBudget(self, url, budget, allow_n_plus_one=False, **kwargs):
+        response = self.client.get(url, **kwargs)
+        self.assertLess(response.status_code, 400, f"GET {url} returned {response.status_code}")
+        profile = response.query_profile
+
+        if profile.query_count > budget:
+            listing = '\n'.join(sql for sql, params, duration in profile.queries)
+            self.fail(f"GET {url} ran {profile.query_count} queries, budget is {budget}:\n{listing}")
+        if not allow_n_plus_one:
+            offenders = profile.n_plus_one()
+            if offenders:
+                listing = '\n'.join(f'{count} x {sql}' for sql, count in offenders.items())
+                self.fail(f"GET {url} has N+1 queries:\n{listing}")
+        return response
+
+
+def table_rows(table, using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'SELECT COUNT(*) FROM {connections[using].ops.quote_name(table)}')
+        return cursor.fetchone()[0]
+
+
+class QueryPlanMixin:
+    """
+    Mixin for TestCase classes that checks the plan the database picks
+    for a queryset.
+
+        self.assertNoFullScan(Cart.objects.filter(user=user))
+
+    fails when the plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on
+    PostgreSQL) reads a whole table holding QUERY_PLAN_SCAN_MIN_ROWS rows
+    or more; smaller tables may be scanned, as planners rightly do. With
+    `ordered=True` it also fails when the rows are sorted rather than read
+    in index order. Run ANALYZE after loading the test data so the planner
+    sees realistic table sizes.
+    """
+
+    def assertNoFullScan(self, queryset, ordered=False):
+        plan = queryset.explain()
+        min_rows = settings.QUERY_PLAN_SCAN_MIN_ROWS
+        tables = set(connections[queryset.db].introspection.table_names())
+        problems = []
+        for line in plan.splitlines():
+            for pattern in FULL_SCAN_PATTERNS:
+                match = pattern.search(line)
+                if match and match['table'] in tables and table_rows(match['table'], queryset.db) >= min_rows:
+                    problems.append(f"full scan of {match['table']}")
+            if ordered and any(pattern.search(line) for pattern in SORT_PATTERNS):
+                problems.append('sort instead of index order')
+        if problems:
+            self.fail(f"{', '.join(problems)}:\n{queryset.query}\n{plan}")
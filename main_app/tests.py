@@ -1,11 +1,15 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User
 from main_app.models import (
     Classification, Shop, Product, Budget, SelectedProduct,
-    Cart, Wishlist, ProductReview, BudgetEstimate, UserProfile
+    Cart, Wishlist, ProductReview, BudgetEstimate, UserProfile, Task
 )
 from datetime import date, datetime
 from decimal import Decimal
+from io import StringIO
+import json
+import os
+from main_app.testing import QueryBudgetMixin, QueryPlanMixin
 
 class ModelsTest(TestCase):
     def setUp(self):
@@ -204,3 +208,1779 @@ class ModelsTest(TestCase):
         
         
         self.assertEqual(Shop.objects.filter(id__in=shop_ids).count(), 0)
+
+
+class BudgetSummaryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='planner', password='12345')
+        self.client.login(username='planner', password='12345')
+        classification = Classification.objects.create(name='Lighting')
+        shop = Shop.objects.create(name='Lamp Shop', classification=classification)
+        self.budget = Budget.objects.create(user=self.user, total=Decimal('100.00'))
+        self.products = [
+            Product.objects.create(shop=shop, name=f'Lamp {i}', price=Decimal('2.50'))
+            for i in range(20)
+        ]
+
+    def add_lines(self, count, start=0):
+        for product in self.products[start:start + count]:
+            SelectedProduct.objects.create(budget=self.budget, product=product, user=self.user, quantity=2)
+            Cart.objects.create(user=self.user, product=product, quantity=1)
+
+    def test_totals_and_status(self):
+        """Test that line totals, cart total and budget usage are computed in SQL"""
+        from main_app.budget import BudgetSummary
+        self.add_lines(4)
+        summary = BudgetSummary(self.user)
+        self.assertEqual(summary.budget, self.budget)
+        self.assertEqual(summary.budget_products_total, Decimal('20.00'))
+        self.assertEqual(summary.cart_total, Decimal('10.00'))
+        self.assertEqual(summary.total_spent, Decimal('30.00'))
+        self.assertEqual(summary.status.remaining, Decimal('70.00'))
+        self.assertEqual(summary.status.percentage, Decimal('30'))
+        self.assertFalse(summary.status.is_near_budget)
+        self.assertEqual([sp.total_price for sp in summary.selected_products], [Decimal('5.00')] * 4)
+
+    def test_over_budget(self):
+        """Test that the over-budget and near-budget flags follow the spend"""
+        from main_app.budget import BudgetStatus
+        status = BudgetStatus(Decimal('120'), Decimal('100'))
+        self.assertTrue(status.is_over_budget)
+        self.assertTrue(status.is_near_budget)
+        self.assertEqual(status.over_budget_amount, Decimal('20'))
+        self.assertFalse(BudgetStatus(Decimal('5'), Decimal('0')).is_over_budget)
+
+    def test_budget_and_cart_views_use_constant_queries(self):
+        """Test that the budget and cart pages do not issue a query per line item"""
+        # The cart page reads its "frequently planned together" products once.
+        self.add_lines(2)
+        with self.assertNumQueries(9):
+            self.client.get('/budget/')
+        with self.assertNumQueries(7):
+            self.client.get('/cart/')
+
+        self.add_lines(18, start=2)
+        with self.assertNumQueries(9):
+            response = self.client.get('/budget/')
+        self.assertEqual(response.context['total_spent'], Decimal('150.00'))
+        with self.assertNumQueries(7):
+            self.client.get('/cart/')
+
+
+class ProductRatingAggregatesTest(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'reviewer{i}', password='12345') for i in range(3)]
+        classification = Classification.objects.create(name='Paints')
+        shop = Shop.objects.create(name='Paint Shop', classification=classification)
+        self.product = Product.objects.create(shop=shop, name='Primer', price=Decimal('5.00'))
+
+    def review(self, user, rating):
+        return ProductReview.objects.create(user=user, product=self.product, rating=rating)
+
+    def test_aggregates_follow_add_edit_delete(self):
+        """Test that rating count, sum and histogram track review changes"""
+        first = self.review(self.users[0], 5)
+        self.review(self.users[1], 3)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum), (2, 8))
+        self.assertEqual(self.product.avg_rating, 4)
+
+        first.rating = 1
+        first.save()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum), (2, 4))
+        self.assertEqual((self.product.rating_1, self.product.rating_3, self.product.rating_5), (1, 1, 0))
+
+        first.delete()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum, self.product.rating_1), (1, 3, 0))
+        self.assertEqual(self.product.rating_histogram[2], (3, 1, 100))
+
+    def test_rebuild_command(self):
+        """Test that rebuild_ratings restores aggregates that drifted"""
+        from django.core.management import call_command
+        self.review(self.users[0], 4)
+        self.review(self.users[1], 2)
+        Product.objects.filter(pk=self.product.pk).update(rating_count=0, rating_sum=0, rating_4=7)
+        call_command('rebuild_ratings', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum), (2, 6))
+        self.assertEqual((self.product.rating_2, self.product.rating_4), (1, 1))
+
+    def test_rebuild_bumps_changed_products_after_commit(self):
+        """Test that a rebuild marks changed products updated and bumps their scopes once it commits"""
+        from django.core.cache import cache
+        from django.core.management import call_command
+        from main_app.catalog_cache import version_key
+        self.review(self.users[0], 4)
+        Product.objects.filter(pk=self.product.pk).update(rating_count=0, rating_sum=0)
+        self.product.refresh_from_db()
+        stamped = self.product.updated_at
+        keys = [version_key(f'product:{self.product.pk}'), version_key(f'shop:{self.product.shop_id}'),
+                version_key(f'classification:{self.product.shop.classification_id}')]
+        before = cache.get_many(keys)
+        with self.captureOnCommitCallbacks() as callbacks:
+            call_command('rebuild_ratings', stdout=StringIO())
+        self.assertEqual(cache.get_many(keys), before)
+        for callback in callbacks:
+            callback()
+        after = cache.get_many(keys)
+        self.assertEqual(len(after), 3)
+        self.assertTrue(all(after[key] != before.get(key) for key in keys))
+        self.product.refresh_from_db()
+        self.assertGreater(self.product.updated_at, stamped)
+
+
+class ProductReviewPageTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='12345')
+        self.client.login(username='reader', password='12345')
+        classification = Classification.objects.create(name='Rugs')
+        shop = Shop.objects.create(name='Rug Room', classification=classification)
+        self.product = Product.objects.create(shop=shop, name='Wool Rug', price=Decimal('90.00'))
+        for i in range(25):
+            reviewer = User.objects.create(username=f'critic{i}', password='!')
+            ProductReview.objects.create(user=reviewer, product=self.product, rating=i % 5 + 1,
+                                         comment=f'Review {i}', helpful_count=i % 7)
+
+    def pages(self, sort):
+        url = f'/product-reviews/{self.product.id}/'
+        response = self.client.get(url, {'sort': sort})
+        reviews = list(response.context['reviews'])
+        while response.context['page'].next_cursor:
+            response = self.client.get(url, {'sort': sort, 'cursor': response.context['page'].next_cursor})
+            reviews += response.context['reviews']
+        return reviews
+
+    def test_sorts_page_through_every_review(self):
+        """Test that each sort pages through all reviews once, in order"""
+        from main_app.views import REVIEW_PAGE_SIZE
+        response = self.client.get(f'/product-reviews/{self.product.id}/')
+        self.assertEqual(len(response.context['reviews']), REVIEW_PAGE_SIZE)
+        self.assertEqual(response.context['rating_histogram'][0], (5, 5, 20))
+        keys = {
+            'newest': lambda review: (review.created_at, review.pk),
+            'highest': lambda review: (review.rating, review.pk),
+            'helpful': lambda review: (review.helpful_count, review.pk),
+        }
+        for sort, key in keys.items():
+            with self.subTest(sort=sort):
+                reviews = self.pages(sort)
+                self.assertEqual(len({review.pk for review in reviews}), 25)
+                self.assertEqual(reviews, sorted(reviews, key=key, reverse=True))
+        lowest = self.pages('lowest')
+        self.assertEqual(lowest, sorted(lowest, key=lambda review: (review.rating, review.pk)))
+
+    def test_reviews_page_has_no_n_plus_one(self):
+        """Test that review authors and their profiles load with the reviews"""
+        self.assertQueryBudget(f'/product-reviews/{self.product.id}/', 7)
+
+    def test_helpful_votes_count_once(self):
+        """Test that a user's helpful vote counts once and never on their own review"""
+        review = ProductReview.objects.filter(product=self.product).first()
+        url = f'/review/{review.id}/helpful/'
+        response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), {'review_id': review.id, 'helpful_count': review.helpful_count + 1,
+                                           'voted': True})
+        response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['helpful_count'], review.helpful_count + 1)
+        self.assertFalse(response.json()['voted'])
+
+        own = ProductReview.objects.create(user=self.user, product=self.product, rating=4)
+        self.client.post(f'/review/{own.id}/helpful/')
+        own.refresh_from_db()
+        self.assertEqual(own.helpful_count, 0)
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+
+class CatalogSearchTest(TestCase):
+    def setUp(self):
+        self.classification = Classification.objects.create(name='Lighting & Fixtures')
+        self.shop = Shop.objects.create(
+            name='Bright Lights Co.', classification=self.classification,
+            description='Modern lighting solutions'
+        )
+        self.lamp = Product.objects.create(
+            shop=self.shop, name='Table Lamp', price=Decimal('75.00'),
+            description='Stylish lamp with USB charging port'
+        )
+        self.chandelier = Product.objects.create(
+            shop=self.shop, name='LED Chandelier', price=Decimal('300.00'),
+            description='Modern chandelier with a dimmer, pairs with any lamp'
+        )
+
+    def search(self, query, **kwargs):
+        from main_app.search import search_catalog
+        return [(r.kind, r.object) for r in search_catalog(query, **kwargs).results]
+
+    def test_ranked_results_across_kinds(self):
+        """Test that title matches outrank description matches and all kinds are searched"""
+        self.assertEqual(self.search('lamp')[:2], [('product', self.lamp), ('product', self.chandelier)])
+        self.assertIn(('shop', self.shop), self.search('modern'))
+        self.assertEqual(self.search('fixtures'), [('classification', self.classification)])
+        self.assertEqual(self.search('chand'), [('product', self.chandelier)])
+
+    def test_index_follows_saves_and_deletes(self):
+        """Test that the index is kept in sync by model signals"""
+        self.lamp.name = 'Floor Standard'
+        self.lamp.save()
+        self.assertEqual(self.search('standard'), [('product', self.lamp)])
+        self.lamp.delete()
+        self.assertEqual(self.search('standard'), [])
+
+    def test_pagination_and_view(self):
+        """Test that the search endpoint pages through results"""
+        from main_app.search import search_catalog
+        page = search_catalog('modern', per_page=1)
+        self.assertTrue(page.has_next)
+        self.assertFalse(search_catalog('modern', page=2, per_page=1).has_next)
+
+        response = self.client.get('/search/', {'q': 'table lamp'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Table Lamp')
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        classification = Classification.objects.create(name='Tiles')
+        self.shop = Shop.objects.create(name='Tile Masters', classification=classification)
+        Product.objects.bulk_create([
+            Product(shop=self.shop, name=f'Tile {i:02d}', price=Decimal(10 + i % 4), rating_avg=i % 3)
+            for i in range(25)
+        ])
+
+    def walk(self, ordering, per_page=4):
+        from main_app.pagination import KeysetPaginator
+        paginator = KeysetPaginator(Product.objects.filter(shop=self.shop), ordering, per_page=per_page)
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append(page)
+            if not page.next_cursor:
+                return paginator, pages
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_row_in_order(self):
+        """Test that walking the cursors visits every product once, in sort order"""
+        for ordering in [('price', 'pk'), ('-price', '-pk'), ('name', 'pk'), ('-pk',), ('-rating_avg', '-pk')]:
+            paginator, pages = self.walk(ordering)
+            seen = [p.pk for page in pages for p in page.object_list]
+            expected = list(Product.objects.filter(shop=self.shop).order_by(*ordering).values_list('pk', flat=True))
+            self.assertEqual(seen, expected, ordering)
+
+    def test_previous_cursor_returns_prior_page(self):
+        """Test that a previous-page cursor gives back the page before it"""
+        paginator, pages = self.walk(('price', 'pk'))
+        for before, after in zip(pages, pages[1:]):
+            self.assertEqual(paginator.page(after.previous_cursor).object_list, before.object_list)
+        self.assertIsNone(pages[0].previous_cursor)
+        self.assertEqual(paginator.page('garbage').object_list, pages[0].object_list)
+
+    def test_listing_view_pages(self):
+        """Test that the shop page is sortable and costs the same on every page"""
+        User.objects.create_user(username='browser', password='12345')
+        self.client.login(username='browser', password='12345')
+        url = f'/shop/{self.shop.id}/'
+        first = self.client.get(url, {'sort': 'price_desc'})
+        self.assertEqual(len(first.context['products']), 24)
+        self.assertEqual(first.context['products'][0].price, Decimal('13'))
+        # The shop itself is served from the catalog cache on the second page.
+        with self.assertNumQueries(4):
+            second = self.client.get(url, {'sort': 'price_desc', 'cursor': first.context['page'].next_cursor})
+        self.assertEqual(len(second.context['products']), 1)
+
+
+class ImageVariantsTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        classification = Classification.objects.create(name='Furniture')
+        self.shop = Shop.objects.create(name='Sofa Shop', classification=classification)
+
+    def tearDown(self):
+        import shutil
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, name='sofa.png', size=(1600, 1200)):
+        from io import BytesIO
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buffer = BytesIO()
+        Image.new('RGBA', size, (200, 120, 40, 255)).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def run_queued_tasks(self):
+        from main_app.tasks import claim_tasks, execute_task
+        for task_id in claim_tasks(100, 'test'):
+            execute_task(task_id)
+
+    def test_variants_generated_on_save(self):
+        """Test that saving an image queues a task that writes every preset, density and format"""
+        from PIL import Image
+        from main_app.images import variant_name
+        product = Product.objects.create(shop=self.shop, name='Sofa', price=Decimal('10'), image=self.upload())
+        self.assertFalse(product.image.storage.exists(variant_name(product.image.name, 'card')))
+        self.run_queued_tasks()
+        storage = product.image.storage
+        for preset, size in [('card', (400, 250)), ('thumb', (80, 80))]:
+            for density in (1, 2):
+                for fmt in ('webp', 'jpg'):
+                    name = variant_name(product.image.name, preset, density, fmt)
+                    self.assertTrue(storage.exists(name), name)
+            with storage.open(variant_name(product.image.name, preset, 2, 'webp')) as f:
+                self.assertEqual(Image.open(f).size, (size[0] * 2, size[1] * 2))
+
+    def test_picture_tag(self):
+        """Test that the picture tag emits srcsets, and the original when variants are missing"""
+        from django.template import Context, Template
+        from unittest import mock
+        from django.core.files.storage import FileSystemStorage
+        product = Product.objects.create(shop=self.shop, name='Sofa', price=Decimal('10'), image=self.upload())
+        template = Template("{% load image_variants %}{% picture product.image 'card' alt=product.name %}")
+        self.assertNotIn('<picture>', template.render(Context({'product': product})))
+        self.run_queued_tasks()
+        product.refresh_from_db()
+        self.assertEqual(product.image_variants, product.image.name)
+        # The tags read the flag the task recorded, never the storage.
+        with mock.patch.object(FileSystemStorage, 'exists', side_effect=AssertionError('storage call')):
+            html = template.render(Context({'product': product}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('card-2x.webp 2x', html)
+
+        Product.objects.filter(pk=product.pk).update(image='product_images/missing.png')
+        product.refresh_from_db()
+        html = template.render(Context({'product': product}))
+        self.assertIn('src="/media/product_images/missing.png"', html)
+        self.assertNotIn('<picture>', html)
+
+
+class TaskQueueTest(TestCase):
+    def setUp(self):
+        from main_app.tasks import HANDLERS
+        self.calls = []
+        self.failures_left = 0
+
+        def record(payload):
+            if self.failures_left:
+                self.failures_left -= 1
+                raise RuntimeError('boom')
+            self.calls.append(payload)
+
+        HANDLERS['test.record'] = record
+        self.addCleanup(HANDLERS.pop, 'test.record')
+
+    def run_due(self):
+        from main_app.tasks import claim_tasks, execute_task
+        return [execute_task(task_id) for task_id in claim_tasks(10, 'test')]
+
+    def test_idempotency_key(self):
+        """Test that enqueuing the same key twice stores and runs one task"""
+        from main_app.tasks import enqueue
+        first = enqueue('test.record', {'n': 1}, key='record:1')
+        second = enqueue('test.record', {'n': 2}, key='record:1')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(self.run_due(), [Task.DONE])
+        self.assertEqual(self.calls, [{'n': 1}])
+        self.assertEqual(self.run_due(), [])
+
+    def test_retries_then_fails(self):
+        """Test that a failing task is retried with backoff and then marked failed"""
+        from django.utils import timezone
+        from main_app.tasks import enqueue
+        task = enqueue('test.record', {'n': 1}, max_attempts=2)
+        self.failures_left = 2
+        self.assertEqual(self.run_due(), [Task.PENDING])
+        task.refresh_from_db()
+        self.assertGreater(task.run_after, timezone.now())
+        self.assertEqual(self.run_due(), [])
+
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        self.assertEqual(self.run_due(), [Task.FAILED])
+        task.refresh_from_db()
+        self.assertIn('RuntimeError', task.last_error)
+        self.assertEqual(task.attempts, 2)
+
+    def test_unknown_task(self):
+        """Test that enqueuing an unregistered task name is rejected"""
+        from main_app.tasks import enqueue
+        with self.assertRaises(ValueError):
+            enqueue('test.missing')
+
+
+class TaskHeartbeatTest(TransactionTestCase):
+    def test_long_running_task_keeps_its_lock(self):
+        """Test that a task running past STALE_AFTER is not handed to another worker"""
+        import time
+        from datetime import timedelta
+        from unittest import mock
+        from main_app import tasks
+        seen = {}
+
+        def slow(payload):
+            time.sleep(0.6)
+            # Another worker polling now must not take the task over.
+            seen['reclaimed'] = tasks.claim_tasks(1, 'other')
+
+        tasks.HANDLERS['test.slow'] = slow
+        self.addCleanup(tasks.HANDLERS.pop, 'test.slow')
+        task = tasks.enqueue('test.slow')
+        with mock.patch.object(tasks, 'STALE_AFTER', timedelta(seconds=0.3)), \
+                mock.patch.object(tasks, 'HEARTBEAT_SECONDS', 0.05):
+            self.assertEqual(tasks.run_worker(concurrency=1, poll_interval=0.01, once=True), 1)
+        self.assertEqual(seen['reclaimed'], [])
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.DONE, 1))
+
+
+class CatalogCacheTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        User.objects.create_user(username='visitor', password='12345')
+        self.client.login(username='visitor', password='12345')
+        self.classification = Classification.objects.create(name='Paints')
+        self.shop = Shop.objects.create(name='Color World', classification=self.classification)
+        self.product = Product.objects.create(shop=self.shop, name='Primer', price=Decimal('25.00'))
+
+    def test_repeat_visit_skips_catalog_queries(self):
+        """Test that a second visit serves the shop and its products from the cache"""
+        url = f'/shop/{self.shop.id}/'
+        self.client.get(url)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'Primer')
+
+    def test_product_change_invalidates_shop_pages(self):
+        """Test that saving a product bumps its shop's version"""
+        url = f'/shop/{self.shop.id}/'
+        self.client.get(url)
+        self.product.name = 'Undercoat'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertContains(self.client.get(url), 'Undercoat')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Shop.objects.create(name='Paint Hub', classification=self.classification)
+        self.assertContains(self.client.get(f'/classification/{self.classification.slug}/'), 'Paint Hub')
+
+    def test_stale_fragment_served_while_another_request_revalidates(self):
+        """Test that a stale fragment is served while its lock is held"""
+        from django.core.cache import cache
+        from main_app.catalog_cache import bump, cached_fragment, fragment_key
+        self.assertEqual(cached_fragment(('demo',), ['shop:99'], lambda: 'old'), 'old')
+        bump('shop:99')
+        cache.add(f"{fragment_key(('demo',))}:lock", 1)
+        self.assertEqual(cached_fragment(('demo',), ['shop:99'], lambda: 'new'), 'old')
+        cache.delete(f"{fragment_key(('demo',))}:lock")
+        self.assertEqual(cached_fragment(('demo',), ['shop:99'], lambda: 'new'), 'new')
+
+    def test_versions_change_only_after_commit(self):
+        """Test that a save inside atomic() bumps its scopes when the transaction commits, not before"""
+        from django.core.cache import cache
+        from django.db import transaction
+        from main_app.catalog_cache import version_key
+        key = version_key(f'shop:{self.shop.pk}')
+        self.client.get(f'/shop/{self.shop.id}/')
+        before = cache.get(key)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.product.name = 'Undercoat'
+                self.product.save()
+                self.assertEqual(cache.get(key), before)
+            self.assertEqual(cache.get(key), before)
+        self.assertNotEqual(cache.get(key), before)
+
+    def test_bump_writes_a_new_version_without_incr(self):
+        """Test that bumps set fresh values rather than relying on the backend's incr"""
+        from unittest import mock
+        from django.core.cache import cache
+        from main_app.catalog_cache import bump, version_key
+        versions = set()
+        with mock.patch.object(cache, 'incr', side_effect=AssertionError('incr is not atomic everywhere')):
+            for _ in range(3):
+                bump('shop:99')
+                versions.add(cache.get(version_key('shop:99')))
+        self.assertEqual(len(versions), 3)
+
+    def test_client_input_does_not_create_cache_entries(self):
+        """Test that cursors and unknown shop ids in the query string add no cache keys"""
+        from django.core.cache import cache
+        url = f'/classification/{self.classification.slug}/'
+        self.client.get(url)
+        keys = set(cache._cache)
+        for query in ('?cursor=WyJuZXh0IiwgWyJ6IiwgOTld', '?cursor=garbage', '?shop=424242', '?sort=bogus'):
+            with self.subTest(query=query):
+                self.assertContains(self.client.get(url + query), 'Color World')
+                self.assertEqual(set(cache._cache), keys)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(username='counter', password='12345')
+        self.client.login(username='counter', password='12345')
+        self.classification = Classification.objects.create(name='Lighting')
+        self.shop = Shop.objects.create(name='Lamp House', classification=self.classification)
+        self.budget = Budget.objects.create(user=self.user, total=Decimal('500.00'))
+        for i in range(5):
+            product = Product.objects.create(shop=self.shop, name=f'Lamp {i}', price=Decimal('10.00') + i)
+            Cart.objects.create(user=self.user, product=product, quantity=1)
+            Wishlist.objects.create(user=self.user, product=product)
+            SelectedProduct.objects.create(budget=self.budget, user=self.user, product=product, quantity=1)
+            ProductReview.objects.create(product=product, user=self.user, rating=4, comment='Bright')
+        self.product = product
+
+    def test_page_query_budgets(self):
+        """Test that each page stays within its query budget with no N+1 queries"""
+        # The budget page reads the wishlist once for its suggested bundle
+        # and the price statistics once for its hints. The shop and cart
+        # pages read their "frequently planned together" products once,
+        # and the reviews page its similar items, after checking once that
+        # the product exists for its ETag. The classification and shop
+        # pages count their facets once.
+        budgets = {
+            '/': 4,
+            f'/classification/{self.classification.slug}/': 6,
+            f'/shop/{self.shop.id}/': 7,
+            '/budget/': 9,
+            '/cart/': 7,
+            '/wishlist/': 4,
+            '/profile/': 5,
+            f'/product-reviews/{self.product.id}/': 7,
+        }
+        for url, budget in budgets.items():
+            with self.subTest(url=url):
+                self.assertQueryBudget(url, budget)
+
+    def test_server_timing_header(self):
+        """Test that responses carry db, template and total timings"""
+        response = self.client.get('/cart/')
+        timing = response['Server-Timing']
+        self.assertIn(f'desc="{response.query_profile.query_count} queries"', timing)
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertGreater(response.query_profile.template_time, 0)
+
+    def test_n_plus_one_is_detected_and_logged(self):
+        """Test that a lazy foreign-key load in a loop is reported"""
+        from main_app.middleware import QueryInstrumentationMiddleware
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+
+        def view(request):
+            names = [item.product.name for item in Wishlist.objects.all()]
+            return HttpResponse(', '.join(names))
+
+        middleware = QueryInstrumentationMiddleware(view)
+        with self.assertLogs('main_app.queries', level='WARNING') as logs:
+            response = middleware(RequestFactory().get('/lazy/'))
+        offenders = response.query_profile.n_plus_one()
+        self.assertEqual(list(offenders.values()), [5])
+        self.assertIn('N+1 on GET /lazy/', logs.output[0])
+
+
+class QueryPlanTest(QueryPlanMixin, TestCase):
+    """Each hot query must use an index once its tables are past QUERY_PLAN_SCAN_MIN_ROWS."""
+
+    @classmethod
+    def setUpTestData(cls):
+        from django.db import connection
+        classification = Classification.objects.create(name='Tiles')
+        shops = Shop.objects.bulk_create(
+            Shop(name=f'Tile Shop {i}', classification=classification) for i in range(5)
+        )
+        products = Product.objects.bulk_create(
+            Product(shop=shops[i % 5], name=f'Tile {i}', price=Decimal(i % 90) + 1, is_available=i % 4 != 0)
+            for i in range(300)
+        )
+        users = User.objects.bulk_create(User(username=f'planner{i}', password='!') for i in range(300))
+        budgets = Budget.objects.bulk_create(Budget(user=user, total=Decimal('1000.00')) for user in users)
+        for offset in (0, 1):
+            pairs = [(i, users[i], products[(i + offset) % 300]) for i in range(300)]
+            Cart.objects.bulk_create(Cart(user=user, product=product) for i, user, product in pairs)
+            Wishlist.objects.bulk_create(Wishlist(user=user, product=product) for i, user, product in pairs)
+            SelectedProduct.objects.bulk_create(
+                SelectedProduct(budget=budgets[i], user=user, product=product) for i, user, product in pairs
+            )
+            ProductReview.objects.bulk_create(
+                ProductReview(user=user, product=product, rating=i % 5 + 1) for i, user, product in pairs
+            )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.user, cls.product, cls.shop, cls.budget = users[7], products[7], shops[2], budgets[7]
+
+    def setUp(self):
+        override = self.settings(QUERY_PLAN_SCAN_MIN_ROWS=250)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_budget_and_cart_queries_use_indexes(self):
+        from main_app.budget import BudgetSummary
+        summary = BudgetSummary(self.user, self.budget)
+        self.assertNoFullScan(Budget.objects.filter(user=self.user).order_by('pk')[:1])
+        self.assertNoFullScan(summary.selected_products)
+        self.assertNoFullScan(summary.cart_items)
+        self.assertNoFullScan(Cart.objects.filter(user=self.user, product=self.product))
+        self.assertNoFullScan(SelectedProduct.objects.filter(budget=self.budget, product=self.product))
+        self.assertNoFullScan(Wishlist.objects.filter(user=self.user).select_related('product'))
+
+    def test_review_queries_read_in_index_order(self):
+        from main_app.views import REVIEW_SORTS
+        for sort, (label, ordering) in REVIEW_SORTS.items():
+            with self.subTest(sort=sort):
+                self.assertNoFullScan(
+                    ProductReview.objects.filter(product=self.product)
+                    .select_related('user', 'user__userprofile').order_by(*ordering),
+                    ordered=True,
+                )
+        self.assertNoFullScan(
+            ProductReview.objects.filter(user=self.user).select_related('product').order_by('-created_at'),
+            ordered=True,
+        )
+
+    def test_catalog_queries_use_indexes(self):
+        self.assertNoFullScan(Product.objects.filter(shop=self.shop).order_by('price', 'pk'), ordered=True)
+        self.assertNoFullScan(
+            Product.objects.filter(shop=self.shop, is_available=True).order_by('price'), ordered=True
+        )
+        self.assertNoFullScan(
+            Product.objects.filter(shop=self.shop, price__gte=10, price__lt=25).order_by('price', 'pk'), ordered=True
+        )
+
+    def test_full_scan_of_large_table_fails(self):
+        with self.assertRaisesMessage(AssertionError, 'full scan of main_app_productreview'):
+            self.assertNoFullScan(ProductReview.objects.filter(comment='Sturdy'))
+        with self.settings(QUERY_PLAN_SCAN_MIN_ROWS=10_000):
+            self.assertNoFullScan(ProductReview.objects.filter(comment='Sturdy'))
+
+
+class BundleTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='planner', password='12345')
+        self.client.login(username='planner', password='12345')
+        self.lighting = Classification.objects.create(name='Lighting')
+        self.seating = Classification.objects.create(name='Seating')
+        lamps = Shop.objects.create(name='Lamp House', classification=self.lighting)
+        chairs = Shop.objects.create(name='Chair Co', classification=self.seating)
+        self.budget = Budget.objects.create(user=self.user, total=Decimal('100.00'))
+        self.lamp = Product.objects.create(shop=lamps, name='Lamp', price=Decimal('60.00'))
+        self.shade = Product.objects.create(shop=lamps, name='Shade', price=Decimal('45.500'))
+        self.bulb = Product.objects.create(shop=lamps, name='Bulb', price=Decimal('30.25'))
+        self.chair = Product.objects.create(shop=chairs, name='Chair', price=Decimal('20.00'))
+        self.stool = Product.objects.create(shop=chairs, name='Stool', price=Decimal('12.00'), rating_avg=4.5)
+        for product in (self.lamp, self.shade, self.bulb):
+            Wishlist.objects.create(user=self.user, product=product)
+
+    def test_solve_finds_the_best_fit(self):
+        """Test that the solver takes at most one option per group and never exceeds the capacity"""
+        from main_app.bundles import Group, solve
+        groups = [
+            Group('a', [(None, 1, 600, 6.0)]),
+            Group('b', [(None, 1, 500, 5.0), (None, 2, 1000, 10.0)]),
+            Group('c', [(None, 1, 400, 4.5)]),
+        ]
+        self.assertEqual(solve(groups, 1000), [0, None, 0])
+        self.assertEqual(solve(groups, 1400), [None, 1, 0])
+        self.assertEqual(solve(groups, 399), [None, None, None])
+
+    def test_wishlist_bundle_fits_remaining_budget(self):
+        """Test that the bundle maximises wishlist items within the remaining budget"""
+        from main_app.bundles import suggest_bundle
+        bundle = suggest_bundle(self.user)
+        self.assertEqual({line.product for line in bundle.lines}, {self.shade, self.bulb})
+        self.assertEqual(bundle.total, Decimal('75.75'))
+        self.assertEqual(bundle.remaining, Decimal('24.25'))
+
+        Cart.objects.create(user=self.user, product=self.bulb, quantity=1)
+        bundle = suggest_bundle(self.user, priorities={self.lamp.id: 10})
+        self.assertEqual([line.product for line in bundle.lines], [self.lamp])
+
+    def test_requirements_draw_on_the_catalog(self):
+        """Test that requirements add catalog products and report what cannot be met"""
+        from main_app.bundles import suggest_bundle
+        Wishlist.objects.all().delete()
+        bundle = suggest_bundle(self.user, requirements={self.seating.id: 2})
+        self.assertEqual([(line.product, line.quantity) for line in bundle.lines], [(self.stool, 2)])
+        self.assertEqual(bundle.missing, {})
+
+        self.budget.total = Decimal('15.00')
+        self.budget.save()
+        bundle = suggest_bundle(self.user, requirements={self.seating.id: 2})
+        self.assertEqual(bundle.missing, {self.seating.id: 1})
+
+    def test_budget_page_and_json_endpoint(self):
+        """Test that the budget page shows the bundle and the endpoint returns it as JSON"""
+        response = self.client.get('/budget/')
+        self.assertContains(response, 'Suggested for your remaining budget')
+        self.assertEqual({line.product for line in response.context['bundle'].lines}, {self.shade, self.bulb})
+
+        data = self.client.get('/budget/bundle/').json()
+        self.assertEqual(data['total'], '75.75')
+        self.assertEqual({line['product_id'] for line in data['lines']}, {self.shade.id, self.bulb.id})
+
+        response = self.client.post('/budget/bundle/', json.dumps({'requirements': {str(self.seating.id): 1}}),
+                                    content_type='application/json')
+        self.assertIn(self.stool.id, [line['product_id'] for line in response.json()['lines']])
+
+        response = self.client.post('/budget/bundle/', json.dumps({'quantities': {'x': 0}}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.json()['errors']), 1)
+
+
+class PriceStatsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='hinted', password='12345')
+        self.client.login(username='hinted', password='12345')
+        self.lighting = Classification.objects.create(name='Lighting')
+        self.lamps = Shop.objects.create(name='Lamp House', classification=self.lighting)
+        self.bulbs = Shop.objects.create(name='Bulb Barn', classification=self.lighting)
+        self.empty = Shop.objects.create(name='Empty', classification=self.lighting)
+        for price in ('10.00', '20.00', '30.00', '40.00'):
+            Product.objects.create(shop=self.lamps, name=f'Lamp {price}', price=Decimal(price))
+        Product.objects.create(shop=self.bulbs, name='Bulb', price=Decimal('5.50'))
+        Product.objects.create(shop=self.bulbs, name='Old bulb', price=Decimal('1.00'), is_available=False)
+
+    def rebuild(self):
+        from django.core.management import call_command
+        call_command('rebuild_price_stats', stdout=StringIO())
+
+    def test_percentiles_match_numpy(self):
+        """Test that the statistics computed in the database match NumPy's linear percentiles"""
+        import numpy as np
+        from main_app.models import ShopPriceStats
+        from main_app.price_stats import refresh_price_stats
+        prices = [Decimal('10.00'), Decimal('20.00'), Decimal('30.00'), Decimal('40.00')]
+        for i in range(9):
+            price = Decimal(17 * i * i % 97) + Decimal('0.25')
+            prices.append(price)
+            Product.objects.create(shop=self.lamps, name=f'Sconce {i}', price=price)
+        refresh_price_stats(ShopPriceStats, [self.lamps.pk, self.empty.pk])
+        stats = ShopPriceStats.objects.get(shop=self.lamps)
+        p10, median, p90 = np.percentile(np.array(prices, dtype=float), [10, 50, 90])
+        self.assertEqual(stats.product_count, 13)
+        self.assertEqual((stats.min_price, stats.max_price), (min(prices), max(prices)))
+        self.assertEqual(stats.mean_price, (sum(prices) / len(prices)).quantize(Decimal('0.01')))
+        self.assertEqual([stats.p10_price, stats.median_price, stats.p90_price],
+                         [Decimal(f'{value:.2f}') for value in (p10, median, p90)])
+        self.assertEqual(ShopPriceStats.objects.get(shop=self.empty).product_count, 0)
+
+    def test_rebuild_covers_available_products(self):
+        """Test that the rebuild writes a row per shop and classification, ignoring unavailable products"""
+        from main_app.models import ClassificationPriceStats, ShopPriceStats
+        self.rebuild()
+        self.assertEqual(ShopPriceStats.objects.get(shop=self.bulbs).min_price, Decimal('5.50'))
+        self.assertEqual(ShopPriceStats.objects.get(shop=self.empty).product_count, 0)
+        self.assertIsNone(ShopPriceStats.objects.get(shop=self.empty).median_price)
+        stats = ClassificationPriceStats.objects.get(classification=self.lighting)
+        self.assertEqual(stats.product_count, 5)
+        self.assertEqual(stats.median_price, Decimal('20.00'))
+        self.assertEqual(stats.min_price, Decimal('5.50'))
+
+    def test_product_changes_refresh_their_scopes(self):
+        """Test that saving, moving and deleting products refreshes the shop and classification rows"""
+        import tempfile
+        from main_app.models import ClassificationPriceStats, ShopPriceStats
+        self.rebuild()
+        # Eager product saves refresh the similarity index too; keep it out of the project.
+        index = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'index.npz')
+        with self.settings(TASKS_EAGER=True, SIMILARITY_INDEX_PATH=index):
+            product = Product.objects.create(shop=self.empty, name='Chandelier', price=Decimal('200.00'))
+            self.assertEqual(ShopPriceStats.objects.get(shop=self.empty).max_price, Decimal('200.00'))
+            self.assertEqual(ClassificationPriceStats.objects.get(classification=self.lighting).product_count, 6)
+
+            product.shop = self.lamps
+            product.save()
+            self.assertEqual(ShopPriceStats.objects.get(shop=self.empty).product_count, 0)
+            self.assertEqual(ShopPriceStats.objects.get(shop=self.lamps).max_price, Decimal('200.00'))
+
+            product.delete()
+            self.assertEqual(ShopPriceStats.objects.get(shop=self.lamps).max_price, Decimal('40.00'))
+            self.assertEqual(ClassificationPriceStats.objects.get(classification=self.lighting).product_count, 5)
+
+    def test_refreshes_are_debounced(self):
+        """Test that changes within one window queue a single delayed task per scope"""
+        from django.core.cache import cache
+        from django.utils import timezone
+        cache.clear()
+        Task.objects.all().delete()
+        for i in range(3):
+            Product.objects.create(shop=self.lamps, name=f'Spot {i}', price=Decimal('12.00'))
+        tasks = Task.objects.filter(name='catalog.refresh_price_stats')
+        self.assertEqual(sorted(task.payload['scope'] for task in tasks), ['classification', 'shop'])
+        self.assertTrue(all(task.run_after > timezone.now() for task in tasks))
+
+    def test_repeat_saves_skip_queued_refreshes(self):
+        """Test that saves after the first in a window neither look up the shop nor insert a task"""
+        from django.core.cache import cache
+        from main_app.price_stats import schedule_refresh
+        cache.clear()
+        Task.objects.all().delete()
+        self.assertEqual(schedule_refresh(shop_ids=[self.lamps.pk]), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(schedule_refresh(shop_ids=[self.lamps.pk]), 0)
+        # A second shop in the same classification only adds its own task.
+        self.assertEqual(schedule_refresh(shop_ids=[self.bulbs.pk]), 1)
+        self.assertEqual(Task.objects.filter(name='catalog.refresh_price_stats').count(), 3)
+
+    def test_budget_page_reads_precomputed_hints(self):
+        """Test that the budget page shows the classification statistics without touching products"""
+        self.rebuild()
+        Budget.objects.create(user=self.user, total=Decimal('300.00'))
+        with self.assertNumQueries(9):
+            response = self.client.get('/budget/')
+        self.assertContains(response, 'Typical prices')
+        self.assertEqual([stats.classification for stats in response.context['price_hints']], [self.lighting])
+
+
+class IntegrityScanTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.db import connection
+        self.checkpoint_dir = os.path.join(tempfile.mkdtemp(), 'scan')
+        self.user = User.objects.create_user(username='scanned', password='12345')
+        shop = Shop.objects.create(name='Scan Shop', classification=Classification.objects.create(name='Scans'))
+        self.products = [
+            Product.objects.create(shop=shop, name=f'Item {i}', price=Decimal('10.00')) for i in range(6)
+        ]
+        self.cart = Cart.objects.create(user=self.user, product=self.products[0], quantity=2)
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE main_app_product SET price = 'n/a' WHERE id = %s", [self.products[1].pk])
+            cursor.execute('UPDATE main_app_product SET price = -4 WHERE id = %s', [self.products[2].pk])
+            cursor.execute('UPDATE main_app_product SET price = 7.125 WHERE id = %s', [self.products[4].pk])
+            cursor.execute('UPDATE main_app_cart SET quantity = 0 WHERE id = %s', [self.cart.pk])
+
+    def scan(self, **options):
+        from main_app.integrity import scan
+        return scan(['main_app.Product', 'main_app.Cart'], checkpoint_dir=self.checkpoint_dir, workers=1,
+                    chunk_size=2, **options)
+
+    def test_scan_reports_without_changing_rows(self):
+        """Test that a dry run finds each kind of bad value with SQL predicates"""
+        results = self.scan()
+        found = {check: count for check, count in results['main_app.Product']['found'].items() if count}
+        self.assertEqual(found, {'price.not_a_number': 1, 'price.negative': 1, 'price.too_precise': 1})
+        self.assertEqual(results['main_app.Product']['samples']['price.negative'], [self.products[2].pk])
+        self.assertEqual(results['main_app.Cart']['found']['quantity.below_one'], 1)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.quantity, 0)
+        self.assertFalse(os.path.exists(self.checkpoint_dir))
+
+    def test_fix_repairs_in_bulk(self):
+        """Test that --fix rewrites the bad values and a second scan comes back clean"""
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('scan_integrity', '--fix', '--workers=1', '--model=Product', '--model=Cart',
+                     f'--checkpoint-dir={self.checkpoint_dir}', stdout=out)
+        self.assertIn('4 bad values found, 4 fixed', out.getvalue())
+        prices = dict(Product.objects.values_list('pk', 'price'))
+        self.assertEqual(prices[self.products[1].pk], Decimal('0'))
+        self.assertEqual(prices[self.products[2].pk], Decimal('0'))
+        self.assertEqual(prices[self.products[4].pk], Decimal('7.13'))
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.quantity, 1)
+        results = self.scan()
+        self.assertEqual(sum(results['main_app.Product']['found'].values()), 0)
+
+    def test_fix_refreshes_cached_pages(self):
+        """Test that prices fixed behind the model signals show on the cached shop page"""
+        from django.core.cache import cache
+        from django.core.management import call_command
+        cache.clear()
+        shop = Shop.objects.create(name='Cached Shop', classification=Classification.objects.get(name='Scans'))
+        product = Product.objects.create(shop=shop, name='Refunded', price=Decimal('-3.50'))
+        self.client.login(username='scanned', password='12345')
+        url = f'/shop/{shop.pk}/'
+        self.assertContains(self.client.get(url), '-3.50 BHD')
+        Task.objects.all().delete()
+        call_command('scan_integrity', '--fix', '--workers=1', '--model=Product',
+                     f'--checkpoint-dir={self.checkpoint_dir}', stdout=StringIO())
+        response = self.client.get(url)
+        self.assertNotContains(response, '-3.50 BHD')
+        self.assertContains(response, '0.00 BHD')
+        product.refresh_from_db()
+        self.assertGreater(product.updated_at, shop.updated_at)
+        self.assertTrue(Task.objects.filter(name='similarity.refresh').exists())
+
+    def test_scan_resumes_from_checkpoint(self):
+        """Test that an interrupted scan picks up after the last checkpointed row"""
+        from main_app.integrity import Checkpoint
+        os.makedirs(self.checkpoint_dir)
+        checkpoint = Checkpoint(self.checkpoint_dir, 'main_app_product')
+        checkpoint.state['last_pk'] = self.products[3].pk
+        checkpoint.save()
+        results = self.scan()
+        found = {check: count for check, count in results['main_app.Product']['found'].items() if count}
+        self.assertEqual(found, {'price.too_precise': 1})
+
+    def test_interrupted_scan_resumes_only_in_the_same_mode(self):
+        """Test that an interrupted report-only scan resumes, but a --fix run starts the table over"""
+        from unittest import mock
+        from main_app.integrity import Checkpoint
+        save = Checkpoint.save
+
+        def interrupt_scan():
+            # Let the first chunk of products be checkpointed, then stop.
+            saved = []
+
+            def save_once(checkpoint):
+                if saved:
+                    raise KeyboardInterrupt
+                saved.append(checkpoint)
+                save(checkpoint)
+
+            with mock.patch.object(Checkpoint, 'save', save_once), self.assertRaises(KeyboardInterrupt):
+                self.scan()
+            checkpoint = Checkpoint(self.checkpoint_dir, 'main_app_product')
+            self.assertEqual(checkpoint.state['last_pk'], self.products[1].pk)
+            self.assertEqual(sum(checkpoint.state['found'].values()), 1)
+
+        interrupt_scan()
+        results = self.scan()
+        self.assertEqual(sum(results['main_app.Product']['found'].values()), 3)
+
+        interrupt_scan()
+        results = self.scan(fix=True)
+        self.assertEqual(results['main_app.Product']['fixed'], results['main_app.Product']['found'])
+        self.assertEqual(sum(results['main_app.Product']['fixed'].values()), 3)
+        self.assertEqual(Product.objects.get(pk=self.products[1].pk).price, Decimal('0'))
+
+
+class RecommendationTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        lighting = Classification.objects.create(name='Lighting')
+        self.lamps = Shop.objects.create(name='Lamp House', classification=lighting)
+        self.bulbs = Shop.objects.create(name='Bulb Barn', classification=lighting)
+        self.lamp = Product.objects.create(shop=self.lamps, name='Lamp', price=Decimal('40.00'))
+        self.shade = Product.objects.create(shop=self.lamps, name='Shade', price=Decimal('15.00'))
+        self.bulb = Product.objects.create(shop=self.bulbs, name='Bulb', price=Decimal('3.00'))
+        self.rug = Product.objects.create(shop=self.bulbs, name='Rug', price=Decimal('80.00'))
+        self.users = [User.objects.create(username=f'planner{i}', password='!') for i in range(4)]
+        first, second, third, fourth = self.users
+        budget = Budget.objects.create(user=second, total=Decimal('100.00'))
+        Wishlist.objects.create(user=first, product=self.lamp)
+        Cart.objects.create(user=first, product=self.bulb)
+        SelectedProduct.objects.create(budget=budget, user=second, product=self.lamp)
+        Wishlist.objects.create(user=second, product=self.bulb)
+        Cart.objects.create(user=second, product=self.shade)
+        Wishlist.objects.create(user=third, product=self.lamp)
+        Wishlist.objects.create(user=third, product=self.shade)
+        Wishlist.objects.create(user=fourth, product=self.rug)
+
+    def neighbors(self, product):
+        from main_app.models import ProductNeighbor
+        return list(ProductNeighbor.objects.filter(product=product).order_by('rank')
+                    .values_list('neighbor_id', 'shared_count'))
+
+    def test_rebuild_ranks_pairs_shared_by_enough_users(self):
+        """Test that neighbours are pairs in at least MIN_SHARED baskets, best score first"""
+        from django.core.management import call_command
+        call_command('rebuild_recommendations', stdout=StringIO())
+        # Lamp pairs with bulb and shade twice each; the tie goes to the lower id.
+        self.assertEqual(self.neighbors(self.lamp), [(self.shade.id, 2), (self.bulb.id, 2)])
+        self.assertEqual(self.neighbors(self.bulb), [(self.lamp.id, 2)])
+        self.assertEqual(self.neighbors(self.rug), [])
+
+    def test_vectorised_counts_match_brute_force(self):
+        """Test that the NumPy pair counts, in several chunks, match counting every basket"""
+        import random
+        from collections import Counter
+        from itertools import permutations
+        from unittest import mock
+        import numpy as np
+        from main_app import recommendations
+        rng = random.Random(7)
+        baskets = [sorted(rng.sample(range(30), rng.randint(1, 8))) for user in range(200)]
+        users = np.array([user for user, basket in enumerate(baskets) for item in basket])
+        items = np.array([item for basket in baskets for item in basket])
+        expected = Counter(pair for basket in baskets for pair in permutations(basket, 2))
+        with mock.patch.object(recommendations, 'PAIR_CHUNK', 50):
+            first, second, counts = recommendations.cooccurrence(users, items, 30)
+        self.assertEqual(dict(zip(zip(first.tolist(), second.tolist()), counts.tolist())), dict(expected))
+
+    def test_basket_changes_refresh_neighbours(self):
+        """Test that adding and removing basket rows updates the affected neighbours"""
+        from main_app.budget import add_to_cart
+        with self.settings(TASKS_EAGER=True):
+            add_to_cart(self.users[3], self.lamp.id)
+            Wishlist.objects.create(user=self.users[2], product=self.rug)
+            self.assertEqual(self.neighbors(self.rug), [(self.lamp.id, 2)])
+            self.assertIn((self.rug.id, 2), self.neighbors(self.lamp))
+
+            Wishlist.objects.filter(user=self.users[3], product=self.rug).delete()
+            self.assertEqual(self.neighbors(self.rug), [])
+            self.assertNotIn(self.rug.id, [neighbor for neighbor, count in self.neighbors(self.lamp)])
+
+    def test_pages_show_products_planned_together(self):
+        """Test that the shop page and cart list other products planned with theirs"""
+        from main_app.recommendations import refresh_neighbors
+        refresh_neighbors()
+        self.client.force_login(self.users[2])
+        response = self.client.get(f'/shop/{self.lamps.id}/')
+        self.assertEqual(response.context['planned_together'], [self.bulb])
+
+        response = self.client.get('/cart/')
+        self.assertEqual(response.context['planned_together'], [])
+        Cart.objects.create(user=self.users[2], product=self.bulb)
+        response = self.client.get('/cart/')
+        self.assertEqual(response.context['planned_together'], [self.lamp])
+        self.assertContains(response, 'Frequently planned together')
+
+    def test_lookups_rank_in_the_database(self):
+        """Test that neighbours are summed and ranked in SQL, loading only the products returned"""
+        from main_app.recommendations import planned_together, refresh_neighbors
+        refresh_neighbors()
+        # The shade's one neighbour, the lamp, outscores the lamp's shade and bulb.
+        with self.assertNumQueries(2):
+            self.assertEqual(planned_together([self.lamp.id, self.shade.id], limit=1), [self.lamp])
+        self.assertEqual(planned_together([self.lamp.id], exclude=[self.shade.id]), [self.bulb])
+
+
+class SimilarProductsTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.core.cache import cache
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = self.settings(SIMILARITY_INDEX_PATH=os.path.join(directory.name, 'index.npz'))
+        override.enable()
+        self.addCleanup(override.disable)
+
+        lighting = Classification.objects.create(name='Lighting')
+        seating = Classification.objects.create(name='Seating')
+        lamps = Shop.objects.create(name='Lamp House', classification=lighting)
+        chairs = Shop.objects.create(name='Chair Co', classification=seating)
+
+        def product(shop, name, description, price):
+            return Product.objects.create(shop=shop, name=name, description=description, price=Decimal(price))
+
+        self.floor_lamp = product(lamps, 'Brass floor lamp', 'Tall brass lamp with a linen shade', '120.00')
+        self.table_lamp = product(lamps, 'Brass table lamp', 'Small brass lamp with a linen shade', '90.00')
+        self.vase = product(lamps, 'Ceramic vase', 'Glazed stoneware vase', '20.00')
+        self.bulb = product(lamps, 'LED bulb', 'Warm white bulb', '3.00')
+        self.stool = product(chairs, 'Brass stool', 'Brass stool with a linen seat', '90.00')
+        self.chair = product(chairs, 'Oak chair', 'Solid oak dining chair', '70.00')
+
+    def similar(self, product):
+        from main_app.models import SimilarProduct
+        return list(SimilarProduct.objects.filter(product=product).order_by('rank').values_list('similar_id', flat=True))
+
+    def test_rebuild_ranks_by_content_within_a_classification(self):
+        """Test that the closest product in name, description and price comes first, never from another classification"""
+        from django.core.management import call_command
+        call_command('rebuild_similar_products', stdout=StringIO())
+        self.assertEqual(self.similar(self.floor_lamp)[0], self.table_lamp.id)
+        self.assertEqual(self.similar(self.table_lamp)[0], self.floor_lamp.id)
+        self.assertNotIn(self.stool.id, self.similar(self.table_lamp))
+        self.assertEqual(self.similar(self.stool), [])
+
+    def test_refresh_recomputes_only_affected_products(self):
+        """Test that an edit, an addition and a deletion update just the lists they touch"""
+        from main_app.similarity import refresh_similar
+        refresh_similar(full=True)
+        self.vase.name, self.vase.description = 'Brass lamp base', 'Brass lamp base for a linen shade'
+        self.vase.save()
+        self.assertEqual(refresh_similar(), 3)
+        self.assertIn(self.vase.id, self.similar(self.floor_lamp))
+        self.assertIn(self.floor_lamp.id, self.similar(self.vase))
+
+        self.table_lamp.delete()
+        self.assertNotIn(self.table_lamp.id, self.similar(self.floor_lamp))
+        reading = Product.objects.create(shop=self.floor_lamp.shop, name='Brass reading lamp',
+                                         description='Brass lamp with a linen shade', price=Decimal('100.00'))
+        refresh_similar()
+        self.assertIn(reading.id, self.similar(self.floor_lamp))
+        self.assertEqual(self.similar(reading)[0], self.floor_lamp.id)
+        self.assertEqual(refresh_similar(), 0)
+
+    def test_tiled_scores_match_one_matrix_product(self):
+        """Test that scoring in small batches and tiles finds the same lists and affected rows"""
+        from unittest import mock
+        from main_app import similarity
+        from main_app.models import SimilarProduct
+
+        def lists():
+            return sorted(SimilarProduct.objects.values_list('product_id', 'similar_id', 'rank'))
+
+        similarity.refresh_similar(full=True)
+        whole = lists()
+        self.vase.name = 'Brass vase'
+        self.vase.save()
+        self.assertEqual(similarity.refresh_similar(), 3)
+        edited = lists()
+
+        self.vase.name = 'Ceramic vase'
+        self.vase.save()
+        with mock.patch.object(similarity, 'BATCH_SIZE', 2), mock.patch.object(similarity, 'TILE_SIZE', 3):
+            similarity.refresh_similar(full=True)
+            self.assertEqual(lists(), whole)
+            self.vase.name = 'Brass vase'
+            self.vase.save()
+            self.assertEqual(similarity.refresh_similar(), 3)
+        self.assertEqual(lists(), edited)
+
+    def test_deleting_from_a_full_list_refills_it(self):
+        """Test that a list left short by a deleted product takes the next best"""
+        from unittest import mock
+        from main_app import similarity
+        iron_lamp = Product.objects.create(shop=self.floor_lamp.shop, name='Iron floor lamp',
+                                           description='Tall iron lamp with a linen shade', price=Decimal('110.00'))
+        with mock.patch.object(similarity, 'TOP_K', 1):
+            similarity.refresh_similar(full=True)
+            self.assertEqual(self.similar(self.floor_lamp), [self.table_lamp.id])
+            self.table_lamp.delete()
+            similarity.refresh_similar()
+        self.assertEqual(self.similar(self.floor_lamp), [iron_lamp.id])
+
+    def test_product_page_lists_available_similar_items(self):
+        """Test that the reviews page shows the similar items still for sale"""
+        from main_app.similarity import refresh_similar
+        refresh_similar(full=True)
+        user = User.objects.create_user(username='browser', password='12345')
+        self.client.force_login(user)
+        response = self.client.get(f'/product-reviews/{self.floor_lamp.id}/')
+        self.assertEqual(response.context['similar_products'][0], self.table_lamp)
+        self.assertContains(response, 'Similar items')
+
+        Product.objects.filter(pk=self.table_lamp.pk).update(is_available=False)
+        from main_app.similarity import similar_products
+        self.assertNotIn(self.table_lamp, similar_products(self.floor_lamp.id))
+
+
+class FacetTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        User.objects.create_user(username='browser', password='12345')
+        self.client.login(username='browser', password='12345')
+        self.lighting = Classification.objects.create(name='Lighting')
+        self.lamps = Shop.objects.create(name='Lamp House', classification=self.lighting)
+        self.bulbs = Shop.objects.create(name='Bulb Barn', classification=self.lighting)
+        Product.objects.bulk_create([
+            Product(shop=self.lamps, name='Desk lamp', price=Decimal('8.00'), rating_avg=4.5),
+            Product(shop=self.lamps, name='Floor lamp', price=Decimal('30.00'), rating_avg=3.2),
+            Product(shop=self.lamps, name='Chandelier', price=Decimal('600.00'), is_available=False),
+            Product(shop=self.bulbs, name='Bulb', price=Decimal('2.00'), rating_avg=4.0),
+            Product(shop=self.bulbs, name='Smart bulb', price=Decimal('12.00'), is_available=False, rating_avg=2.0),
+        ])
+        self.url = f'/classification/{self.lighting.slug}/'
+
+    def counts(self, response, name):
+        facet = next(facet for facet in response.context['facets'].facets if facet.name == name)
+        return {option.value: option.count for option in facet.options}
+
+    def test_counts_apply_the_other_facets(self):
+        """Test that each facet is counted with every other facet's filters applied"""
+        from main_app.facets import facet_cells, facet_counts, Filters
+        cells = facet_cells(Product.objects.filter(shop__classification=self.lighting))
+        counts = facet_counts(cells, Filters(price=('0-10',), availability=('in_stock',), rating=None, shop=()))
+        self.assertEqual(counts.total, 2)
+        facets = {facet.name: {option.value: option.count for option in facet.options} for facet in counts.facets}
+        # Ticking another price range would add in-stock products from it.
+        self.assertEqual(facets['price']['25-50'], 1)
+        self.assertEqual(facets['price']['500-'], 0)
+        self.assertEqual(facets['availability'], {'in_stock': 2, 'out_of_stock': 0})
+        self.assertEqual(facets['rating'], {4: 2, 3: 2, 2: 2, 1: 2})
+        self.assertEqual(counts.shop_counts, {self.lamps.pk: 1, self.bulbs.pk: 1})
+
+    def test_classification_page_filters_shops(self):
+        """Test that the classification page lists only shops with matching products, in fixed queries"""
+        response = self.client.get(self.url)
+        self.assertEqual(self.counts(response, 'shop'), {self.bulbs.pk: 2, self.lamps.pk: 3})
+        # The facet counts are cached; filtering costs the session, user, profile and listing queries only.
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {'rating': '4', 'availability': ['in_stock', 'out_of_stock']})
+        self.assertEqual(response.context['facets'].total, 2)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {'price': '500-', 'rating': '4'})
+        self.assertEqual(response.context['shops'], [])
+        self.assertContains(response, 'No shops match these filters')
+
+        response = self.client.get(self.url, {'price': ['0-10', '10-25'], 'shop': self.bulbs.pk, 'sort': 'newest'})
+        self.assertEqual([shop.pk for shop in response.context['shops']], [self.bulbs.pk])
+        self.assertEqual(response.context['shops'][0].matching_count, 2)
+        self.assertEqual(response.context['filter_query'], f'price=0-10&price=10-25&shop={self.bulbs.pk}')
+        self.assertContains(response, '2 matching products')
+
+    def test_shop_page_filters_products(self):
+        """Test that the shop page filters its products and ignores the shop facet"""
+        url = f'/shop/{self.lamps.pk}/'
+        response = self.client.get(url, {'rating': '3', 'shop': self.bulbs.pk, 'sort': 'price'})
+        self.assertEqual([p.name for p in response.context['products']], ['Desk lamp', 'Floor lamp'])
+        self.assertEqual([facet.name for facet in response.context['facets'].facets], ['price', 'availability', 'rating'])
+        self.assertEqual(self.counts(response, 'availability'), {'in_stock': 2, 'out_of_stock': 0})
+        response = self.client.get(url, {'price': 'bogus', 'rating': '9'})
+        self.assertFalse(response.context['filtered'])
+        self.assertEqual(len(response.context['products']), 3)
+
+    def test_product_and_review_changes_refresh_counts(self):
+        """Test that the cached counts are invalidated by product and review changes"""
+        self.assertEqual(self.client.get(self.url).context['facets'].total, 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            lamp = Product.objects.create(shop=self.lamps, name='Reading lamp', price=Decimal('45.00'))
+        response = self.client.get(self.url, {'price': '25-50'})
+        self.assertEqual(response.context['facets'].total, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductReview.objects.create(product=lamp, user=User.objects.get(username='browser'), rating=5)
+        response = self.client.get(self.url, {'price': '25-50', 'rating': '4'})
+        self.assertEqual(response.context['facets'].total, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            lamp.delete()
+        self.assertEqual(self.client.get(self.url).context['facets'].total, 5)
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(username='revisitor', password='12345')
+        self.client.login(username='revisitor', password='12345')
+        self.classification = Classification.objects.create(name='Rugs')
+        self.shop = Shop.objects.create(name='Rug Room', classification=self.classification)
+        self.product = Product.objects.create(shop=self.shop, name='Kilim', price=Decimal('75.00'))
+
+    def revisit(self, url):
+        # The first page a browser sees sets its CSRF cookie, which is part of the ETag.
+        self.client.get('/')
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+        self.assertNotIn('Last-Modified', first)
+        return first, self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+
+    def test_unchanged_pages_are_304_without_listing_queries(self):
+        """Test that a revalidation skips the view's queries and template"""
+        for url in ['/', f'/classification/{self.classification.slug}/', f'/shop/{self.shop.id}/',
+                    f'/product-reviews/{self.product.id}/']:
+            with self.subTest(url=url):
+                first, second = self.revisit(url)
+                self.assertEqual(second.status_code, 304)
+                # Only the session and the user are loaded.
+                self.assertEqual(second.query_profile.query_count, 2)
+                self.assertEqual(second.query_profile.template_time, 0)
+
+    def test_changes_invalidate_the_etag(self):
+        """Test that edits, new reviews and another user all get a fresh page"""
+        url = f'/shop/{self.shop.id}/'
+        first, second = self.revisit(url)
+        self.product.price = Decimal('80.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+        first, second = self.revisit(f'/product-reviews/{self.product.id}/')
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductReview.objects.create(user=self.user, product=self.product, rating=4)
+        response = self.client.get(f'/product-reviews/{self.product.id}/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+        first, second = self.revisit('/')
+        User.objects.create_user(username='second', password='12345')
+        self.client.login(username='second', password='12345')
+        self.assertEqual(self.client.get('/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_missing_pages_are_not_validated(self):
+        """Test that a 404 carries no validators"""
+        for url in ['/shop/999/', '/product-reviews/999/', '/classification/missing/']:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 404)
+                self.assertNotIn('ETag', response)
+
+    def test_removed_products_invalidate_the_page(self):
+        """Test that deleting a product or making it unavailable, which no updated_at shows, gets a fresh page"""
+        spare = Product.objects.create(shop=self.shop, name='Dhurrie', price=Decimal('40.00'))
+        url = f'/shop/{self.shop.id}/'
+        first, second = self.revisit(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            spare.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'Dhurrie')
+        # Only the ETag validates: a date alone never earns a 304.
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+        first, second = self.revisit(url)
+        self.product.is_available = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+
+class AsyncServingTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(username='asyncer', password='12345')
+        classification = Classification.objects.create(name='Curtains')
+        self.shop = Shop.objects.create(name='Drapes Co', classification=classification)
+        self.product = Product.objects.create(shop=self.shop, name='Linen Drape', price=Decimal('30.00'))
+        ProductReview.objects.create(user=self.user, product=self.product, rating=5, comment='Lovely')
+
+    async def test_catalog_views_run_under_asgi(self):
+        """Test that the async catalog views serve pages and 304s through the ASGI handler"""
+        from django.test import AsyncClient
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        await client.get('/')  # sets the CSRF cookie the ETags include
+        for url in ['/', f'/shop/{self.shop.id}/', f'/product-reviews/{self.product.id}/']:
+            response = await client.get(url)
+            self.assertEqual(response.status_code, 200)
+            again = await client.get(url, headers={'if-none-match': response['ETag']})
+            self.assertEqual(again.status_code, 304)
+        response = await client.get(f'/product-reviews/{self.product.id}/')
+        self.assertContains(response, 'Lovely')
+
+    def test_middleware_stack_stays_async(self):
+        """Test that no middleware makes the ASGI handler adapt the stack to sync"""
+        from django.core.handlers.asgi import ASGIHandler
+        with self.settings(DEBUG=True), self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    async def test_queries_are_profiled_under_asgi(self):
+        """Test that the async views' queries, run in other threads, reach the request profile"""
+        from django.test import AsyncClient
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        response = await client.get(f'/shop/{self.shop.id}/')
+        self.assertGreater(response.query_profile.query_count, 0)
+        self.assertIn(f'desc="{response.query_profile.query_count} queries"', response['Server-Timing'])
+
+    async def test_sync_write_views_under_asgi(self):
+        """Test that cart and budget writes keep working across the sync-to-async boundary"""
+        import asyncio
+        from django.test import AsyncClient
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        await asyncio.gather(*(client.get(f'/add-to-cart/{self.product.id}/') for _ in range(5)))
+        await client.get(f'/add-to-budget/{self.product.id}/', headers={'accept': 'application/json'})
+        self.assertEqual(await Cart.objects.filter(user=self.user).values_list('quantity', flat=True).aget(), 5)
+        self.assertEqual(await SelectedProduct.objects.filter(user=self.user).acount(), 1)
+
+    def test_simulated_latency_delays_queries(self):
+        """Test that SIMULATED_DB_LATENCY_MS makes every query sleep"""
+        import time
+        from main_app.latency import sleep_before_query
+        from django.db import connection
+        with self.settings(SIMULATED_DB_LATENCY_MS=30), connection.execute_wrapper(sleep_before_query):
+            started = time.perf_counter()
+            Product.objects.count()
+            self.assertGreaterEqual(time.perf_counter() - started, 0.03)
+
+
+class ReplicaRoutingTest(TestCase):
+    """Two SQLite files stand in for the primary and a lagging replica."""
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(username='router', password='12345')
+        self.client.login(username='router', password='12345')
+        # Rows both files share, as a caught-up replica would...
+        for alias in ('default', 'replica'):
+            Classification.objects.using(alias).create(pk=1, name='Lamps')
+            Shop.objects.using(alias).create(pk=1, name='Lamp Shop', classification_id=1)
+            Product.objects.using(alias).create(pk=1, shop_id=1, name='Lamp', price=Decimal('10.00'))
+        self.product = Product.objects.get(pk=1)
+        # ...and one that tells them apart, on a page read without the cache.
+        Product.objects.create(pk=2, shop_id=1, name='On Primary', price=Decimal('12.00'))
+        Product.objects.using('replica').create(pk=2, shop_id=1, name='On Replica', price=Decimal('12.00'))
+        self.reviews_url = '/product-reviews/2/'
+
+    def test_catalog_reads_use_the_replica_in_requests(self):
+        """Test that requests read the catalog from the replica and everything else from the primary"""
+        from main_app.routers import ReplicaRouter, RequestRouting, current_routing
+        router = ReplicaRouter()
+        with self.settings(DATABASE_REPLICAS=['replica']):
+            self.assertIsNone(router.db_for_read(Product))
+            token = current_routing.set(RequestRouting())
+            try:
+                self.assertEqual(router.db_for_read(Product), 'replica')
+                self.assertEqual(router.db_for_read(ProductReview), 'replica')
+                for model in (Cart, Budget, SelectedProduct, Wishlist):
+                    self.assertIsNone(router.db_for_read(model))
+            finally:
+                current_routing.reset(token)
+
+            response = self.client.get(self.reviews_url)
+            self.assertContains(response, 'On Replica')
+            self.assertNotContains(response, 'On Primary')
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        """Test that after a write the same and later requests read from the primary"""
+        from django.core.cache import cache
+        with self.settings(DATABASE_REPLICAS=['replica'], REPLICA_PIN_SECONDS=30):
+            response = self.client.get(f'/add-to-cart/{self.product.id}/')
+            self.assertEqual(response.status_code, 302)
+            self.assertIn('primary_pin', response.cookies)
+            self.assertEqual(Cart.objects.get().quantity, 1)
+
+            cache.clear()
+            response = self.client.get(self.reviews_url)
+            self.assertContains(response, 'On Primary')
+
+            self.client.cookies.pop('primary_pin')
+            cache.clear()
+            self.assertContains(self.client.get(self.reviews_url), 'On Replica')
+
+    def test_cached_fragments_are_computed_on_the_primary(self):
+        """Test that a fragment recomputed after a bump never caches a lagging replica's rows"""
+        from main_app.catalog_cache import bump
+        with self.settings(DATABASE_REPLICAS=['replica']):
+            self.assertContains(self.client.get('/shop/1/'), 'Lamp')
+            # The replica has not seen the rename yet.
+            Product.objects.filter(pk=1).update(name='Brass Lamp')
+            bump('product:1', 'shop:1', 'classification:1')
+            self.assertContains(self.client.get('/shop/1/'), 'Brass Lamp')
+
+
+class SyntheticDataTest(TestCase):
+    def test_generate_bulk_creates_consistent_data(self):
+        """Test that generated data has unique user lines and matching rating aggregates"""
+        from django.core.management import call_command
+        from django.db.models import Count
+        call_command('generate_data', classifications=2, shops=5, products=60, users=20,
+                     seed=7, batch_size=25, stdout=StringIO())
+
+        self.assertEqual(Product.objects.count(), 60)
+        self.assertEqual(UserProfile.objects.filter(user__username__startswith='user-').count(), 20)
+        self.assertFalse(Cart.objects.values('user', 'product').annotate(n=Count('id')).filter(n__gt=1).exists())
+        for product in Product.objects.filter(rating_count__gt=0):
+            ratings = list(product.reviews.values_list('rating', flat=True))
+            self.assertEqual(product.rating_count, len(ratings))
+            self.assertEqual(product.rating_sum, sum(ratings))
+
+    def test_benchmark_reports_every_read_route(self):
+        """Test that the benchmark covers the read routes and flags regressions against a baseline"""
+        from main_app.benchmark import compare, run_benchmark
+        from main_app.synthetic import generate
+        generate({'classifications': 1, 'shops': 2, 'products': 10, 'users': 3}, seed=3)
+
+        results = run_benchmark(requests=2, warmup=0)
+        self.assertEqual(results['meta']['target'], 'test-client')
+        self.assertIn('cart', results['routes'])
+        self.assertIn('add_to_cart', results['meta']['skipped'])
+        cart = results['routes']['cart']
+        self.assertLessEqual(cart['p50_ms'], cart['p99_ms'])
+        self.assertEqual(cart['statuses'], {'200': 2})
+
+        baseline = {'routes': {'cart': dict(cart, p95_ms=cart['p95_ms'] / 10, queries=cart['queries'] - 1)}}
+        self.assertEqual(len(compare(results, baseline)), 2)
+
+
+class CatalogImportTest(TestCase):
+    def setUp(self):
+        self.classification = Classification.objects.create(name='Lighting')
+        self.admin = User.objects.create_superuser(username='admin', password='12345')
+
+    def import_text(self, content, kind, fmt='csv', **kwargs):
+        from main_app.catalog_import import import_catalog
+        return import_catalog(StringIO(content), kind, fmt, **kwargs)
+
+    def test_import_upserts_and_reports_rejects(self):
+        """Test that shops and products are upserted on external_id and bad rows are rejected"""
+        shops = self.import_text(
+            'external_id,name,classification,phone\n'
+            'S1,Lamp House,lighting,123\n'
+            'S2,Nowhere,Unknown Category,\n', 'shops')
+        self.assertEqual((shops.upserted, shops.rejected), (1, 1))
+        self.assertIn('Unknown classification', shops.rejects[0].reason)
+
+        products = self.import_text(
+            '{"external_id": "P1", "shop": "S1", "name": "Desk Lamp", "price": "12.50"}\n'
+            '{"external_id": "P2", "shop": "S1", "name": "Floor Lamp", "price": "12.345"}\n'
+            '{"external_id": "P3", "shop": "S9", "name": "Lost Lamp", "price": "5"}\n'
+            'not json\n'
+            '{"external_id": "P1", "shop": "S1", "name": "Desk Lamp", "price": "14.00", "is_available": "no"}\n',
+            'products', 'jsonl', batch_size=2)
+        self.assertEqual((products.upserted, products.rejected), (2, 3))
+        self.assertEqual([reject.line for reject in products.rejects], [2, 3, 4])
+
+        product = Product.objects.get(external_id='P1')
+        self.assertEqual(product.price, Decimal('14.00'))
+        self.assertFalse(product.is_available)
+        self.assertEqual(Product.objects.filter(external_id='P1').count(), 1)
+
+        from main_app.search import search_catalog
+        self.assertEqual([r.object for r in search_catalog('desk').results], [product])
+
+    def test_image_urls_are_fetched_by_the_task_worker(self):
+        """Test that image URLs are queued once per product and URL"""
+        self.import_text('external_id,name,classification\nS1,Lamp House,Lighting\n', 'shops')
+        content = 'external_id,shop,name,price,image_url\nP1,S1,Desk Lamp,10,https://example.com/lamp.jpg\n'
+        self.assertEqual(self.import_text(content, 'products').images_queued, 1)
+        self.import_text(content, 'products')
+        self.assertEqual(Task.objects.filter(name='catalog.fetch_image').count(), 1)
+
+        rejected = self.import_text(content.replace('https://', 'file://'), 'products')
+        self.assertEqual(rejected.rejected, 1)
+
+    def test_admin_upload(self):
+        """Test that staff can import a file from the product admin"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        self.import_text('external_id,name,classification\nS1,Lamp House,Lighting\n', 'shops')
+        self.client.login(username='admin', password='12345')
+        upload = SimpleUploadedFile('catalog.csv', b'external_id,shop,name,price\nP1,S1,Desk Lamp,9.99\n')
+        response = self.client.post('/admin/main_app/product/import/', {'file': upload}, follow=True)
+        self.assertContains(response, '1 upserted')
+        self.assertTrue(Product.objects.filter(external_id='P1', price=Decimal('9.99')).exists())
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user(username='staff', password='12345', is_staff=True)
+        self.shopper = User.objects.create_user(username='shopper', password='12345')
+        classification = Classification.objects.create(name='Tiles')
+        self.shop = Shop.objects.create(name='Tile Masters', classification=classification)
+        for i in range(5):
+            product = Product.objects.create(shop=self.shop, name=f'Tile {i}', price=Decimal('4.50'))
+            Cart.objects.create(user=self.shopper, product=product, quantity=2)
+        Cart.objects.create(user=self.staff, product=product, quantity=1)
+
+    def test_export_requires_staff(self):
+        """Test that exports are staff-only"""
+        self.client.login(username='shopper', password='12345')
+        self.assertEqual(self.client.get('/export/products/').status_code, 302)
+
+    def test_streams_csv_with_related_columns_in_constant_queries(self):
+        """Test that the CSV export streams rows with joined shop columns"""
+        self.client.login(username='staff', password='12345')
+        response = self.client.get('/export/products/')
+        self.assertTrue(response.streaming)
+        with self.assertNumQueries(1):
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].startswith('id,external_id,shop_id,shop,'))
+        self.assertIn('Tile Masters', lines[1])
+
+    def test_streams_in_chunks_under_asgi(self):
+        """Test that under ASGI the export is sent as it is read, not buffered whole"""
+        from unittest import mock
+        from asgiref.sync import async_to_sync
+        from django.core.handlers.asgi import ASGIHandler
+        from django.core.signals import request_finished, request_started
+        from django.db import close_old_connections
+        from main_app.benchmark import asgi_get, session_cookie
+        # As the test client does, keep the handler from closing the test's connection.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        with mock.patch('main_app.exports.ASYNC_BATCH_LINES', 2):
+            messages = async_to_sync(asgi_get)(ASGIHandler(), '/export/products/', session_cookie(self.staff))
+        chunks = [message['body'] for message in messages if message['type'] == 'http.response.body' and message.get('body')]
+        # The header and five rows, two lines per chunk.
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(b''.join(chunks).decode().splitlines()), 6)
+
+    def test_user_lines_as_jsonl(self):
+        """Test that cart lines can be exported as JSONL for one user"""
+        import json
+        self.client.login(username='staff', password='12345')
+        response = self.client.get(f'/export/cart_lines/?format=jsonl&user={self.shopper.id}')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['username'], 'shopper')
+        self.assertEqual(Decimal(rows[0]['line_total']), Decimal('9.00'))
+        self.assertEqual(self.client.get('/export/passwords/').status_code, 404)
+
+    def test_export_command(self):
+        """Test that export_data writes the same stream"""
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('export_data', 'shops', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class AtomicLineMutationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='clicker', password='12345')
+        self.client.login(username='clicker', password='12345')
+        classification = Classification.objects.create(name='Doors')
+        shop = Shop.objects.create(name='Door World', classification=classification)
+        self.product = Product.objects.create(shop=shop, name='Oak Door', price=Decimal('120.00'))
+
+    def test_repeat_adds_increment_one_line(self):
+        """Test that adding a product again increments its single cart and budget line"""
+        for _ in range(3):
+            self.client.get(f'/add-to-cart/{self.product.id}/')
+            self.client.get(f'/add-to-budget/{self.product.id}/')
+        self.assertEqual(list(Cart.objects.values_list('quantity', flat=True)), [3])
+        self.assertEqual(list(SelectedProduct.objects.values_list('quantity', flat=True)), [3])
+
+    def test_add_to_cart_is_one_upsert(self):
+        """Test that a click costs one upsert, plus queuing a recommendations refresh once per window"""
+        from django.core.cache import cache
+        from main_app.budget import add_to_cart
+        cache.clear()
+        with self.assertNumQueries(2):
+            pk, quantity = add_to_cart(self.user, self.product.id, quantity=2)
+        self.assertEqual(quantity, 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(add_to_cart(self.user, self.product.id), (pk, 3))
+
+    def test_unique_lines_are_enforced(self):
+        """Test that a second line for the same product is refused"""
+        from django.db import IntegrityError, transaction
+        Cart.objects.create(user=self.user, product=self.product)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cart.objects.create(user=self.user, product=self.product)
+
+    def test_update_quantity_checks_ownership(self):
+        """Test that quantity updates only touch the user's own lines"""
+        other = User.objects.create_user(username='other', password='12345')
+        line = Cart.objects.create(user=other, product=self.product)
+        response = self.client.post(f'/update-cart-quantity/{line.id}/', {'quantity': 5})
+        self.assertEqual(response.status_code, 404)
+        line.refresh_from_db()
+        self.assertEqual(line.quantity, 1)
+
+
+class JsonLineMutationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='fetcher', password='12345')
+        self.client.login(username='fetcher', password='12345')
+        Budget.objects.create(user=self.user, total=Decimal('500.00'))
+        classification = Classification.objects.create(name='Lamps')
+        shop = Shop.objects.create(name='Lamp Land', classification=classification)
+        self.product = Product.objects.create(shop=shop, name='Desk Lamp', price=Decimal('40.00'))
+
+    def fetch(self, url, data=None):
+        if data is None:
+            return self.client.get(url, HTTP_ACCEPT='application/json')
+        return self.client.post(url, data, HTTP_ACCEPT='application/json')
+
+    def test_cart_add_update_remove(self):
+        """Test that cart mutations answer with the line, totals and budget status"""
+        data = self.fetch(f'/add-to-cart/{self.product.id}/').json()
+        line_id = data['line']['id']
+        self.assertEqual(data['line'], {'id': line_id, 'product_id': self.product.id, 'quantity': 1, 'total': '40.00'})
+        self.assertEqual(data['totals']['cart'], '40.00')
+
+        data = self.fetch(f'/update-cart-quantity/{line_id}/', {'quantity': 15}).json()
+        self.assertEqual(data['line']['quantity'], 15)
+        self.assertEqual(Decimal(data['line']['total']), Decimal('600.00'))
+        self.assertTrue(data['cart_status']['is_over_budget'])
+        self.assertEqual(Decimal(data['cart_status']['over_budget_amount']), Decimal('100.00'))
+
+        data = self.fetch(f'/remove-from-cart/{line_id}/').json()
+        self.assertIsNone(data['line'])
+        self.assertEqual(data['removed'], line_id)
+        self.assertEqual(Decimal(data['totals']['cart']), 0)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_budget_remove(self):
+        """Test that removing a budget line returns the new spent total"""
+        self.fetch(f'/add-to-budget/{self.product.id}/')
+        line = SelectedProduct.objects.get()
+        data = self.fetch(f'/remove-from-budget/{line.id}/').json()
+        self.assertEqual(data['removed'], line.id)
+        self.assertEqual(Decimal(data['totals']['spent']), 0)
+        self.assertEqual(Decimal(data['status']['remaining']), Decimal('500.00'))
+
+    def test_wishlist_add_and_remove(self):
+        """Test that wishlist mutations answer with the item"""
+        data = self.fetch(f'/add-to-wishlist/{self.product.id}/').json()
+        self.assertTrue(data['created'])
+        self.assertFalse(self.fetch(f'/add-to-wishlist/{self.product.id}/').json()['created'])
+        data = self.fetch(f'/remove-from-wishlist/{data["item"]["id"]}/').json()
+        self.assertIsNone(data['item'])
+        self.assertFalse(Wishlist.objects.exists())
+
+    def test_plain_requests_still_redirect(self):
+        """Test that links followed without JavaScript keep redirecting"""
+        response = self.client.get(f'/add-to-cart/{self.product.id}/')
+        self.assertEqual(response.status_code, 302)
+
+
+class BatchLineTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='roomer', password='12345')
+        self.client.login(username='roomer', password='12345')
+        Budget.objects.create(user=self.user, total=Decimal('5000.00'))
+        classification = Classification.objects.create(name='Bedroom')
+        shop = Shop.objects.create(name='Bed Barn', classification=classification)
+        self.products = Product.objects.bulk_create(
+            Product(shop=shop, name=f'Item {i}', price=Decimal('10.00') + i) for i in range(50)
+        )
+
+    def post(self, target, operations):
+        return self.client.post(f'/batch/{target}/', json.dumps({'operations': operations}),
+                                content_type='application/json')
+
+    def test_room_is_added_in_a_handful_of_queries(self):
+        """Test that a 50-item room costs a constant number of queries"""
+        from django.core.cache import cache
+        cache.clear()
+        operations = [[product.id, 2] for product in self.products]
+        # Including one INSERT queuing the user's recommendations refresh.
+        with self.assertNumQueries(10):
+            response = self.post('budget', operations)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['lines']), 50)
+        self.assertEqual(data['lines'][1]['total'], '22.00')
+        self.assertEqual(SelectedProduct.objects.filter(user=self.user).count(), 50)
+        self.assertEqual(Decimal(data['totals']['spent']), sum((p.price * 2 for p in self.products), Decimal(0)))
+
+    def test_batch_increments_existing_and_merges_repeats(self):
+        """Test that batch adds increment existing lines and sum repeated ids"""
+        first, second = self.products[:2]
+        Cart.objects.create(user=self.user, product=first, quantity=3)
+        response = self.post('cart', [{'product_id': first.id, 'quantity': 1}, [second.id, 2], [first.id, 1]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(Cart.objects.values_list('product_id', 'quantity')), {first.id: 5, second.id: 2})
+
+    def test_invalid_batch_writes_nothing(self):
+        """Test that an unknown product or bad quantity rejects the whole batch"""
+        response = self.post('cart', [[self.products[0].id, 1], [999999, 1]])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], ['Unknown product 999999'])
+        self.assertEqual(self.post('cart', [[self.products[0].id, 0]]).status_code, 400)
+        self.assertEqual(self.post('wishlist', [[self.products[0].id, 1]]).status_code, 404)
+        self.assertFalse(Cart.objects.exists())
+
+
+class ConcurrentLineMutationTest(TransactionTestCase):
+    def test_parallel_clicks_do_not_lose_increments(self):
+        """Test that parallel add-to-cart and add-to-budget requests all count"""
+        from concurrent.futures import ThreadPoolExecutor
+        from django.db import connection
+        from django.test import Client
+        user = User.objects.create_user(username='racer', password='12345')
+        classification = Classification.objects.create(name='Windows')
+        shop = Shop.objects.create(name='Window World', classification=classification)
+        product = Product.objects.create(shop=shop, name='Sash Window', price=Decimal('80.00'))
+        Budget.objects.create(user=user, total=Decimal('1000.00'))
+
+        clients = []
+        for _ in range(8):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+
+        def click(client):
+            try:
+                for _ in range(5):
+                    client.get(f'/add-to-cart/{product.id}/')
+                    client.get(f'/add-to-budget/{product.id}/')
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(click, clients))
+
+        self.assertEqual(list(Cart.objects.filter(user=user).values_list('quantity', flat=True)), [40])
+        self.assertEqual(list(SelectedProduct.objects.filter(user=user).values_list('quantity', flat=True)), [40])
@@ -9,11 +9,13 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('accounts/login/', auth_views.LoginView.as_view(), name='accounts_login'),
     path('', views.home_view, name='home'),
+    path('search/', views.search_view, name='search'),
     path('classification/<slug:slug>/', views.classification_stores_view, name='classification_stores'),
     path('shop/<int:shop_id>/', views.shop_products_view, name='shop_products'),
     path('add-shop/<int:classification_id>/', views.add_shop_view, name='add_shop'),
     path('add-product/<int:shop_id>/', views.add_product_view, name='add_product'),
     path('budget/', views.budget_view, name='budget'),
+    path('budget/bundle/', views.bundle_view, name='budget_bundle'),
     path('add-to-budget/<int:product_id>/', views.add_to_budget_view, name='add_to_budget'),
     path('remove-from-budget/<int:selected_product_id>/', views.remove_from_budget_view, name='remove_from_budget'),
     path('update-quantity/<int:selected_product_id>/', views.update_quantity_view, name='update_quantity'),
@@ -21,6 +23,7 @@ urlpatterns = [
     path('add-to-cart/<int:product_id>/', views.add_to_cart_view, name='add_to_cart'),
     path('remove-from-cart/<int:cart_item_id>/', views.remove_from_cart_view, name='remove_from_cart'),
     path('update-cart-quantity/<int:cart_item_id>/', views.update_cart_quantity_view, name='update_cart_quantity'),
+    path('batch/<str:target>/', views.batch_lines_view, name='batch_lines'),
 
     path('wishlist/', views.wishlist_view, name='wishlist'),
     path('add-to-wishlist/<int:product_id>/', views.add_to_wishlist_view, name='add_to_wishlist'),
@@ -29,11 +32,14 @@ urlpatterns = [
 
     path('add-review/<int:product_id>/', views.add_review_view, name='add_review'),
     path('product-reviews/<int:product_id>/', views.product_reviews_view, name='product_reviews'),
+    path('review/<int:review_id>/helpful/', views.review_helpful_view, name='review_helpful'),
     path('edit-review/<int:review_id>/', views.edit_review_view, name='edit_review'),   
     path('delete-review/<int:review_id>/', views.delete_review_view, name='delete_review'), 
 
     path('about/', views.about_view, name='about'),
 
+    path('export/<str:name>/', views.export_view, name='export'),
+
     path('profile/', views.profile_view, name='profile'),
     path('update-profile/', views.update_profile_view, name='update_profile'),
     path('change-password/', views.change_password_view, name='change_password'),
@@ -1,18 +1,47 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import require_POST
 from django.contrib.auth.models import User
-from .models import Classification, Shop, Product, Budget, SelectedProduct, Cart, Wishlist, ProductReview, BudgetEstimate, UserProfile
+from django.core.handlers.asgi import ASGIRequest
+from decimal import Decimal, InvalidOperation
+import json
+from .models import Classification, Shop, Product, Budget, SelectedProduct, Cart, Wishlist, ProductReview, HelpfulVote, BudgetEstimate, UserProfile, ClassificationPriceStats
+from .budget import CENT, BatchError, BudgetSummary, add_to_budget, add_to_cart, apply_batch, get_or_create_budget, line_total
+from .bundles import BundleOptionsError, bundle_json, parse_options, suggest_bundle
+from .facets import FACETS, NO_FILTERS, facet_cells, facet_counts, filter_params, filter_query, parse_filters, product_filter
+from .recommendations import planned_together, shop_planned_together
+from .search import search_catalog
+from .similarity import SCOPE as SIMILAR_SCOPE, similar_products
+from .pagination import KeysetPaginator
+from .catalog_cache import acached_fragment, bump, cached_fragment, conditional_page
+from .exports import EXPORTS, FORMATS, astream_export, stream_export
 
 
 def is_admin(user):
     return user.is_superuser
 
 
+# The catalog and review pages below are async views. Under ASGI
+# (Baytdesign/asgi.py, see the README) every middleware is async-capable,
+# so they run on the event loop. The async ORM still runs each query in a
+# thread, as does the template render, where lazy lookups such as the
+# user's profile picture are allowed: a request takes a thread while a
+# query or render runs, not for its whole lifetime.
+arender = sync_to_async(render)
+
+async def alist(queryset):
+    return [obj async for obj in queryset]
+
+
 def signup_view(request):
     if request.method == "POST":
         form = UserCreationForm(request.POST)
@@ -42,28 +71,189 @@ def logout_view(request):
 
 
 
-def home_view(request):
-    classifications = Classification.objects.all()
-    return render(request, 'home.html', {'classifications': classifications})
+def get_classification(slug):
+    return cached_fragment(
+        ('classification', slug), ['catalog'],
+        lambda: get_object_or_404(Classification, slug=slug)
+    )
+
+def get_shop(shop_id):
+    return cached_fragment(
+        ('shop', shop_id), [f'shop:{shop_id}'],
+        lambda: get_object_or_404(Shop.objects.select_related('classification'), id=shop_id)
+    )
+
+async def aget_classification(slug):
+    return await acached_fragment(
+        ('classification', slug), ['catalog'],
+        lambda: aget_object_or_404(Classification, slug=slug)
+    )
+
+async def aget_shop(shop_id):
+    return await acached_fragment(
+        ('shop', shop_id), [f'shop:{shop_id}'],
+        lambda: aget_object_or_404(Shop.objects.select_related('classification'), id=shop_id)
+    )
+
+def classification_scopes(slug):
+    try:
+        return [f'classification:{get_classification(slug).pk}']
+    except Http404:
+        return None
+
+def shop_scopes(shop_id):
+    try:
+        get_shop(shop_id)
+    except Http404:
+        return None
+    return [f'shop:{shop_id}']
+
+def product_reviews_scopes(product_id):
+    try:
+        cached_fragment(
+            ('product_exists', product_id), [f'product:{product_id}'],
+            lambda: get_object_or_404(Product.objects.values_list('pk', flat=True), pk=product_id)
+        )
+    except Http404:
+        return None
+    return [f'product:{product_id}', SIMILAR_SCOPE]
+
+@conditional_page('home', lambda: ['catalog'])
+async def home_view(request):
+    classifications = await acached_fragment(
+        ('home', 'classifications'), ['catalog'], lambda: alist(Classification.objects.all())
+    )
+    return await arender(request, 'home.html', {'classifications': classifications})
+
+def search_view(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+    results = search_catalog(query, page=page)
+    return render(request, 'search.html', {'query': query, 'results': results})
+
+# Listing sort orders: key -> (label, keyset ordering). Each one is backed
+# by a composite index declared on the model.
+SHOP_SORTS = {
+    'name': ('Name', ('name', 'pk')),
+    'newest': ('Newest', ('-pk',)),
+}
+
+PRODUCT_SORTS = {
+    'newest': ('Newest', ('-pk',)),
+    'price': ('Price: low to high', ('price', 'pk')),
+    'price_desc': ('Price: high to low', ('-price', '-pk')),
+    'name': ('Name', ('name', 'pk')),
+    'rating': ('Top rated', ('-rating_avg', '-pk')),
+}
+
+# Ties break in the direction of the sort, so the (product, <field>, id)
+# indexes on ProductReview serve each order read forwards or backwards.
+REVIEW_SORTS = {
+    'newest': ('Newest', ('-created_at', '-pk')),
+    'highest': ('Highest rated', ('-rating', '-pk')),
+    'lowest': ('Lowest rated', ('rating', 'pk')),
+    'helpful': ('Most helpful', ('-helpful_count', '-pk')),
+}
+
+LISTING_PAGE_SIZE = 24
+
+REVIEW_PAGE_SIZE = 20
+
+
+def listing_params(request, sorts, default_sort):
+    sort = request.GET.get('sort', default_sort)
+    if sort not in sorts:
+        sort = default_sort
+    return sort, request.GET.get('cursor') or None
+
+def apaginate_listing(queryset, sorts, sort, cursor):
+    return KeysetPaginator(queryset, sorts[sort][1], per_page=LISTING_PAGE_SIZE).apage(cursor)
+
+async def alisting_page(parts, scopes, queryset, sorts, sort, cursor):
+    """
+    The listing page at `cursor`. Only first pages are cached: a cursor is
+    whatever the client sends, and later pages are cheap keyset queries.
+    """
+    if cursor:
+        return await apaginate_listing(queryset, sorts, sort, cursor)
+    return await acached_fragment((*parts, sort), scopes, lambda: apaginate_listing(queryset, sorts, sort, None))
+
+# Facets offered on each listing; a shop page lists a single shop.
+SHOP_PAGE_FACETS = ('price', 'availability', 'rating')
+
+
+def listing_filters(request, facets, cells):
+    """The page's Filters and its facet context: counts, the active filters and their query string."""
+    filters = parse_filters(request.GET, facets)
+    # Only shops on the page can be filtered on, so other ids never reach a cache key.
+    shop_ids = {cell[0] for cell in cells or ()}
+    filters = filters._replace(shop=tuple(pk for pk in filters.shop if pk in shop_ids))
+    return filters, {
+        'facets': facet_counts(cells, filters, facets) if cells else None,
+        'filtered': filters != NO_FILTERS,
+        'filter_params': filter_params(filters),
+        'filter_query': filter_query(filters),
+    }
 
 @login_required
-def classification_stores_view(request, slug):
-    classification = get_object_or_404(Classification, slug=slug)
-    shops = Shop.objects.filter(classification=classification)
-    return render(request, 'classification_stores.html', {
+@conditional_page('classification', classification_scopes)
+async def classification_stores_view(request, slug):
+    classification = await aget_classification(slug)
+    sort, cursor = listing_params(request, SHOP_SORTS, 'name')
+    scopes = [f'classification:{classification.pk}']
+    cells = await acached_fragment(
+        ('facet_cells', 'classification', classification.pk), scopes,
+        lambda: sync_to_async(facet_cells)(Product.objects.filter(shop__classification=classification))
+    )
+    filters, facet_context = listing_filters(request, FACETS, cells)
+    shops = Shop.objects.filter(classification=classification).select_related('price_stats')
+    if facet_context['filtered']:
+        # Only the shops with a product passing the filters.
+        shops = shops.filter(Exists(Product.objects.filter(product_filter(filters), shop=OuterRef('pk'))))
+    page = await alisting_page(('classification_shops', classification.pk, filters), scopes,
+                               shops, SHOP_SORTS, sort, cursor)
+    if facet_context['filtered']:
+        for shop in page.object_list:
+            shop.matching_count = facet_context['facets'].shop_counts.get(shop.pk, 0)
+    return await arender(request, 'classification_stores.html', {
         'classification': classification,
-        'shops': shops
+        'shops': page.object_list,
+        'page': page,
+        'sort': sort,
+        'sort_options': [(key, label) for key, (label, ordering) in SHOP_SORTS.items()],
+        **facet_context,
     })
 
 
 
 @login_required
-def shop_products_view(request, shop_id):
-    shop = get_object_or_404(Shop, id=shop_id)
-    products = Product.objects.filter(shop=shop)
-    return render(request, 'shop_products.html', {
+@conditional_page('shop', shop_scopes)
+async def shop_products_view(request, shop_id):
+    shop = await aget_shop(shop_id)
+    sort, cursor = listing_params(request, PRODUCT_SORTS, 'newest')
+    cells = await acached_fragment(
+        ('facet_cells', 'shop', shop_id), [f'shop:{shop_id}'],
+        lambda: sync_to_async(facet_cells)(Product.objects.filter(shop_id=shop_id))
+    )
+    filters, facet_context = listing_filters(request, SHOP_PAGE_FACETS, cells)
+    page = await alisting_page(('shop_products', shop_id, filters), [f'shop:{shop_id}'],
+                               Product.objects.filter(product_filter(filters), shop=shop),
+                               PRODUCT_SORTS, sort, cursor)
+    planned_together = await acached_fragment(
+        ('shop_planned_together', shop_id), [f'shop:{shop_id}'],
+        lambda: sync_to_async(shop_planned_together)(shop_id)
+    )
+    return await arender(request, 'shop_products.html', {
         'shop': shop,
-        'products': products
+        'products': page.object_list,
+        'page': page,
+        'planned_together': planned_together,
+        'sort': sort,
+        'sort_options': [(key, label) for key, (label, ordering) in PRODUCT_SORTS.items()],
+        **facet_context,
     })
 
 
@@ -79,18 +269,16 @@ def add_shop_view(request, classification_id):
         email = request.POST.get('email', '')
         image = request.FILES.get('image')
         
-        shop = Shop.objects.create(
+        # One save with the image; resizing is queued for the task worker.
+        Shop.objects.create(
             name=name,
             description=description,
             address=address,
             phone=phone,
             email=email,
-            classification=classification
+            classification=classification,
+            image=image,
         )
-        
-        if image:
-            shop.image = image
-            shop.save()
             
         return redirect('classification_stores', slug=classification.slug)
     return render(request, 'add_shop.html', {'classification': classification})
@@ -105,17 +293,15 @@ def add_product_view(request, shop_id):
         is_available = request.POST.get('is_available') == 'true'
         image = request.FILES.get('image')
         
-        product = Product.objects.create(
+        # One save with the image; resizing is queued for the task worker.
+        Product.objects.create(
             name=name,
             description=description,
             price=price,
             is_available=is_available,
-            shop=shop
+            shop=shop,
+            image=image,
         )
-        
-        if image:
-            product.image = image
-            product.save()
             
         return redirect('shop_products', shop_id=shop.id)
     return render(request, 'add_product.html', {'shop': shop})
@@ -124,30 +310,7 @@ def add_product_view(request, shop_id):
 
 @login_required
 def budget_view(request):
-    from decimal import Decimal, InvalidOperation
-    
-
-    budget = None
-    
-
-    try:
-
-        budget = Budget.objects.filter(user=request.user).first()
-        if not budget:
-
-            budget = Budget.objects.create(user=request.user, total=Decimal('0'))
-            budget.save()
-
-        Decimal(str(budget.total))
-    except (InvalidOperation, ValueError):
-
-        if budget:
-            budget.total = Decimal('0')
-            budget.save()
-        else:
-            budget = Budget.objects.create(user=request.user, total=Decimal('0'))
-            budget.save()
-    
+    budget = get_or_create_budget(request.user)
 
     if request.method == "POST":
         new_budget = request.POST.get('budget')
@@ -166,87 +329,56 @@ def budget_view(request):
 
                 messages.error(request, f"Invalid budget amount. Please enter a valid number.")
 
-    
-    selected_products = SelectedProduct.objects.filter(budget=budget, user=request.user)
-    
-
-    for product in selected_products:
-        try:
-            product.total_price = product.product.price * product.quantity
-        except (InvalidOperation, TypeError):
-
-            product.total_price = Decimal('0')
-    
-
-    cart_items = Cart.objects.filter(user=request.user)
-    cart_total = Decimal('0')
-    for item in cart_items:
-        try:
-            cart_total += item.product.price * item.quantity
-        except (InvalidOperation, TypeError):
-
-            pass
-    
-
-    budget_products_total = Decimal('0')
-    for p in selected_products:
-        try:
-            budget_products_total += p.total_price
-        except (InvalidOperation, TypeError):
-
-            pass
-    
-    total_spent = budget_products_total + cart_total
-
-    try:
-        remaining_budget = budget.total - total_spent
-    except (InvalidOperation, TypeError):
-        remaining_budget = Decimal('0')
-        
-    try:
-        if budget.total > 0:
-            budget_percentage = (total_spent / budget.total * Decimal('100'))
-
-        else:
-            budget_percentage = Decimal('0')
-    except (InvalidOperation, TypeError, ZeroDivisionError):
-        budget_percentage = Decimal('0')
-        
-    try:
-
-        is_over_budget = total_spent > budget.total
-    except (InvalidOperation, TypeError):
-        is_over_budget = False
-        
-    try:
-        is_near_budget = total_spent > (budget.total * Decimal('0.9')) if budget.total > 0 else False
-    except (InvalidOperation, TypeError):
-        is_near_budget = False
+    summary = BudgetSummary(request.user, budget=budget)
+    status = summary.status
 
     return render(request, 'budget.html', {
+        'bundle': suggest_bundle(request.user, summary),
+        # Typical prices per classification, precomputed by price_stats.py.
+        'price_hints': (
+            ClassificationPriceStats.objects
+            .filter(product_count__gt=0)
+            .select_related('classification')
+            .order_by('classification__name')
+        ),
         'budget': budget,
-        'selected_products': selected_products,
-        'total_spent': total_spent,
-        'remaining_budget': remaining_budget,
-        'budget_percentage': budget_percentage,
-        'is_over_budget': is_over_budget,
-        'is_near_budget': is_near_budget,
+        'selected_products': summary.selected_products,
+        'total_spent': summary.total_spent,
+        'remaining_budget': status.remaining,
+        'budget_percentage': status.percentage,
+        'is_over_budget': status.is_over_budget,
+        'is_near_budget': status.is_near_budget,
         'budget_created_at': budget.created_at
     })
 
+def wants_json(request):
+    """True for the fetch() calls made by static/js/line_updates.js."""
+    return 'application/json' in request.headers.get('Accept', '')
+
+def line_json(line):
+    """JSON for a cart or budget line annotated with `total_price`, or None if it was removed."""
+    if line is None:
+        return None
+    return {'id': line['id'], 'product_id': line['product_id'], 'quantity': line['quantity'],
+            'total': Decimal(line['total_price']).quantize(CENT)}
+
+def budget_response(request, line=None, **extra):
+    """The changed line plus fresh totals and budget status, instead of a redirect."""
+    return JsonResponse({'line': line_json(line), **BudgetSummary(request.user).as_json(), **extra})
+
+def annotated_line(model, pk):
+    return model.objects.filter(pk=pk).annotate(total_price=line_total()).values(
+        'id', 'product_id', 'quantity', 'total_price'
+    ).first()
+
 @login_required
 def add_to_budget_view(request, product_id):
     product = get_object_or_404(Product, id=product_id)
-    budget, created = Budget.objects.get_or_create(user=request.user)
-    
-    existing_selection = SelectedProduct.objects.filter(product=product, budget=budget, user=request.user).first()
-    
-    if existing_selection:
-        existing_selection.quantity += 1
-        existing_selection.save()
-    else:
-        SelectedProduct.objects.create(product=product, budget=budget, user=request.user)
-    
+    pk, quantity = add_to_budget(get_or_create_budget(request.user), product.id)
+
+    if wants_json(request):
+        line = {'id': pk, 'product_id': product.id, 'quantity': quantity, 'total_price': product.price * quantity}
+        return budget_response(request, line)
 
     referer = request.META.get('HTTP_REFERER')
     if referer:
@@ -255,130 +387,144 @@ def add_to_budget_view(request, product_id):
 
 @login_required
 def remove_from_budget_view(request, selected_product_id):
-    budget = Budget.objects.get_or_create(user=request.user)[0]
-    selected_product = get_object_or_404(SelectedProduct, id=selected_product_id, user=request.user, budget=budget)
-    selected_product.delete()
+    deleted, _ = SelectedProduct.objects.filter(id=selected_product_id, user=request.user).delete()
+    if not deleted:
+        raise Http404("No such budget line")
+    if wants_json(request):
+        return budget_response(request, removed=selected_product_id)
     return redirect('budget')
 
 @login_required
 def update_quantity_view(request, selected_product_id):
-    selected_product = get_object_or_404(SelectedProduct, id=selected_product_id, user=request.user)
+    selected_product = SelectedProduct.objects.filter(id=selected_product_id, user=request.user)
     new_quantity = int(request.POST.get('quantity', 1))
-    
+
+    # One UPDATE (or DELETE) that also checks ownership.
     if new_quantity > 0:
-        selected_product.quantity = new_quantity
-        selected_product.save()
+        changed = selected_product.update(quantity=new_quantity)
     else:
-        selected_product.delete()
-    
-    return redirect('budget')
+        changed, _ = selected_product.delete()
+    if not changed:
+        raise Http404("No such budget line")
 
+    if wants_json(request):
+        return budget_response(request, annotated_line(SelectedProduct, selected_product_id),
+                               removed=None if new_quantity > 0 else selected_product_id)
+    return redirect('budget')
 
 @login_required
 def cart_view(request):
-    from decimal import Decimal, InvalidOperation
-    
-    cart_items = Cart.objects.filter(user=request.user)
+    summary = BudgetSummary(request.user)
+    status = summary.cart_status
+    in_cart = [item.product_id for item in summary.cart_items]
 
-    total_price = Decimal('0')
-    for item in cart_items:
-        try:
-            total_price += item.product.price * item.quantity
-        except (InvalidOperation, TypeError):
-
-            pass
-    
-
-    budget = None
-    
-
-    try:
-
-        budget = Budget.objects.filter(user=request.user).first()
-        if not budget:
-            budget = Budget.objects.create(user=request.user, total=Decimal('0'))
-
-        Decimal(str(budget.total))
-    except (InvalidOperation, ValueError):
-
-        if budget:
-            budget.total = Decimal('0')
-            budget.save()
-        else:
-            budget = Budget.objects.create(user=request.user, total=Decimal('0'))
-    
-    try:
-        is_over_budget = total_price > budget.total if budget.total > 0 else False
-        over_budget_amount = total_price - budget.total if is_over_budget else Decimal('0')
-        budget_percentage = (total_price / budget.total * Decimal('100')) if budget.total > 0 else Decimal('0')
-        is_near_budget = total_price > (budget.total * Decimal('0.9')) if budget.total > 0 else False
-    except (InvalidOperation, TypeError, ZeroDivisionError):
-        is_over_budget = False
-        over_budget_amount = Decimal('0')
-        budget_percentage = Decimal('0')
-        is_near_budget = False
-    
     return render(request, 'cart.html', {
-        'cart_items': cart_items,
-        'total_price': total_price,
-        'budget': budget.total,
-        'is_over_budget': is_over_budget,
-        'over_budget_amount': over_budget_amount,
-        'budget_percentage': budget_percentage,
-        'is_near_budget': is_near_budget,
+        'cart_items': summary.cart_items,
+        'planned_together': planned_together(in_cart, exclude=in_cart) if in_cart else [],
+        'total_price': summary.cart_total,
+        'budget': summary.budget.total,
+        'is_over_budget': status.is_over_budget,
+        'over_budget_amount': status.over_budget_amount,
+        'budget_percentage': status.percentage,
+        'is_near_budget': status.is_near_budget,
     })
 
 @login_required
 def add_to_cart_view(request, product_id):
     product = get_object_or_404(Product, id=product_id)
-    cart_item, created = Cart.objects.get_or_create(
-        user=request.user,
-        product=product,
-        defaults={'quantity': 1}
-    )
-    
-    if not created:
-        cart_item.quantity += 1
-        cart_item.save()
-    
+    pk, quantity = add_to_cart(request.user, product.id)
+
+    if wants_json(request):
+        line = {'id': pk, 'product_id': product.id, 'quantity': quantity, 'total_price': product.price * quantity}
+        return budget_response(request, line)
+
     messages.success(request, f'{product.name} added to cart!')
 
     referer = request.META.get('HTTP_REFERER')
     if referer:
         return redirect(referer)
-    return redirect('shop_products', shop_id=product.shop.id)
+    return redirect('shop_products', shop_id=product.shop_id)
 
 @login_required
 def remove_from_cart_view(request, cart_item_id):
-    cart_item = get_object_or_404(Cart, id=cart_item_id, user=request.user)
-    cart_item.delete()
+    deleted, _ = Cart.objects.filter(id=cart_item_id, user=request.user).delete()
+    if not deleted:
+        raise Http404("No such cart item")
+    if wants_json(request):
+        return budget_response(request, removed=cart_item_id)
     messages.success(request, 'Item removed from cart!')
     return redirect('cart')
 
 @login_required
 def update_cart_quantity_view(request, cart_item_id):
-    cart_item = get_object_or_404(Cart, id=cart_item_id, user=request.user)
+    cart_item = Cart.objects.filter(id=cart_item_id, user=request.user)
     new_quantity = int(request.POST.get('quantity', 1))
-    
+
+    # One UPDATE (or DELETE) that also checks ownership.
     if new_quantity > 0:
-        cart_item.quantity = new_quantity
-        cart_item.save()
+        changed = cart_item.update(quantity=new_quantity)
     else:
-        cart_item.delete()
-    
+        changed, _ = cart_item.delete()
+    if not changed:
+        raise Http404("No such cart item")
+
+    if wants_json(request):
+        return budget_response(request, annotated_line(Cart, cart_item_id),
+                               removed=None if new_quantity > 0 else cart_item_id)
     return redirect('cart')
 
+@login_required
+@require_POST
+def batch_lines_view(request, target):
+    """
+    Add many products to the cart or budget in one request. The body is
+    JSON: {"operations": [[product_id, quantity], ...]} (or objects with
+    product_id and quantity). Either every operation is applied or, with
+    a 400 listing the errors, none is.
+    """
+    if target not in ('cart', 'budget'):
+        raise Http404("Unknown batch target")
+    try:
+        operations = json.loads(request.body).get('operations')
+    except (ValueError, AttributeError):
+        return JsonResponse({'errors': ['Body must be a JSON object']}, status=400)
+    budget = get_or_create_budget(request.user)
+    try:
+        lines = apply_batch(request.user, target, operations, budget=budget)
+    except BatchError as error:
+        return JsonResponse({'errors': error.errors}, status=400)
+    summary = BudgetSummary(request.user, budget)
+    return JsonResponse({'lines': [line_json(line) for line in lines], **summary.as_json()})
+
+@login_required
+def bundle_view(request):
+    """
+    The suggested bundle for the remaining budget, as JSON. A POST may send
+    {"requirements": {classification_id: units}, "priorities": {product_id:
+    weight}, "quantities": {product_id: units}} to steer it.
+    """
+    options = {}
+    if request.method == 'POST':
+        try:
+            options = parse_options(json.loads(request.body))
+        except ValueError as error:
+            errors = error.errors if isinstance(error, BundleOptionsError) else ['Body must be a JSON object']
+            return JsonResponse({'errors': errors}, status=400)
+    return JsonResponse(bundle_json(suggest_bundle(request.user, **options)))
 
 @login_required
 def wishlist_view(request):
-    wishlist_items = Wishlist.objects.filter(user=request.user)
+    wishlist_items = Wishlist.objects.filter(user=request.user).select_related('product')
     return render(request, 'wishlist.html', {'wishlist_items': wishlist_items})
 
 @login_required
 def add_to_wishlist_view(request, product_id):
     product = get_object_or_404(Product, id=product_id)
     wishlist_item, created = Wishlist.objects.get_or_create(user=request.user, product=product)
-    
+
+    if wants_json(request):
+        return JsonResponse({'item': {'id': wishlist_item.id, 'product_id': product.id}, 'created': created})
+
     if created:
         messages.success(request, f'{product.name} added to your list!')
     else:
@@ -388,12 +534,15 @@ def add_to_wishlist_view(request, product_id):
     referer = request.META.get('HTTP_REFERER')
     if referer:
         return redirect(referer)
-    return redirect('shop_products', shop_id=product.shop.id)
+    return redirect('shop_products', shop_id=product.shop_id)
 
 @login_required
 def remove_from_wishlist_view(request, wishlist_item_id):
-    wishlist_item = get_object_or_404(Wishlist, id=wishlist_item_id, user=request.user)
-    wishlist_item.delete()
+    deleted, _ = Wishlist.objects.filter(id=wishlist_item_id, user=request.user).delete()
+    if not deleted:
+        raise Http404("No such wishlist item")
+    if wants_json(request):
+        return JsonResponse({'item': None, 'removed': wishlist_item_id})
     messages.success(request, 'Item removed from your list!')
     return redirect('wishlist')
 
@@ -432,17 +581,55 @@ def add_review_view(request, product_id):
     return render(request, 'add_review.html', {'product': product})
 
 @login_required
-def product_reviews_view(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    reviews = ProductReview.objects.filter(product=product).order_by('-created_at')
-    avg_rating = sum([review.rating for review in reviews]) / len(reviews) if reviews else 0
-    
-    return render(request, 'product_reviews.html', {
+@conditional_page('product_reviews', product_reviews_scopes)
+async def product_reviews_view(request, product_id):
+    product = await aget_object_or_404(Product.objects.select_related('shop__classification'), id=product_id)
+    sort, cursor = listing_params(request, REVIEW_SORTS, 'newest')
+    # The average, count and histogram come from the aggregates stored on
+    # the product; only the page of reviews itself is read here.
+    reviews = ProductReview.objects.filter(product=product).select_related('user', 'user__userprofile')
+    page = await KeysetPaginator(reviews, REVIEW_SORTS[sort][1], per_page=REVIEW_PAGE_SIZE).apage(cursor)
+    similar = await acached_fragment(
+        ('similar_products', product_id), [f'product:{product_id}', SIMILAR_SCOPE],
+        lambda: sync_to_async(similar_products)(product_id)
+    )
+
+    return await arender(request, 'product_reviews.html', {
         'product': product,
-        'reviews': reviews,
-        'avg_rating': avg_rating,
+        'reviews': page.object_list,
+        'similar_products': similar,
+        'page': page,
+        'sort': sort,
+        'sort_options': [(key, label) for key, (label, ordering) in REVIEW_SORTS.items()],
+        'avg_rating': product.avg_rating,
+        'rating_histogram': product.rating_histogram,
     })
 
+@login_required
+@require_POST
+def review_helpful_view(request, review_id):
+    review = get_object_or_404(ProductReview.objects.only('pk', 'product_id', 'user_id'), id=review_id)
+    voted = False
+    if review.user_id != request.user.id:
+        with transaction.atomic():
+            vote, voted = HelpfulVote.objects.get_or_create(review=review, user=request.user)
+            if voted:
+                ProductReview.objects.filter(pk=review.pk).update(
+                    helpful_count=F('helpful_count') + 1, updated_at=timezone.now()
+                )
+        if voted:
+            bump(f'product:{review.product_id}')
+    helpful_count = ProductReview.objects.filter(pk=review.pk).values_list('helpful_count', flat=True).first()
+
+    if wants_json(request):
+        return JsonResponse({'review_id': review.pk, 'helpful_count': helpful_count, 'voted': voted})
+    if voted:
+        messages.success(request, 'Thanks for your feedback!')
+    referer = request.META.get('HTTP_REFERER')
+    if referer:
+        return redirect(referer)
+    return redirect('product_reviews', product_id=review.product_id)
+
 
 def about_view(request):
     return render(request, 'about.html')
@@ -450,8 +637,8 @@ def about_view(request):
 
 @login_required
 def profile_view(request):
-    wishlist_items = Wishlist.objects.filter(user=request.user)
-    user_reviews = ProductReview.objects.filter(user=request.user).order_by('-created_at')
+    wishlist_items = Wishlist.objects.filter(user=request.user).select_related('product')
+    user_reviews = ProductReview.objects.filter(user=request.user).select_related('product').order_by('-created_at')
     return render(request, 'profile.html', {
         'wishlist_items': wishlist_items,
         'user_reviews': user_reviews
@@ -540,3 +727,24 @@ def change_password_view(request):
         return redirect('profile')
     
     return redirect('profile')
+
+
+@staff_member_required
+def export_view(request, name):
+    if name not in EXPORTS:
+        raise Http404("Unknown export")
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in FORMATS:
+        fmt = 'csv'
+    user_id = request.GET.get('user')
+    user_id = int(user_id) if user_id and user_id.isdigit() else None
+
+    if isinstance(request, ASGIRequest):
+        # Django would read a sync iterator to the end before sending it.
+        content = astream_export(name, fmt, user_id=user_id)
+    else:
+        content = stream_export(name, fmt, user_id=user_id)
+    response = StreamingHttpResponse(content, content_type=FORMATS[fmt])
+    filename = f"{name}-{timezone.now():%Y%m%d-%H%M%S}.{fmt}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response